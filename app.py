@@ -1,15 +1,25 @@
 import streamlit as st
+from export import EXPORT_FORMATS, FOLLOWER_COLUMNS
+from metrics import METRICS_FILE, metrics
+from resources import use_resources
 from utils import (
+    show_logs_in_page,
+    shared_resources,
     cache_file,
+    merge_uploaded_db,
     retrieve_followers_button,
     check_bot_button,
-    download_bot_result_button
+    download_bot_result_button,
+    results_viewer,
+    jobs_panel
 )
 
 
 def main():
     # Settings
-    st.set_option('deprecation.showfileUploaderEncoding', False)
+    show_logs_in_page()
+    metrics.path = METRICS_FILE
+    use_resources(shared_resources())
 
     # App (Main Window)
     st.title("Twitter Bot Checker Powered by Botometer")
@@ -29,25 +39,33 @@ def main():
         file, which can be found with the app. Credential loaded will be
         cached for later use.
 
-        **Step 2:** Provide an existing database. If not provided, the app will
-        look for database in the temp folder. If no cached database available,
-        a new database will be created.
-
-        **Step 3:** Specify the account whose followers need to be checked,
+        **Step 2:** Specify the account whose followers need to be checked,
         and set the timeframe you want to keep the bot check data.
 
+        **Step 3:** Optionally, provide a database of the followers of the
+        account saved by an older version of the app. It is merged into the
+        database of all the accounts in the temp folder, which is created if
+        not available.
+
         **Step 4:** Run "Retrieve Twitter followers", which uses Tweepy API to
-        retrieve all the followers of a specific account. If a database is
-        provided or cached in the temp folder, the app will only add new
-        followers that are not already in the database. If no database is
-        available, the app will create a new database from scratch.
+        retrieve all the followers of a specific account. If the database
+        in the temp folder already has some of them, the app will only add
+        new followers that are not already in the database. If no database
+        is available, the app will create a new database from scratch.
+        If a previous retrieval was interrupted, it resumes from the last
+        page saved to the database.
 
         **Step 5:** Run "Check bot", which call the Botometer Rapid API to
         check for bot in the database. It will not re-check the followers
-        unless the bot data is expired. A download link will be available
+        unless the bot data is expired. A download button will be available
         at the bottom of the sidebar when the process is completed.
         Alternatively, you can click the "Download bot check results"
-        button to get the download link.
+        button to get it.
+
+        With "Run in the background", steps 4 and 5 run as jobs that keep
+        going if the page is closed or the app restarted. They are listed
+        at the bottom of the page, where they can be paused, resumed or
+        cancelled.
         """)
 
     # App (Side Bar)
@@ -57,31 +75,69 @@ def main():
         "Botometer credentials",
         type=["json"])
     cache_file(credentials_file, "temp", "credentials.json")
-    db_file = st.sidebar.file_uploader(
-        "Select a database (if not provided, the app will look for database "
-        "in the temp folder. If no cached database available, "
-        "a new database will be created.",
-        type=["db"])
-    cache_file(db_file, "temp", "db")
     account_name = st.sidebar.text_input('Twitter Account Handler '
                                          '(without"@"):')
+    db_file = st.sidebar.file_uploader(
+        "Select a database of the followers of the account saved by an "
+        "older version of the app (optional, it is merged into the "
+        "database in the temp folder)",
+        type=["db"])
+    merge_uploaded_db(db_file, account_name)
     days_to_keep = st.sidebar.number_input("Number of days before the\
         bot data expires:", min_value=0, max_value=360, value=180)
     account_cap = st.sidebar.number_input("Accounts Check\
         Daily cap:", min_value=0, value=480)
+    workers = st.sidebar.number_input("Concurrent bot check requests:",
+                                      min_value=1, max_value=32, value=4)
+    rate_per_second = st.sidebar.number_input("Bot check requests per\
+        second:", min_value=0.1, value=1.0)
+    prefetch = st.sidebar.number_input("Concurrent Twitter fetches ahead of\
+        the bot checks (0 for none):", min_value=0, max_value=32, value=4)
+
+    prioritize = st.sidebar.checkbox("Check the most suspicious and most "
+                                     "stale followers first", value=True)
+    prefilter = st.sidebar.checkbox("Skip Botometer for the followers a "
+                                    "local model is sure about",
+                                    value=False)
+    by_id = st.sidebar.checkbox("Retrieve follower IDs first and only "
+                                "look up new followers", value=False)
+    background = st.sidebar.checkbox("Run in the background (keeps running "
+                                     "if the page is closed)", value=True)
+
+    export_format = st.sidebar.selectbox("Download format:",
+                                         list(EXPORT_FORMATS))
+    export_columns = st.sidebar.multiselect("Columns to download (all if "
+                                            "none selected):",
+                                            FOLLOWER_COLUMNS)
+    incremental = st.sidebar.checkbox("Only download followers changed "
+                                      "since the last download",
+                                      value=False)
+    show_results = st.sidebar.checkbox("Show results browser", value=False)
 
     st.sidebar.title("Functions")
     # Retrieve Twitter followers
     if st.sidebar.button("Retrieve Twitter followers"):
-        retrieve_followers_button(account_name)
+        retrieve_followers_button(account_name, by_id, export_format,
+                                  export_columns, background)
 
     # Check bot
     if st.sidebar.button("Check bot"):
-        check_bot_button(account_name, days_to_keep, account_cap)
+        check_bot_button(account_name, days_to_keep, account_cap,
+                         workers, rate_per_second, export_format,
+                         export_columns, prefetch, prioritize, prefilter,
+                         background)
 
     # Download results
     if st.sidebar.button("Download bot check results"):
-        download_bot_result_button(account_name)
+        download_bot_result_button(account_name, export_format,
+                                   export_columns, incremental)
+
+    # Browse results
+    if show_results and account_name:
+        results_viewer(account_name)
+
+    # Background jobs
+    jobs_panel()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,422 @@
+import math
+import time
+import random
+import threading
+from datetime import datetime, timedelta
+import tweepy
+import requests
+import botometer
+from ratelimit import rate_limits
+
+
+class TwitterSource:
+    """
+    Follower source backed by the live Twitter API through Tweepy.
+    Follower sources page through followers with Tweepy style iterators:
+    next() returns a page and next_cursor is the cursor of the page after,
+    0 once the last page has been returned. The pages do not wait for the
+    rate limit, the caller does with the headers of rate_limit_headers().
+    """
+
+    def __init__(self, api):
+        """
+        :param api: Tweepy api returned by twitter_login()
+        """
+        self.api = api
+
+    def follower_pages(self, user_name, cursor=-1):
+        """
+        :return: iterator of pages of up to 200 users
+        """
+        return tweepy.Cursor(self.api.followers, screen_name=user_name,
+                             wait_on_rate_limit=False, count=200,
+                             cursor=cursor).pages()
+
+    def follower_id_pages(self, user_name, cursor=-1):
+        """
+        :return: iterator of pages of up to 5000 user ids
+        """
+        return tweepy.Cursor(self.api.followers_ids, screen_name=user_name,
+                             wait_on_rate_limit=False, count=5000,
+                             cursor=cursor).pages()
+
+    def lookup_users(self, user_ids):
+        """
+        :param user_ids: list of up to 100 user ids
+        :return: list of users, without the ones that cannot be found
+        """
+        return self.api.lookup_users(user_ids=user_ids)
+
+    def rate_limit_headers(self):
+        """
+        :return: headers of the last response of the Twitter API
+        """
+        response = getattr(self.api, "last_response", None)
+        return response.headers if response is not None else {}
+
+
+class PrefetchingBotometer(botometer.Botometer):
+    """
+    Botometer client whose check is split in two steps, so the Twitter
+    fetches of the next accounts can run while the current ones are
+    scored: fetch_payload() gets the timeline, mentions and profile from
+    Twitter and score_payload() posts them to the Botometer API.
+    check_account() does both, like botometer.Botometer. Calls to the
+    Botometer API share one HTTP session until close() and record the
+    RapidAPI rate limit headers in rate_limits.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # the Twitter calls wait for the rate limits in rate_limits rather
+        # than in Tweepy
+        kwargs["wait_on_ratelimit"] = False
+        super().__init__(*args, **kwargs)
+
+    def fetch_payload(self, screen_name):
+        """
+        :param screen_name:
+        :return: payload for score_payload()
+        """
+        # same steps as botometer.Botometer.check_account() (botometer 1.6)
+        payload = self._get_twitter_data(screen_name)
+        if not payload["timeline"]:
+            raise botometer.NoTimelineError(payload["user"])
+        return payload
+
+    def _twitter_call(self, endpoint, method, *args, **kwargs):
+        """
+        Call the Twitter API once the budget of the endpoint allows it,
+        and again after its reset if it returns a 429
+        :param endpoint: name of the endpoint in rate_limits
+        :param method: method of the Tweepy api
+        :return: result of the method
+        """
+        while True:
+            rate_limits.acquire(endpoint)
+            try:
+                result = method(*args, **kwargs)
+            except tweepy.RateLimitError as e:
+                response = getattr(e, "response", None)
+                if response is not None:
+                    rate_limits.update(endpoint, response.headers)
+                if rate_limits.delay(endpoint) > 0:
+                    continue
+                raise
+            response = getattr(self.twitter_api, "last_response", None)
+            if response is not None:
+                rate_limits.update(endpoint, response.headers)
+            return result
+
+    def _get_twitter_data(self, user, full_user_object=False):
+        # botometer.Botometer._get_twitter_data() (botometer 1.6), with the
+        # rate limits of each endpoint handled by rate_limits
+        user_timeline = self._twitter_call(
+            "twitter_user_timeline", self.twitter_api.user_timeline, user,
+            include_rts=True, count=200)
+        if user_timeline:
+            user_data = user_timeline[0]["user"]
+        else:
+            user_data = self._twitter_call(
+                "twitter_get_user", self.twitter_api.get_user, user)
+        search = self._twitter_call(
+            "twitter_search", self.twitter_api.search,
+            "@" + user_data["screen_name"], count=100)
+        payload = {
+            "mentions": search["statuses"],
+            "timeline": user_timeline,
+            "user": user_data,
+        }
+        if not full_user_object:
+            payload["user"] = {
+                "id_str": user_data["id_str"],
+                "screen_name": user_data["screen_name"],
+            }
+        return payload
+
+    def score_payload(self, payload):
+        """
+        :param payload: returned by fetch_payload()
+        :return: result of the Botometer v4 API
+        """
+        response = self._bom_post(self.bom_api_path("check_account"),
+                                  json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    def _bom_post(self, *args, **kwargs):
+        # one keep-alive session instead of a new connection per call
+        if getattr(self, "session", None) is None:
+            self.session = requests.Session()
+        self._add_rapidapi_header(kwargs)
+        response = self.session.post(*args, **kwargs)
+        rate_limits.update("botometer", response.headers)
+        return response
+
+    def close(self):
+        if getattr(self, "session", None) is not None:
+            self.session.close()
+            self.session = None
+
+
+class SimulatedUser:
+    """
+    Stand-in for a Tweepy User, only the _json the app reads is filled in
+    """
+
+    def __init__(self, user_id, seed=0):
+        rng = random.Random(str(seed) + ":" + str(user_id))
+        created_at = datetime(2008, 1, 1) + timedelta(
+            days=rng.randint(0, 4500))
+        self._json = {
+            "id": user_id,
+            "screen_name": "sim_user_" + str(user_id),
+            "name": "Simulated user " + str(user_id),
+            "description": "" if rng.random() < 0.3 else "Simulated bio",
+            "followers_count": int(rng.paretovariate(1.2) * 20),
+            "friends_count": int(rng.paretovariate(1.5) * 50),
+            "listed_count": rng.randint(0, 20),
+            "favourites_count": int(rng.paretovariate(1.1) * 10),
+            "created_at": created_at.strftime("%a %b %d %H:%M:%S +0000 %Y")
+        }
+
+
+class _RateWindow:
+    """
+    Count calls in fixed windows, like the Twitter and RapidAPI limits
+    """
+
+    def __init__(self, calls, seconds):
+        self.calls = calls
+        self.seconds = seconds
+        self.start = time.monotonic()
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        :return: 0 if the call is allowed, otherwise the seconds left
+        until the window resets
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.start >= self.seconds:
+                self.start = now
+                self.used = 0
+            if self.used >= self.calls:
+                return self.start + self.seconds - now
+            self.used += 1
+            return 0
+
+    def headers(self):
+        """
+        :return: the budget of the window in Twitter's rate limit headers
+        """
+        with self.lock:
+            now = time.monotonic()
+            used, reset_in = self.used, self.start + self.seconds - now
+            if reset_in <= 0:
+                used, reset_in = 0, self.seconds
+            return {"x-rate-limit-limit": str(self.calls),
+                    "x-rate-limit-remaining": str(max(0, self.calls - used)),
+                    "x-rate-limit-reset": str(math.ceil(time.time() +
+                                                        reset_in))}
+
+
+class _SimulatedPages:
+
+    def __init__(self, fetch, total, page_size, cursor):
+        self.fetch = fetch
+        self.total = total
+        self.page_size = page_size
+        # cursors are 1 + the offset of the page, as 0 marks the end
+        self.offset = 0 if cursor == -1 else cursor - 1
+        self.next_cursor = cursor
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next_cursor == 0 or self.offset >= self.total:
+            raise StopIteration
+        end = min(self.offset + self.page_size, self.total)
+        page = self.fetch(self.offset, end)
+        self.offset = end
+        self.next_cursor = end + 1 if end < self.total else 0
+        return page
+
+
+class SimulatedSource:
+    """
+    Offline follower source. Every target account has n_followers
+    followers with ids 1..n_followers. Each call sleeps for latency
+    seconds, and after calls_per_window calls the next calls raise a 429
+    RateLimitError until the window resets, like Twitter. The window is
+    reported in Twitter's rate limit headers.
+    """
+
+    def __init__(self, n_followers=10000, latency=0.0, calls_per_window=15,
+                 window_seconds=0, missing_rate=0.01, seed=0):
+        """
+        :param n_followers: number of followers of every target account
+        :param latency: seconds each call takes
+        :param calls_per_window: calls allowed per rate limit window
+        :param window_seconds: length of the window, 0 for no rate limit
+        :param missing_rate: share of the ids that lookup_users drops, as
+        suspended accounts
+        :param seed: seed of the simulated data
+        """
+        self.n_followers = n_followers
+        self.latency = latency
+        self.missing_rate = missing_rate
+        self.seed = seed
+        self.window = _RateWindow(calls_per_window, window_seconds) \
+            if window_seconds else None
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.window is not None and self.window.take():
+            raise tweepy.RateLimitError(
+                "Rate limit exceeded",
+                http_error(429, self.rate_limit_headers()).response)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _users(self, start, end):
+        self._call()
+        return [SimulatedUser(i, self.seed) for i in range(start + 1,
+                                                           end + 1)]
+
+    def _ids(self, start, end):
+        self._call()
+        return list(range(start + 1, end + 1))
+
+    def follower_pages(self, user_name, cursor=-1):
+        return _SimulatedPages(self._users, self.n_followers, 200, cursor)
+
+    def follower_id_pages(self, user_name, cursor=-1):
+        return _SimulatedPages(self._ids, self.n_followers, 5000, cursor)
+
+    def rate_limit_headers(self):
+        return self.window.headers() if self.window is not None else {}
+
+    def lookup_users(self, user_ids):
+        self._call()
+        return [SimulatedUser(i, self.seed) for i in user_ids
+                if random.Random(str(self.seed) + ":missing:" + str(i))
+                .random() >= self.missing_rate]
+
+
+def http_error(status_code, headers=None):
+    """
+    :param status_code: HTTP status code
+    :param headers: dict of the headers of the response
+    :return: requests HTTPError carrying a response with that status code
+    """
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return requests.exceptions.HTTPError(str(status_code) + " Simulated",
+                                         response=response)
+
+
+class SimulatedBotometer:
+    """
+    Offline stand-in for PrefetchingBotometer. Results depend only on the
+    screen_name and the seed, so a run can be repeated exactly whatever
+    the order the workers make the calls in. Private and deleted accounts
+    raise 401 and 404 when their Twitter data is fetched, and calls above
+    the per-second limit or the daily quota raise 429 like RapidAPI. The
+    daily quota is reported in RapidAPI's rate limit headers.
+    """
+
+    def __init__(self, latency=0.5, latency_jitter=0.2, private_rate=0.05,
+                 missing_rate=0.02, rate_per_second=None, daily_quota=None,
+                 seed=0, twitter_latency=0.0):
+        """
+        :param latency: mean seconds a Botometer API call takes
+        :param latency_jitter: the latencies vary by up to this many seconds
+        :param private_rate: share of the accounts that are private (401)
+        :param missing_rate: share of the accounts suspended or deleted (404)
+        :param rate_per_second: calls allowed per second, None for no limit
+        :param daily_quota: calls allowed in total, None for no limit
+        :param seed: seed of the simulated results
+        :param twitter_latency: mean seconds fetching the Twitter data of an
+        account takes
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.private_rate = private_rate
+        self.missing_rate = missing_rate
+        self.seed = seed
+        self.twitter_latency = twitter_latency
+        self.window = _RateWindow(rate_per_second, 1) \
+            if rate_per_second else None
+        self.daily_quota = daily_quota
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _sleep(self, rng, latency):
+        if latency:
+            time.sleep(max(0, latency + rng.uniform(-1, 1) *
+                           self.latency_jitter))
+
+    def fetch_payload(self, screen_name):
+        """
+        :param screen_name:
+        :return: payload for score_payload()
+        """
+        rng = random.Random(str(self.seed) + ":twitter:" + str(screen_name))
+        self._sleep(rng, self.twitter_latency)
+        outcome = rng.random()
+        if outcome < self.private_rate:
+            raise http_error(401)
+        if outcome < self.private_rate + self.missing_rate:
+            raise http_error(404)
+        return {"user": {"screen_name": screen_name}}
+
+    def score_payload(self, payload):
+        """
+        :param payload: returned by fetch_payload()
+        :return: result in the format of the Botometer v4 API
+        """
+        with self.lock:
+            self.calls += 1
+            over_quota = self.daily_quota is not None \
+                and self.calls > self.daily_quota
+            headers = {}
+            if self.daily_quota is not None:
+                tomorrow = datetime.combine(
+                    datetime.now().date() + timedelta(days=1),
+                    datetime.min.time())
+                headers = {
+                    "x-ratelimit-requests-limit": str(self.daily_quota),
+                    "x-ratelimit-requests-remaining":
+                        str(max(0, self.daily_quota - self.calls)),
+                    "x-ratelimit-requests-reset":
+                        str(int((tomorrow - datetime.now()).total_seconds()))
+                }
+        # like the responses PrefetchingBotometer reads
+        rate_limits.update("botometer", headers)
+        if over_quota or (self.window is not None and self.window.take()):
+            raise http_error(429)
+
+        rng = random.Random(str(self.seed) + ":" +
+                            str(payload["user"]["screen_name"]))
+        self._sleep(rng, self.latency)
+        categories = ["astroturf", "fake_follower", "financial", "other",
+                      "overall", "self_declared", "spammer"]
+        return {
+            "cap": {"english": rng.random(), "universal": rng.random()},
+            "raw_scores": {
+                "english": {c: rng.random() for c in categories},
+                "universal": {c: rng.random() for c in categories}
+            }
+        }
+
+    def check_account(self, screen_name):
+        """
+        :param screen_name:
+        :return: result in the format of the Botometer v4 API
+        """
+        return self.score_payload(self.fetch_payload(screen_name))
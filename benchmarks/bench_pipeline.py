@@ -0,0 +1,190 @@
+"""
+Benchmark the hot paths of the pipeline against the simulated backends:
+follower ingestion, selection of the followers due, in the prioritized
+order the app and the command line use by default, scoring and export.
+Each stage runs in its own process so its peak RSS can be measured.
+Run from the root of the repository:
+
+    python -m benchmarks.bench_pipeline --sizes 10000 1000000
+
+Results are printed and saved as json (temp/bench_pipeline_<time>.json by
+default) so runs can be compared.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+
+STAGES = ["ingest", "select", "score", "export"]
+
+
+def io_write_bytes():
+    """
+    :return: bytes this process made the storage layer write, None where
+    /proc/self/io is not available
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        return None
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def db_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal")
+               if os.path.exists(p))
+
+
+def run_stage(stage, rows, score_rows):
+    """
+    Run one stage in the current working directory
+    :param stage: one of STAGES
+    :param rows: number of followers of the synthetic account
+    :param score_rows: number of followers to score
+    :return: dict of metrics
+    """
+    from backends import SimulatedSource, SimulatedBotometer
+    from bot_checker import get_followers, save_followers_to_db, run_checks
+    from db import (
+        FOLLOWERS_DB,
+        create_connection,
+        create_new_followers_table,
+        CheckResultWriter,
+        select_followers_to_check
+    )
+    from export import export_followers
+    from ratelimit import TokenBucket
+
+    user_name = "bench_" + str(rows)
+    database = FOLLOWERS_DB
+    write_before = io_write_bytes()
+    start = time.perf_counter()
+
+    if stage == "ingest":
+        create_new_followers_table(database)
+        n = save_followers_to_db(user_name, get_followers(
+            SimulatedSource(n_followers=rows), user_name))
+        logical = n * 200  # rough size of a follower profile row
+    elif stage == "select":
+        conn = create_connection(database)
+        n = sum(1 for _ in select_followers_to_check(
+            conn, user_name, 180, score_rows, prioritize=True))
+        logical = 0
+    elif stage == "score":
+        conn = create_connection(database)
+        followers = list(select_followers_to_check(
+            conn, user_name, 180, score_rows, prioritize=True))
+        bucket = TokenBucket(rate=1e9, burst=10 ** 6)
+        with CheckResultWriter(conn) as writer:
+            n, _ = run_checks(
+                SimulatedBotometer(latency=0, latency_jitter=0), followers,
+                bucket, lambda user_id, action, result: writer.add(
+                    action, result), workers=8)
+        logical = n * 19 * 8  # the score columns of a result
+    elif stage == "export":
+        path = export_followers(user_name, "csv")
+        n = rows
+        logical = os.path.getsize(path)
+    else:
+        raise ValueError("Unknown stage: " + stage)
+
+    seconds = time.perf_counter() - start
+    write_after = io_write_bytes()
+    written = None if write_before is None else write_after - write_before
+    return {
+        "stage": stage,
+        "rows": rows,
+        "items": n,
+        "seconds": round(seconds, 4),
+        "items_per_second": round(n / seconds, 1) if seconds else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "bytes_written": written,
+        "write_amplification": round(written / logical, 2)
+        if written and logical else None,
+        "db_bytes": db_size(database)
+    }
+
+
+def run_benchmark(sizes, score_rows, workdir=None):
+    """
+    Run every stage for every size, each in a child process
+    :param sizes: list of follower counts
+    :param score_rows: number of followers to score per size
+    :param workdir: directory for the benchmark databases, a temporary
+    one by default
+    :return: list of the metrics of every stage
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    workdir = workdir or tempfile.mkdtemp(prefix="bench_pipeline_")
+    os.makedirs(os.path.join(workdir, "temp"), exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep +
+               os.environ.get("PYTHONPATH", ""))
+    results = []
+    try:
+        for rows in sizes:
+            for stage in STAGES:
+                out = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_pipeline",
+                     "--stage", stage, "--sizes", str(rows),
+                     "--score-rows", str(min(score_rows, rows))],
+                    cwd=workdir, env=env, check=True,
+                    stdout=subprocess.PIPE, universal_newlines=True).stdout
+                result = json.loads(out.strip().splitlines()[-1])
+                print(json.dumps(result), flush=True)
+                results.append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark ingestion, selection, scoring and export.")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10000, 1000000, 10000000],
+                        help="numbers of synthetic followers")
+    parser.add_argument("--score-rows", type=int, default=10000,
+                        help="followers scored per size")
+    parser.add_argument("--output",
+                        help="json file for the results (default: "
+                             "temp/bench_pipeline_<time>.json)")
+    parser.add_argument("--stage", choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.stage:
+        # child process: run one stage in the current directory
+        print(json.dumps(run_stage(args.stage, args.sizes[0],
+                                   args.score_rows)))
+        return 0
+
+    results = run_benchmark(args.sizes, args.score_rows)
+    output = args.output or "temp/bench_pipeline_" + \
+        datetime.now().strftime("%Y%m%d_%H%M%S") + ".json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"created_at": datetime.now().isoformat(),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "results": results}, f, indent=2)
+    print("Results saved to " + output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
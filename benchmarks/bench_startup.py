@@ -0,0 +1,135 @@
+"""
+Benchmark the cold start of the app, the jobs and the command line: the
+time to import each entry point and to render the first page of the
+Streamlit app. Each measure runs in a new process, so nothing is already
+imported, and is repeated to report the median. Run from the root of the
+repository:
+
+    python -m benchmarks.bench_startup --repeat 5
+
+Results are printed and saved as json (temp/bench_startup_<time>.json by
+default) so runs can be compared.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import importlib
+import statistics
+import subprocess
+from datetime import datetime
+
+
+# entry points whose import time is measured
+MODULES = ["app", "utils", "jobs", "cli", "bot_checker", "scheduler"]
+
+# dependencies worth importing only on the paths that use them
+HEAVY_MODULES = ["streamlit", "pandas", "numpy", "pyarrow", "tweepy",
+                 "botometer", "requests"]
+
+
+def run_stage(stage, module):
+    """
+    Run one measure in the current process
+    :param stage: "import" or "render"
+    :param module: module to import, "app" for "render"
+    :return: dict of metrics
+    """
+    start = time.perf_counter()
+    imported = importlib.import_module(module)
+    result = {"stage": stage, "module": module,
+              "import_seconds": time.perf_counter() - start}
+    if stage == "render":
+        # the Streamlit calls are no-ops outside of streamlit run, this
+        # times the work of the script itself
+        start = time.perf_counter()
+        imported.main()
+        result["render_seconds"] = time.perf_counter() - start
+    result["heavy_modules"] = [m for m in HEAVY_MODULES if m in sys.modules]
+    return result
+
+
+def run_benchmark(modules, repeat, workdir=None):
+    """
+    Run every measure repeat times, each in a child process
+    :param modules: list of modules to import
+    :param repeat: number of runs of each measure
+    :param workdir: working directory of the runs, a temporary one by
+    default
+    :return: list of the metrics of every measure, with the medians of
+    the runs
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    workdir = workdir or tempfile.mkdtemp(prefix="bench_startup_")
+    os.makedirs(os.path.join(workdir, "temp"), exist_ok=True)
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep +
+               os.environ.get("PYTHONPATH", ""))
+    measures = [("import", m) for m in modules] + [("render", "app")]
+    results = []
+    try:
+        for stage, module in measures:
+            runs = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                out = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_startup",
+                     "--stage", stage, "--modules", module],
+                    cwd=workdir, env=env, check=True,
+                    stdout=subprocess.PIPE, universal_newlines=True).stdout
+                run = json.loads(out.strip().splitlines()[-1])
+                # interpreter start included
+                run["process_seconds"] = time.perf_counter() - start
+                runs.append(run)
+            result = {"stage": stage, "module": module, "runs": repeat,
+                      "heavy_modules": runs[-1]["heavy_modules"]}
+            for name in ("import_seconds", "render_seconds",
+                         "process_seconds"):
+                if name in runs[0]:
+                    result[name] = round(statistics.median(
+                        r[name] for r in runs), 4)
+            print(json.dumps(result), flush=True)
+            results.append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the import time of the entry points and "
+                    "the first render of the app.")
+    parser.add_argument("--modules", nargs="+", default=MODULES,
+                        help="modules whose import time is measured")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs of each measure, the median is reported")
+    parser.add_argument("--output",
+                        help="json file for the results (default: "
+                             "temp/bench_startup_<time>.json)")
+    parser.add_argument("--stage", choices=["import", "render"],
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.stage:
+        # child process: run one measure in the current directory
+        print(json.dumps(run_stage(args.stage, args.modules[0])))
+        return 0
+
+    results = run_benchmark(args.modules, args.repeat)
+    output = args.output or "temp/bench_startup_" + \
+        datetime.now().strftime("%Y%m%d_%H%M%S") + ".json"
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"created_at": datetime.now().isoformat(),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "results": results}, f, indent=2)
+    print("Results saved to " + output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
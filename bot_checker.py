@@ -0,0 +1,802 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from functools import partial
+from datetime import datetime
+from ratelimit import TokenBucket, backoff_delay, rate_limits
+from metrics import metrics
+from resources import current_resources
+from prefilter import LOOKAHEAD, train_prefilter, split_followers
+from db import (
+    FOLLOWERS_DB,
+    create_connection,
+    create_new_followers_table,
+    create_followers,
+    get_new_follower_ids,
+    link_followers,
+    get_crawl_checkpoint,
+    start_crawl_run,
+    save_crawl_checkpoint,
+    stage_crawl_ids,
+    diff_crawl,
+    get_crawl_status,
+    CheckResultWriter,
+    select_followers_to_check,
+    count_followers_to_check
+)
+
+# tweepy, botometer and requests are imported by the functions calling the
+# APIs, so importing this module for the UI or the jobs is fast
+
+
+logger = logging.getLogger(__name__)
+
+CREDENTIALS_FILE = "temp/credentials.json"
+
+# longest wait for the Botometer rate limit to reset, a run stops as
+# rate limited rather than waiting for a daily quota
+MAX_RATE_LIMIT_WAIT = 900.0
+
+# extra attributes telling the Streamlit UI how to show a log record
+SUCCESS = {"status": "success"}
+DETAIL = {"status": "text"}
+
+# path -> (modification time and size of the file, parsed credentials)
+_credentials = {}
+
+
+def get_credentials(path=CREDENTIALS_FILE):
+    """
+    Load credential.json file, by default from the temp folder. The file
+    is only parsed again when it changed.
+    :param path: path to the credentials file
+    :return:
+    """
+    try:
+        f = open(path)
+    except IOError:
+        logger.error("Cannot find cached credentials."
+                     "Please specify file containing the credentials.")
+        raise
+    else:
+        with f:
+            stat = os.fstat(f.fileno())
+            version = (stat.st_mtime_ns, stat.st_size)
+            cached = _credentials.get(path)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            credentials = json.load(f)
+            _credentials[path] = (version, credentials)
+            return(credentials)
+
+
+def twitter_login(credentials):
+    """
+    Log in Twitter API
+    :param credentials: credentials returned by get_credentials()
+    :return: the api object
+    """
+    resources = current_resources()
+    if resources is not None:
+        # AppAuthHandler requests a bearer token on every login
+        return resources.client(
+            ("twitter", _credentials_key(credentials["twitter_app_auth"])),
+            partial(_twitter_login, credentials))
+    return _twitter_login(credentials)
+
+
+def _twitter_login(credentials):
+    import tweepy
+
+    consumer_key = credentials["twitter_app_auth"]["consumer_key"]
+    consumer_secret = credentials["twitter_app_auth"]["consumer_secret"]
+
+    auth = tweepy.AppAuthHandler(consumer_key, consumer_secret)
+    # the calls wait for the rate limits in rate_limits, Tweepy would
+    # sleep until 5 seconds after the reset of any endpoint hitting it
+    api = tweepy.API(auth, wait_on_rate_limit=False)
+    if (api.verify_credentials):
+        logger.info('Twitter API successfully logged in.', extra=SUCCESS)
+    else:
+        logger.error('Login failed, please check Twitter credentials.')
+    return(api)
+
+
+def _credentials_key(credentials):
+    return json.dumps(credentials, sort_keys=True)
+
+
+def botometer_login(credentials):
+    """
+    Create the Botometer api
+    :param credentials: credentials returned by get_credentials()
+    :return: the Botometer object
+    """
+    from backends import PrefetchingBotometer
+
+    rapidapi_key = credentials["botometer_auth"]["rapidapi_key"]
+    twitter_app_auth = credentials["twitter_app_auth"]
+    login = partial(PrefetchingBotometer, rapidapi_key=rapidapi_key,
+                    **twitter_app_auth)
+    resources = current_resources()
+    if resources is not None:
+        return resources.client(("botometer", _credentials_key(credentials)),
+                                login)
+    return login()
+
+
+def check_user_name(user_name):
+    """
+    Check if target account name was given
+    :param user_name:
+    :return:
+    """
+    if user_name == "":
+        logger.error("You need to specify a target account name.")
+        raise TypeError("user_name is empty")
+
+
+def save_followers_to_db(user_name, pages, run_id=None, progress=None):
+    """
+    Save the followers data returned by Tweepy to SQLite db, one page at
+    a time as the pages arrive, so only one page is held in memory.
+    Known followers only get their profile written if it changed.
+    :param user_name: the screen_name of the account for which the followers
+    are collected
+    :param pages: iterable of (page, next_cursor) yielded by get_followers()
+    :param run_id: id of the crawl run to checkpoint after each page
+    :param progress: optional callback taking the number of followers saved
+    :return: number of followers saved
+    """
+    # create a database connection
+    conn = create_connection(FOLLOWERS_DB)
+    n = 0
+    for page, next_cursor in pages:
+        # one transaction per page
+        with metrics.timer("db_write"), conn:
+            followers = [(i._json["id"],
+                          i._json["screen_name"],
+                          i._json["name"],
+                          i._json["description"],
+                          i._json["followers_count"],
+                          i._json["friends_count"],
+                          i._json["listed_count"],
+                          i._json["favourites_count"],
+                          i._json["created_at"])
+                         for i in page]
+            updated = create_followers(conn, followers, user_name)
+            if run_id is not None:
+                stage_crawl_ids(conn, run_id, [f[0] for f in followers])
+                save_crawl_checkpoint(conn, run_id, next_cursor, len(page),
+                                      updated)
+        n += len(page)
+        metrics.set_gauge("followers_saved", n)
+        metrics.maybe_write()
+        if progress is not None:
+            progress(n)
+
+    logger.info("Successfully saved followers to database.", extra=SUCCESS)
+    return n
+
+
+def is_rate_limited(endpoint, error):
+    """
+    Record the rate limit headers of the response of a Tweepy error
+    :param endpoint: name of the endpoint in rate_limits
+    :param error: TweepError
+    :return: True if the error is a 429
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return False
+    rate_limits.update(endpoint, response.headers)
+    return response.status_code == 429
+
+
+def fetch_pages(source, pages, endpoint):
+    """
+    Iterate over a Tweepy page iterator, waiting for the rate limit of the
+    endpoint before each page, and retrying the same page when Twitter
+    returns an error
+    :param source: follower source the pages come from
+    :param pages: Tweepy CursorIterator or a follower source page iterator
+    :param endpoint: name of the endpoint in rate_limits
+    :return: generator of pages
+    """
+    import tweepy
+
+    attempt = 0
+    while True:
+        with metrics.timer("twitter_sleep"):
+            rate_limits.acquire(endpoint)
+        try:
+            with metrics.timer("twitter_page"):
+                page = next(pages)
+        except StopIteration:
+            return
+        except tweepy.TweepError as e:
+            # the cursor is not advanced, so the same page is fetched again
+            if is_rate_limited(endpoint, e):
+                logger.info("Twitter API limit has been reached. Continue "
+                            "in " + str(int(rate_limits.delay(endpoint))) +
+                            "s.", extra=DETAIL)
+                if rate_limits.delay(endpoint) > 0:
+                    continue
+            delay = backoff_delay(attempt, cap=60.0)
+            logger.info("Twitter API error. Retry in " + str(int(delay)) +
+                        "s. " + str(e), extra=DETAIL)
+            with metrics.timer("twitter_sleep"):
+                time.sleep(delay)
+            attempt += 1
+            continue
+        attempt = 0
+        rate_limits.update(endpoint, source.rate_limit_headers())
+        yield page
+
+
+def get_followers(source, user_name, cursor=-1):
+    """
+    Get all followers of a twitter account, page by page
+    :param source: follower source, e.g. TwitterSource
+    :param user_name: twitter username without '@' symbol
+    :param cursor: Tweepy cursor to start from, -1 for the first page
+    :return: generator of (page, next_cursor), each page a list of up to
+    200 Tweepy users
+    """
+    check_user_name(user_name)
+
+    logger.info("Begin to retrieve followers of " + user_name + "...")
+    pages = source.follower_pages(user_name, cursor)
+    for page in fetch_pages(source, pages, "twitter_followers"):
+        yield page, pages.next_cursor
+    logger.info("Completed retrieving all followers of " + user_name,
+                extra=SUCCESS)
+
+
+def get_followers_by_id(source, user_name, conn, cursor=-1, run_id=None):
+    """
+    Get the followers of a twitter account by pulling the follower ids
+    first (5000 per call) and only looking up the profiles of the ids that
+    are not in the database yet (100 per call)
+    :param source: follower source, e.g. TwitterSource
+    :param user_name: twitter username without '@' symbol
+    :param conn: Connection object of the followers database
+    :param cursor: Tweepy cursor of the id pages to start from
+    :param run_id: id of the crawl run the fetched ids are recorded for
+    :return: generator of (users, next_cursor). next_cursor stays at the
+    current id page until all its new ids have been looked up.
+    """
+    import tweepy
+
+    check_user_name(user_name)
+
+    logger.info("Begin to retrieve follower ids of " + user_name + "...")
+    pages = source.follower_id_pages(user_name, cursor)
+    for ids in fetch_pages(source, pages, "twitter_followers_ids"):
+        new_ids = get_new_follower_ids(conn, ids)
+        # the followers already known from other accounts are only linked
+        with conn:
+            link_followers(conn, user_name, ids)
+            if run_id is not None:
+                stage_crawl_ids(conn, run_id, ids)
+        for i in range(0, len(new_ids), 100):
+            while True:
+                with metrics.timer("twitter_sleep"):
+                    rate_limits.acquire("twitter_lookup_users")
+                try:
+                    with metrics.timer("twitter_lookup"):
+                        users = source.lookup_users(new_ids[i:i + 100])
+                except tweepy.TweepError as e:
+                    if is_rate_limited("twitter_lookup_users", e) and \
+                            rate_limits.delay("twitter_lookup_users") > 0:
+                        # wait for the reset and look them up again
+                        continue
+                    # none of the ids can be looked up, e.g. all suspended
+                    logger.info("Cannot look up followers. " + str(e),
+                                extra=DETAIL)
+                    users = []
+                else:
+                    rate_limits.update("twitter_lookup_users",
+                                       source.rate_limit_headers())
+                break
+            last_batch = i + 100 >= len(new_ids)
+            yield users, pages.next_cursor if last_batch else cursor
+        if not new_ids:
+            yield [], pages.next_cursor
+        cursor = pages.next_cursor
+    logger.info("Completed retrieving all followers of " + user_name,
+                extra=SUCCESS)
+
+
+def retrieve_followers(user_name, by_id=False,
+                       credentials_file=CREDENTIALS_FILE, progress=None,
+                       source=None):
+    """
+    Retrieve the followers of an account and save them to the database,
+    resuming from the last checkpoint if a previous run did not finish.
+    :param user_name: the screen_name of the target account
+    :param by_id: fetch the follower ids first and only look up the
+    profiles of new followers
+    :param credentials_file: path to the credentials file
+    :param progress: optional callback taking the number of followers saved
+    :param source: follower source, by default the live Twitter API
+    :return: number of followers saved
+    """
+    check_user_name(user_name)
+
+    # Create the follower database if not exist
+    database = FOLLOWERS_DB
+    create_new_followers_table(database)
+
+    # Resume from the last checkpoint if a previous run did not finish
+    conn = create_connection(database)
+    mode = "ids" if by_id else "profiles"
+    checkpoint = get_crawl_checkpoint(conn, user_name, mode)
+    if checkpoint is not None:
+        run_id, cursor = checkpoint
+        logger.info("Resuming the previous retrieval from its last "
+                    "checkpoint.")
+    else:
+        run_id, cursor = start_crawl_run(conn, user_name, mode), -1
+
+    # Retrieve followers and save each page to database as it arrives
+    if source is None:
+        from backends import TwitterSource
+        source = TwitterSource(twitter_login(get_credentials(
+            credentials_file)))
+    if by_id:
+        pages = get_followers_by_id(source, user_name, conn, cursor, run_id)
+    else:
+        pages = get_followers(source, user_name, cursor)
+    n = save_followers_to_db(user_name, pages, run_id, progress)
+
+    # Compare with the followers stored before, once all have been fetched
+    if get_crawl_status(conn, run_id) == "finished":
+        churn = diff_crawl(conn, run_id, user_name)
+        logger.info(str(churn["new"]) + " new followers, " +
+                    str(churn["lost"]) + " lost, " + str(churn["returned"]) +
+                    " back and " + str(churn["updated"]) +
+                    " profiles updated since the last retrieval.")
+    return n
+
+
+def check_bot(screen_name, bom, fetch=None):
+    """
+    Call the Botometer API to return bot check info for an account
+    :param screen_name:
+    :param bom:
+    :param fetch: Future of the payload prefetched by PayloadPrefetcher,
+    None to fetch the Twitter data in the Botometer call
+    :return: result, check_action
+    """
+    import tweepy
+    import requests
+    import botometer
+
+    result = (screen_name,)
+    try:
+        payload = None
+        if fetch is not None:
+            # errors of the Twitter fetch are raised and handled here
+            with metrics.timer("prefetch_wait"):
+                payload = fetch.result()
+        with metrics.timer("botometer_call"):
+            if payload is None:
+                result_js = bom.check_account(screen_name)
+            else:
+                result_js = bom.score_payload(payload)
+        cap = result_js["cap"]
+        raw_scores_en = result_js["raw_scores"]["english"]
+        raw_scores_un = result_js["raw_scores"]["universal"]
+
+        # Store the following results to tuple
+        result = (
+            cap["english"],
+            raw_scores_en["astroturf"],
+            raw_scores_en["fake_follower"],
+            raw_scores_en["financial"],
+            raw_scores_en["other"],
+            raw_scores_en["overall"],
+            raw_scores_en["self_declared"],
+            raw_scores_en["spammer"],
+            cap["universal"],
+            raw_scores_un["astroturf"],
+            raw_scores_un["fake_follower"],
+            raw_scores_un["financial"],
+            raw_scores_un["other"],
+            raw_scores_un["overall"],
+            raw_scores_un["self_declared"],
+            raw_scores_un["spammer"],
+            datetime.now(),  # stamp with current date and time
+            "success",
+            screen_name)  # need screen_name here as key
+
+        check_action = "success"
+        return(result, check_action)
+
+    except requests.exceptions.HTTPError as e:
+        status_code = e.response.status_code
+        if status_code == 401:
+            logger.info(screen_name + " is a private account, "
+                                      "skipping bot check...", extra=DETAIL)
+            check_action = "skip"
+            return(result, check_action)
+
+        elif status_code == 404:
+            logger.info(screen_name + " has been suspended or deleted, "
+                                      "skipping bot check...", extra=DETAIL)
+            check_action = "skip"
+            return(result, check_action)
+
+        elif status_code == 403:
+            logger.error("Botometer account error! "
+                         "Please check Rapid API subscription and settings")
+            raise requests.exceptions.HTTPError
+
+        elif status_code == 429:
+            # the caller backs off and retries this request only
+            check_action = "retry"
+            return(result, check_action)
+
+        else:
+            logger.error("HTTP error: " + str(status_code))
+            raise requests.exceptions.HTTPError
+
+    except tweepy.RateLimitError:
+        # Twitter did not tell when its limit resets, the caller backs off
+        check_action = "retry"
+        return(result, check_action)
+
+    except tweepy.TweepError as e:
+        error_text = e.response.text
+        if "Not authorized" in error_text:
+            logger.info(screen_name + " is a private account, "
+                                      "skipping bot check...", extra=DETAIL)
+            check_action = "skip"
+            return(result, check_action)
+        elif "does not exist" in error_text:
+            logger.info(screen_name + " does not exist, "
+                                      "skipping bot check...", extra=DETAIL)
+            check_action = "skip"
+            return(result, check_action)
+        else:
+            logger.error("Other Tweepy error: " + error_text)
+            raise
+
+    except botometer.NoTimelineError:
+        logger.info(screen_name + " account does not have enough "
+                                  "information, skipping bot check...",
+                    extra=DETAIL)
+        check_action = "skip"
+        return(result, check_action)
+
+    except Exception:
+        logger.error("Unexpected error: " + str(sys.exc_info()[0]))
+        raise
+
+
+class PayloadPrefetcher:
+    """
+    Fetch the Twitter data of the accounts to check ahead of their
+    Botometer calls, on a separate pool of threads, so Twitter I/O and
+    scoring I/O overlap. Twitter has no bulk timeline endpoint, so each
+    account takes one fetch; at most `depth` accounts are fetched ahead
+    of the scoring workers to bound the memory held by timelines. A
+    payload is fetched once and reused when its Botometer call is retried.
+    """
+
+    def __init__(self, bom, screen_names, bucket, stop, workers=4,
+                 depth=None):
+        """
+        :param bom: Botometer api with fetch_payload and score_payload
+        :param screen_names: accounts in the order they will be scored
+        :param bucket: TokenBucket of the run, nothing is fetched once its
+        quota is used up
+        :param stop: threading.Event set when the run should stop
+        :param workers: number of concurrent Twitter fetches
+        :param depth: number of accounts fetched ahead, twice workers by
+        default
+        """
+        self.bom = bom
+        self.screen_names = screen_names
+        self.bucket = bucket
+        self.stop = stop
+        self.depth = depth or 2 * workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def _fetch(self, screen_name):
+        if self.stop.is_set() or self.bucket.remaining() == 0:
+            # the account will not be scored
+            return None
+        with metrics.timer("twitter_fetch"):
+            return self.bom.fetch_payload(screen_name)
+
+    def get(self, i):
+        """
+        :param i: position of the account in screen_names
+        :return: Future of the payload of the account, its result is None
+        if the account was not fetched because the run is stopping
+        """
+        with self.lock:
+            if self.stop.is_set() and i not in self.futures:
+                # closed, nothing more is fetched
+                future = Future()
+                future.set_result(None)
+                return future
+            while self.next < min(i + self.depth + 1,
+                                  len(self.screen_names)):
+                self.futures[self.next] = self.executor.submit(
+                    self._fetch, self.screen_names[self.next])
+                self.next += 1
+            # the scoring worker keeps the only reference to the payload
+            return self.futures.pop(i)
+
+    def close(self):
+        self.stop.set()
+        self.executor.shutdown(wait=True)
+
+
+def check_bot_with_retry(screen_name, bom, bucket, stop, max_retries=6,
+                         fetch=None):
+    """
+    Check one account, waiting for the reset given by the rate limit
+    headers, or backing off with jitter on a 429 without them, without
+    blocking the other workers.
+    :param screen_name:
+    :param bom: Botometer api
+    :param bucket: the TokenBucket shared by all the workers
+    :param stop: threading.Event set when the run should stop
+    :param max_retries: number of retries after a 429
+    :param fetch: optional function returning the Future of the prefetched
+    payload of the account
+    :return: result, check_action ("cap" if the quota is used up,
+    "retry" if it is still rate limited after all retries or the rate
+    limit resets in more than MAX_RATE_LIMIT_WAIT seconds)
+    """
+    if stop.is_set():
+        return((screen_name,), "cap")
+
+    result = (screen_name,)
+    for attempt in range(max_retries + 1):
+        # wait for the rate limit to reset, waking up early if the run is
+        # stopped, then for the bucket. Retries were already counted
+        # against the quota.
+        with metrics.timer("rate_limit_wait"):
+            if not rate_limits.acquire("botometer", stop,
+                                       MAX_RATE_LIMIT_WAIT):
+                break
+            if not bucket.acquire(consume_quota=attempt == 0):
+                return((screen_name,), "cap")
+        if attempt == 0:
+            start = time.monotonic()
+            if fetch is not None:
+                fetch = fetch()
+        result, action = check_bot(screen_name, bom, fetch)
+        if action != "retry":
+            # time to check one account, retries included
+            metrics.observe("check", time.monotonic() - start)
+            return(result, action)
+        if attempt == max_retries:
+            break
+        if rate_limits.delay("botometer") == 0:
+            # the 429 did not tell when to retry
+            with metrics.timer("backoff_sleep"):
+                if stop.wait(backoff_delay(attempt)):
+                    break
+    return(result, "retry")
+
+
+def update_check_gauges(bucket, total, done):
+    """
+    Update the progress, quota left and ETA of the bot checks in the
+    metrics, writing the metrics file every few seconds
+    :param bucket: TokenBucket shared by the workers
+    :param total: number of followers to check in this run
+    :param done: number of followers done so far
+    :return:
+    """
+    quota_left = bucket.remaining()
+    remaining = total - done
+    if quota_left is not None:
+        remaining = min(remaining, quota_left)
+    rate = metrics.rate("check")
+    metrics.set_gauge("checks_total", total)
+    metrics.set_gauge("checks_done", done)
+    metrics.set_gauge("quota_left", quota_left)
+    metrics.set_gauge("eta_seconds", remaining / rate if rate else None)
+    for endpoint, state in rate_limits.state().items():
+        metrics.set_gauge("rate_limit_remaining_" + endpoint,
+                          state["remaining"])
+    metrics.maybe_write()
+
+
+def run_checks(bom, followers_to_check, bucket, on_result, workers=4,
+               progress=None, prefetch=0):
+    """
+    Run bot checks concurrently. API calls are made by the worker threads,
+    on_result is called on the calling thread so it can write to db.
+    :param bom: Botometer api
+    :param followers_to_check: list of (id, screen_name)
+    :param bucket: TokenBucket shared by the workers
+    :param on_result: callback taking (id, check_action, result) for each
+    account checked or skipped
+    :param workers: number of concurrent Botometer requests
+    :param progress: optional callback taking the fraction completed
+    :param prefetch: number of concurrent Twitter fetches running ahead of
+    the Botometer calls, 0 to let each Botometer call fetch its own data.
+    Needs a Botometer api with fetch_payload and score_payload.
+    :return: tuple (checked, completed): the number of accounts checked
+    or skipped, and False if the run was stopped because the Botometer API
+    kept returning 429, True otherwise
+    """
+    followers_to_check = list(followers_to_check)
+    N = len(followers_to_check)
+    stop = threading.Event()
+    checked = 0
+    completed = True
+    update_check_gauges(bucket, N, 0)
+
+    prefetcher = None
+    if prefetch > 0 and hasattr(bom, "fetch_payload"):
+        prefetcher = PayloadPrefetcher(
+            bom, [screen_name for _, screen_name in followers_to_check],
+            bucket, stop, workers=prefetch)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(
+            check_bot_with_retry, screen_name, bom, bucket, stop,
+            fetch=partial(prefetcher.get, i) if prefetcher else None):
+            user_id
+            for i, (user_id, screen_name) in enumerate(followers_to_check)}
+        try:
+            for i, future in enumerate(as_completed(futures), 1):
+                result, action = future.result()
+                if action in ("success", "skip"):
+                    on_result(futures[future], action, result)
+                    checked += 1
+                elif action == "retry":
+                    completed = False
+                    stop.set()
+                update_check_gauges(bucket, N, i)
+                if progress is not None and N > 0:
+                    progress(i/N)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+            metrics.write()
+
+    return(checked, completed)
+
+
+def check_bots(conn, bom, followers_to_check, bucket, workers=4,
+               progress=None, prefetch=0):
+    """
+    Run bot checks concurrently and store the results to db.
+    :param conn: Connection object
+    :param bom: Botometer api
+    :param followers_to_check: list of (id, screen_name)
+    :param bucket: TokenBucket shared by the workers
+    :param workers: number of concurrent Botometer requests
+    :param progress: optional callback taking the fraction completed
+    :param prefetch: number of concurrent Twitter fetches running ahead of
+    the Botometer calls
+    :return: tuple (checked, completed): the number of accounts checked
+    or skipped, and False if the run was stopped because the Botometer API
+    kept returning 429, True otherwise
+    """
+    with CheckResultWriter(conn) as writer:
+        return run_checks(
+            bom, followers_to_check, bucket,
+            lambda user_id, action, result: writer.add(action, result),
+            workers=workers, progress=progress, prefetch=prefetch)
+
+
+def run_bot_check(user_name, days_to_keep, account_cap, workers=4,
+                  rate_per_second=1.0, credentials_file=CREDENTIALS_FILE,
+                  progress=None, scorer=None, prefetch=4, prioritize=True,
+                  prefilter=False):
+    """
+    Check the followers of an account whose bot data is missing or expired
+    :param user_name: the screen_name of the target account
+    :param days_to_keep: number of days before the bot data expires
+    :param account_cap: maximum number of accounts to check in this run
+    :param workers: number of concurrent Botometer requests
+    :param rate_per_second: Botometer requests allowed per second
+    :param credentials_file: path to the credentials file
+    :param progress: optional callback taking the fraction completed
+    :param scorer: score provider with a check_account method, by default
+    the live Botometer API
+    :param prefetch: number of concurrent Twitter fetches running ahead of
+    the Botometer calls, 0 to fetch in the Botometer calls
+    :param prioritize: check the most suspicious and most stale followers
+    first, otherwise never checked followers in table order then the
+    oldest checks
+    :param prefilter: estimate the bot probability of the due followers
+    from their profiles with a model trained on the followers already
+    checked, and only send the ones it is unsure about to Botometer
+    :return: dict summarising the run: due (number of followers due,
+    counted up to the cap), checked, predicted, cap_reached and
+    rate_limited
+    """
+    check_user_name(user_name)
+
+    # Create botometer api
+    bom = scorer
+    if bom is None:
+        bom = botometer_login(get_credentials(credentials_file))
+
+    # Load followers table, adding the tables and indexes missing from
+    # older databases
+    database = FOLLOWERS_DB
+    conn = create_connection(database)
+    create_new_followers_table(database)
+
+    # Calculate the number of followers need to be checked, only counting
+    # as far as needed for the warnings below
+    N = count_followers_to_check(conn, user_name, days_to_keep,
+                                 max(account_cap, 500) + 1)
+
+    if N > 500:
+        logger.warning("You have more than 500 followers to check. "
+                       "This is beyond the Botometer's daily limit (free "
+                       "plan), which may lead to suspension of your Rapid "
+                       "API account. Please make sure you set up a daily "
+                       "cap that is smaller than 500 or upgrade to a paid "
+                       "plan.")
+    # With the pre-filter, look further down the queue as the followers
+    # it is sure about do not need a Botometer call
+    limit = account_cap * LOOKAHEAD if prefilter else account_cap
+    followers_to_check = list(select_followers_to_check(
+        conn, user_name, days_to_keep, limit, prioritize))
+
+    # Estimate the obvious humans and bots locally
+    predicted = []
+    model = train_prefilter(conn) if prefilter else None
+    if model is not None:
+        predicted, followers_to_check = split_followers(
+            model, conn, followers_to_check)
+        now = datetime.now()
+        with CheckResultWriter(conn) as writer:
+            for user_id, screen_name, p in predicted:
+                writer.add("predicted", (p, now, screen_name))
+        logger.info(str(len(predicted)) + " followers were estimated by "
+                    "the pre-filter without a Botometer call.")
+    followers_to_check = followers_to_check[:account_cap]
+
+    # Check followers concurrently, sharing one rate limiter
+    logger.info("Starting to check " + str(len(followers_to_check)) +
+                " followers... This may take a while.")
+    bucket = TokenBucket(rate=rate_per_second,
+                         burst=max(1, int(rate_per_second)),
+                         quota=account_cap)
+    checked, completed = check_bots(conn, bom, followers_to_check, bucket,
+                                    workers=workers, progress=progress,
+                                    prefetch=prefetch)
+    cap_reached = completed and \
+        count_followers_to_check(conn, user_name, days_to_keep, 1) > 0
+    summary = {"due": N, "checked": checked,
+               "predicted": len(predicted), "cap_reached": cap_reached,
+               "rate_limited": not completed}
+
+    if not completed:
+        logger.error("Doh! Botometer API daily limit is reached. "
+                     "Please continue the next day. "
+                     "Don't worry, Followers that have "
+                     "been checked will not be lost.")
+    elif cap_reached:
+        logger.warning("You have reached the daily cap set. "
+                       "Please continue the next day if you are using the "
+                       "free plan. Ignore this message and re-run the app "
+                       "if you are on the paid plan.")
+    return summary
+
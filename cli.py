@@ -0,0 +1,262 @@
+"""
+Headless runner for retrieving followers and checking bots, e.g. from cron:
+
+    python cli.py account1 account2 --days-to-keep 180 --account-cap 480
+
+With --schedule the accounts share one daily Botometer budget, split by
+the priority given as account:priority and by how stale their data is:
+
+    python cli.py brand1:2 brand2 --schedule --daily-budget 2000
+
+Exit status: 0 all done, 1 an account failed, 2 bad arguments,
+3 the account cap was reached before every due follower was checked,
+4 the Botometer API rate limit stopped the run.
+"""
+import sys
+import json
+import logging
+import argparse
+from bot_checker import CREDENTIALS_FILE, retrieve_followers, run_bot_check
+from export import EXPORT_FORMATS, export_followers
+from scheduler import parse_target, run_schedule, run_daily
+from metrics import metrics
+from ratelimit import rate_limits
+from db import FOLLOWERS_DB, create_connection, get_follower_overlap
+from resources import Resources
+
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_CAP_REACHED = 3
+EXIT_RATE_LIMITED = 4
+
+logger = logging.getLogger("cli")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Retrieve the followers of Twitter accounts and check "
+                    "them for bots with Botometer.")
+    parser.add_argument("accounts", nargs="+",
+                        help="screen names of the target accounts, "
+                             "without '@', optionally followed by "
+                             "':priority' for --schedule")
+    parser.add_argument("--retrieve", action="store_true",
+                        help="retrieve followers (default: retrieve and "
+                             "check)")
+    parser.add_argument("--check", action="store_true",
+                        help="check followers for bots (default: retrieve "
+                             "and check)")
+    parser.add_argument("--export", action="store_true",
+                        help="export the followers table at the end")
+    parser.add_argument("--export-format", choices=list(EXPORT_FORMATS),
+                        default="csv", help="format of the export")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only export the followers added or rescored "
+                             "since the last incremental export")
+    parser.add_argument("--consumer", default="default",
+                        help="name of the downstream system the "
+                             "incremental export is for")
+    parser.add_argument("--columns",
+                        help="comma separated columns to export "
+                             "(default: all)")
+    parser.add_argument("--overlap", action="store_true",
+                        help="count the followers each account shares "
+                             "with the other accounts in the database")
+    parser.add_argument("--by-id", action="store_true",
+                        help="retrieve follower ids first and only look up "
+                             "new followers")
+    parser.add_argument("--days-to-keep", type=int, default=180,
+                        help="number of days before the bot data expires")
+    parser.add_argument("--account-cap", type=int, default=480,
+                        help="maximum number of accounts to check per "
+                             "target account")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of concurrent Botometer requests")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="Botometer requests allowed per second")
+    parser.add_argument("--table-order", action="store_true",
+                        help="check never checked followers in table order "
+                             "then the oldest checks, instead of the most "
+                             "suspicious and most stale followers first")
+    parser.add_argument("--prefilter", action="store_true",
+                        help="only send to Botometer the followers a local "
+                             "model trained on the followers already "
+                             "checked is unsure about (needs numpy)")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="number of concurrent Twitter fetches running "
+                             "ahead of the Botometer requests, 0 to turn "
+                             "prefetching off")
+    parser.add_argument("--schedule", action="store_true",
+                        help="check all the accounts together within "
+                             "--daily-budget, deduplicating shared "
+                             "followers")
+    parser.add_argument("--daily-budget", type=int, default=480,
+                        help="Botometer calls per day for all the accounts "
+                             "with --schedule")
+    parser.add_argument("--daemon", action="store_true",
+                        help="with --schedule, keep running and continue "
+                             "each day")
+    parser.add_argument("--backend", choices=["live", "simulated"],
+                        default="live",
+                        help="'simulated' runs offline against simulated "
+                             "Twitter and Botometer APIs, for load tests")
+    parser.add_argument("--sim-followers", type=int, default=10000,
+                        help="followers per account with the simulated "
+                             "backend")
+    parser.add_argument("--sim-latency", type=float, default=0.5,
+                        help="seconds per Botometer call with the simulated "
+                             "backend")
+    parser.add_argument("--sim-twitter-latency", type=float, default=0.5,
+                        help="seconds to fetch the Twitter data of an "
+                             "account with the simulated backend")
+    parser.add_argument("--credentials", default=CREDENTIALS_FILE,
+                        help="path to the credentials json file")
+    parser.add_argument("--metrics-file",
+                        help="write stage timings, rates, quota left and "
+                             "ETA to this file in the Prometheus text "
+                             "format every few seconds")
+    parser.add_argument("--json", action="store_true",
+                        help="print a json summary of each account to "
+                             "stdout")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="also log the followers skipped")
+    args = parser.parse_args(argv)
+    if not args.retrieve and not args.check:
+        args.retrieve = args.check = True
+    try:
+        args.targets = [parse_target(a) for a in args.accounts]
+    except ValueError:
+        parser.error("priority must be a number, e.g. account:2")
+    args.source = args.scorer = None
+    if args.backend == "simulated":
+        from backends import SimulatedSource, SimulatedBotometer
+        args.source = SimulatedSource(n_followers=args.sim_followers)
+        args.scorer = SimulatedBotometer(
+            latency=args.sim_latency, latency_jitter=args.sim_latency / 2,
+            twitter_latency=args.sim_twitter_latency)
+    return args
+
+
+def run_account(user_name, args):
+    """
+    Run the requested steps for one target account
+    :param user_name: the screen_name of the target account
+    :param args: parsed command line arguments
+    :return: dict summarising the run, with its exit status
+    """
+    summary = {"account": user_name, "status": EXIT_OK}
+    try:
+        if args.retrieve:
+            summary["retrieved"] = retrieve_followers(
+                user_name, args.by_id, args.credentials,
+                source=args.source)
+        if args.check and not args.schedule:
+            summary.update(run_bot_check(
+                user_name, args.days_to_keep, args.account_cap,
+                args.workers, args.rate, args.credentials,
+                scorer=args.scorer, prefetch=args.prefetch,
+                prioritize=not args.table_order,
+                prefilter=args.prefilter))
+            summary["rate_limits"] = rate_limits.state()
+            if summary["rate_limited"]:
+                summary["status"] = EXIT_RATE_LIMITED
+            elif summary["cap_reached"]:
+                summary["status"] = EXIT_CAP_REACHED
+        if args.export:
+            summary["export"] = export_followers(
+                user_name, args.export_format,
+                args.columns.split(",") if args.columns else None,
+                incremental=args.incremental, consumer=args.consumer)
+        if args.overlap:
+            summary["overlap"] = dict(get_follower_overlap(
+                create_connection(FOLLOWERS_DB), user_name))
+    except Exception as e:
+        logger.exception("Failed to process " + user_name)
+        summary["status"] = EXIT_FAILED
+        summary["error"] = str(e)
+    return summary
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if not args.verbose:
+        # the per follower skip messages are only shown with --verbose
+        logging.getLogger("bot_checker").addFilter(
+            lambda record: getattr(record, "status", None) != "text")
+
+    metrics.path = args.metrics_file
+
+    # the accounts share the database connections and API clients
+    with Resources():
+        return run_targets(args)
+
+
+def run_targets(args):
+    """
+    Run the steps chosen on the command line for all the target accounts
+    :param args: parsed arguments
+    :return: exit status
+    """
+    status = EXIT_OK
+    per_account = args.retrieve or args.export or args.overlap \
+        or not args.schedule
+    for user_name, _ in args.targets if per_account else []:
+        summary = run_account(user_name, args)
+        if args.json:
+            print(json.dumps(summary), flush=True)
+        # report the most serious status of all the accounts
+        if summary["status"] == EXIT_FAILED or status == EXIT_FAILED:
+            status = EXIT_FAILED
+        else:
+            status = max(status, summary["status"])
+        if summary["status"] == EXIT_RATE_LIMITED:
+            logger.error("Botometer rate limit reached, skipping the "
+                         "remaining accounts.")
+            return status
+
+    if args.check and args.schedule:
+        schedule_args = (args.targets, args.daily_budget, args.days_to_keep)
+        schedule_kwargs = {"workers": args.workers,
+                           "rate_per_second": args.rate,
+                           "credentials_file": args.credentials,
+                           "scorer": args.scorer,
+                           "prefetch": args.prefetch,
+                           "prioritize": not args.table_order,
+                           "prefilter": args.prefilter}
+        if args.daemon:
+            try:
+                run_daily(*schedule_args, **schedule_kwargs)
+            except KeyboardInterrupt:
+                # the way to stop the daemon, it only returns when stopped
+                logger.info("Scheduler stopped.")
+                return status
+            except Exception:
+                logger.exception("Failed to run the schedule")
+                return EXIT_FAILED
+        try:
+            summary = run_schedule(*schedule_args, **schedule_kwargs)
+        except Exception as e:
+            logger.exception("Failed to run the schedule")
+            summary = {"status": EXIT_FAILED, "error": str(e)}
+            status = EXIT_FAILED
+        else:
+            if summary["rate_limited"]:
+                summary["status"] = EXIT_RATE_LIMITED
+            elif summary["budget_left"] == 0:
+                summary["status"] = EXIT_CAP_REACHED
+            else:
+                summary["status"] = EXIT_OK
+            if status != EXIT_FAILED:
+                status = max(status, summary["status"])
+        if args.json:
+            print(json.dumps(summary), flush=True)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
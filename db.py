@@ -0,0 +1,1171 @@
+import os
+import glob
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+from metrics import metrics
+from resources import current_resources
+
+
+logger = logging.getLogger(__name__)
+
+# Botometer scores, in the order of a check_bot() result tuple
+SCORE_COLUMNS = [
+    "en_cap", "en_astroturf", "en_fake_follower", "en_financial",
+    "en_other", "en_overall", "en_self_declared", "en_spammer",
+    "un_cap", "un_astroturf", "un_fake_follower", "un_financial",
+    "un_other", "un_overall", "un_self_declared", "un_spammer"
+]
+
+# overall scores also kept in the followers table, with their index in a
+# check_bot() result tuple
+OVERALL_COLUMNS = ["en_overall", "un_overall"]
+OVERALL_INDEXES = [SCORE_COLUMNS.index(c) for c in OVERALL_COLUMNS]
+
+# convert a datetime bound as an ISO string to seconds since 1970 in SQL,
+# reading it as UTC like the SQLite date functions
+SQL_EPOCH = "ROUND((julianday(?) - 2440587.5) * 86400.0, 3)"
+
+
+# profile fields that can change between two retrievals, in the order of
+# a follower tuple after the id
+PROFILE_COLUMNS = [
+    "screen_name", "name", "description", "followers_count",
+    "friends_count", "listed_count", "favourites_count"
+]
+
+# one database for the followers of all the target accounts
+FOLLOWERS_DB = "temp/followers.db"
+
+# file name ending of the per account databases of older versions of the
+# app, merged into FOLLOWERS_DB
+ACCOUNT_DB_SUFFIX = "_followers.db"
+
+# screen_name given up by a follower to the account that took it after it
+# was renamed, until the follower is saved again with its new one. "#" is
+# not allowed in screen names.
+SQL_RENAMED = "'#' || id"
+SQL_NOT_RENAMED = "screen_name NOT LIKE '#%'"
+
+
+def create_connection(db_file):
+    """
+    Create a database connection to the SQLite database
+    specified by db_file. Create the database if not exist.
+    While a Resources is in use, the connection of the current thread, or
+    of the browser session in the app, is reused instead, and closed with
+    the Resources.
+    :param db_file: database file
+    :return: Connection object or None
+    """
+    resources = current_resources()
+    if resources is not None:
+        return resources.connection(db_file, open_connection)
+    return open_connection(db_file)
+
+
+def open_connection(db_file):
+    """
+    Open a new connection to the SQLite database specified by db_file
+    :param db_file: database file
+    :return: Connection object or None
+    """
+    conn = None
+    try:
+        # the connection is only used by one thread at a time, but may be
+        # closed by another one
+        conn = sqlite3.connect(db_file, check_same_thread=False)
+        # WAL lets readers and the writer work at the same time and only
+        # fsyncs on checkpoints, NORMAL is safe with WAL
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-65536")  # 64 MB
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+    except sqlite3.Error as e:
+        logger.error(e)
+
+    return conn
+
+
+def create_table(conn, create_table_sql):
+    """
+    Create a table from the create_table_sql statement
+    :param conn: Connection object
+    :param create_table_sql: a CREATE TABLE statement
+    :return:
+    """
+    try:
+        c = conn.cursor()
+        c.execute(create_table_sql)
+    except sqlite3.Error as e:
+        logger.error(e)
+
+
+def add_missing_column(conn, table, column_def):
+    """
+    Add a column to a table created by an older version of the app
+    :param conn: Connection object
+    :param table: name of the table
+    :param column_def: column name followed by its type
+    :return: True if the column was added
+    """
+    column = column_def.split()[0]
+    columns = [row[1] for row in
+               conn.execute("PRAGMA table_info(" + table + ")")]
+    if column not in columns:
+        create_table(conn, "ALTER TABLE " + table + " ADD COLUMN " +
+                     column_def)
+        return True
+    return False
+
+
+def replace_view(conn, name, create_view_sql):
+    """
+    Create a view, or recreate it if its statement has changed since it
+    was created, e.g. by an older version of the app. An unchanged view is
+    not written, as a schema change takes the write lock.
+    :param conn: Connection object
+    :param name: name of the view
+    :param create_view_sql: its CREATE VIEW statement
+    :return:
+    """
+    row = conn.execute("SELECT sql FROM sqlite_master "
+                       "WHERE type = 'view' AND name = ?", (name,)).fetchone()
+    # SQLite keeps the statement without the final semicolon
+    if row is not None and row[0].split() == \
+            create_view_sql.strip().rstrip(";").split():
+        return
+    create_table(conn, "DROP VIEW IF EXISTS " + name)
+    create_table(conn, create_view_sql)
+
+
+def create_new_followers_table(database=FOLLOWERS_DB):
+    """
+    Create the followers tables in the database if not exist, and merge
+    the per account databases of older versions of the app found next to
+    it.
+    :param database: Path to the cached database
+    :return:
+    """
+    # create a database connection
+    conn = create_connection(database)
+    if conn is None:
+        logger.error("Error! cannot create the database connection.")
+        return
+    create_followers_schema(conn)
+    for path in sorted(glob.glob(os.path.join(
+            os.path.dirname(database), "*" + ACCOUNT_DB_SUFFIX))):
+        try:
+            merge_account_db(conn, path)
+        except sqlite3.DatabaseError as e:
+            if "locked" in str(e):
+                # in use by another process, merged on a later call
+                logger.warning("Cannot merge " + path + " now: " + str(e))
+                continue
+            # set aside so it is not merged again on every call
+            logger.error("Cannot merge " + path + ", renamed with a "
+                         ".failed ending: " + str(e))
+            os.replace(path, path + ".failed")
+
+
+def create_followers_schema(conn):
+    """
+    Create the tables, indexes, triggers and views of the followers
+    database, upgrading the ones created by an older version of the app.
+    The followers table holds one row per Twitter account, whatever the
+    number of target accounts it follows.
+    screen_name is set to be unique.
+    :param conn: Connection object
+    :return:
+    """
+    sql_create_followers_table = """ CREATE TABLE IF NOT EXISTS followers (
+                                        id integer PRIMARY KEY,
+                                        screen_name text NOT NULL,
+                                        name text,
+                                        description text,
+                                        followers_count int,
+                                        friends_count int,
+                                        listed_count int,
+                                        favourites_count int,
+                                        created_at DATETIME,
+                                        last_check_date DATETIME,
+                                        last_check_status text,
+                                        change_seq integer,
+                                        prefilter_score REAL,
+                                        en_overall REAL,
+                                        un_overall REAL,
+                                        UNIQUE(screen_name)
+                                    ); """
+    sql_create_crawl_runs_table = """ CREATE TABLE IF NOT EXISTS crawl_runs (
+                                        id integer PRIMARY KEY,
+                                        target text NOT NULL,
+                                        started_at DATETIME,
+                                        updated_at DATETIME,
+                                        finished_at DATETIME,
+                                        mode text,
+                                        next_cursor integer,
+                                        pages_fetched int DEFAULT 0,
+                                        followers_fetched int DEFAULT 0,
+                                        status text,
+                                        new_followers int,
+                                        lost_followers int,
+                                        returned_followers int,
+                                        updated_profiles int DEFAULT 0
+                                    ); """
+    sql_create_check_index = """ CREATE INDEX IF NOT EXISTS
+                                    followers_last_check
+                                    ON followers(last_check_status,
+                                                 last_check_date); """
+    sql_create_watermarks_table = """ CREATE TABLE IF NOT EXISTS
+                                        export_watermarks (
+                                            name text PRIMARY KEY,
+                                            change_seq integer,
+                                            exported_at DATETIME
+                                        ); """
+    # every insert or update stamps the row with the next change number
+    sql_create_change_index = """ CREATE INDEX IF NOT EXISTS
+                                    followers_change_seq
+                                    ON followers(change_seq); """
+    sql_create_insert_trigger = """ CREATE TRIGGER IF NOT EXISTS
+                                      followers_insert_seq
+                                      AFTER INSERT ON followers
+                                      BEGIN
+                                        UPDATE followers SET change_seq =
+                                          (SELECT IFNULL(MAX(change_seq), 0)
+                                           + 1 FROM followers)
+                                        WHERE id = NEW.id;
+                                      END; """
+    sql_create_update_trigger = """ CREATE TRIGGER IF NOT EXISTS
+                                      followers_update_seq
+                                      AFTER UPDATE ON followers
+                                      WHEN NEW.change_seq IS OLD.change_seq
+                                      BEGIN
+                                        UPDATE followers SET change_seq =
+                                          (SELECT IFNULL(MAX(change_seq), 0)
+                                           + 1 FROM followers)
+                                        WHERE id = NEW.id;
+                                      END; """
+    # every score of every check, newest per follower found by the primary
+    # key, so rescoring appends a narrow row instead of rewriting the
+    # profile
+    sql_create_score_history_table = """ CREATE TABLE IF NOT EXISTS
+                                          score_history (
+                                            user_id integer NOT NULL,
+                                            checked_at REAL NOT NULL,
+                                            """ + ",\n".join(
+        c + " REAL" for c in SCORE_COLUMNS) + """,
+                                            PRIMARY KEY (user_id, checked_at)
+                                          ) WITHOUT ROWID; """
+    sql_create_latest_scores_view = """ CREATE VIEW IF NOT EXISTS
+                                         latest_scores AS
+                                         SELECT * FROM score_history h
+                                         WHERE checked_at =
+                                           (SELECT MAX(checked_at)
+                                            FROM score_history
+                                            WHERE user_id = h.user_id); """
+    # the followers with their latest scores, in the layout of the old
+    # wide followers table
+    sql_create_followers_scores_view = """ CREATE VIEW
+                                            followers_scores AS
+                                            SELECT f.id, f.screen_name,
+                                              f.name, f.description,
+                                              f.followers_count,
+                                              f.friends_count,
+                                              f.listed_count,
+                                              f.favourites_count,
+                                              f.created_at, """ + ", ".join(
+        "h." + c for c in SCORE_COLUMNS) + """,
+                                              f.last_check_date,
+                                              f.last_check_status,
+                                              f.prefilter_score,
+                                              f.change_seq
+                                            FROM followers f
+                                            LEFT JOIN score_history h
+                                            ON h.user_id = f.id
+                                            AND h.checked_at =
+                                              (SELECT MAX(checked_at)
+                                               FROM score_history
+                                               WHERE user_id = f.id); """
+    # which target accounts each follower follows, read by target for the
+    # followers of an account and by follower for the accounts it follows
+    sql_create_target_followers_table = """ CREATE TABLE IF NOT EXISTS
+                                             target_followers (
+                                               target text NOT NULL,
+                                               follower_id integer NOT NULL,
+                                               first_seen DATETIME,
+                                               PRIMARY KEY (target,
+                                                            follower_id)
+                                             ) WITHOUT ROWID; """
+    sql_create_follower_targets_index = """ CREATE INDEX IF NOT EXISTS
+                                             follower_targets
+                                             ON target_followers(follower_id,
+                                                                 target); """
+    # a new target of a known follower counts as a change of the follower
+    # for the incremental export
+    sql_create_target_insert_trigger = """ CREATE TRIGGER IF NOT EXISTS
+                                            target_followers_insert_seq
+                                            AFTER INSERT ON target_followers
+                                            BEGIN
+                                              UPDATE followers
+                                              SET change_seq = change_seq
+                                              WHERE id = NEW.follower_id;
+                                            END; """
+
+    # latest overall scores, copied from score_history so the results of
+    # a check status can be sorted and filtered by score through an index,
+    # like by check date with followers_last_check. Every bot check writes
+    # these indexes, so there are none for the other sorts.
+    sql_create_sort_indexes = [
+        "CREATE INDEX IF NOT EXISTS followers_status_" + c +
+        " ON followers(last_check_status, " + c + ")"
+        for c in OVERALL_COLUMNS]
+    # created by an earlier version of the results browser
+    sql_drop_sort_indexes = [
+        "DROP INDEX IF EXISTS followers_" + c
+        for c in OVERALL_COLUMNS + ["last_check_date"]]
+    # aggregates of the results of each account, valid as long as the
+    # followers do not change
+    sql_create_aggregate_cache_table = """ CREATE TABLE IF NOT EXISTS
+                                            aggregate_cache (
+                                              target text NOT NULL,
+                                              name text NOT NULL,
+                                              change_seq integer,
+                                              value text,
+                                              PRIMARY KEY (target, name)
+                                            ); """
+    # change_seq of the last change of the followers of each target
+    # account, so the aggregates of an account are only computed again
+    # when its own followers change
+    sql_create_target_versions_table = """ CREATE TABLE IF NOT EXISTS
+                                            target_versions (
+                                              target text PRIMARY KEY,
+                                              change_seq integer
+                                            ); """
+    sql_create_target_versions_trigger = """ CREATE TRIGGER IF NOT EXISTS
+                                              followers_target_versions
+                                              AFTER UPDATE OF change_seq
+                                              ON followers
+                                              WHEN NEW.change_seq IS NOT
+                                                OLD.change_seq
+                                              BEGIN
+                                                INSERT OR REPLACE INTO
+                                                target_versions
+                                                SELECT target,
+                                                  NEW.change_seq
+                                                FROM target_followers
+                                                WHERE follower_id = NEW.id;
+                                              END; """
+    # ids fetched by each follower retrieval run, diffed with the stored
+    # followers of the target once the run has fetched them all
+    sql_create_crawl_ids_table = """ CREATE TABLE IF NOT EXISTS crawl_ids (
+                                        run_id integer NOT NULL,
+                                        follower_id integer NOT NULL,
+                                        PRIMARY KEY (run_id, follower_id)
+                                    ) WITHOUT ROWID; """
+    # a follower leaving or coming back counts as a change for the
+    # incremental export
+    sql_create_target_departed_trigger = """ CREATE TRIGGER IF NOT EXISTS
+                                              target_followers_departed_seq
+                                              AFTER UPDATE OF departed_at
+                                              ON target_followers
+                                              BEGIN
+                                                UPDATE followers
+                                                SET change_seq = change_seq
+                                                WHERE id = NEW.follower_id;
+                                              END; """
+
+    # create projects table
+    create_table(conn, sql_create_followers_table)
+    # create table for the follower retrieval checkpoints
+    create_table(conn, sql_create_crawl_runs_table)
+    # index used to select the followers due for a bot check
+    create_table(conn, sql_create_check_index)
+    # change tracking used by the incremental export
+    if add_missing_column(conn, "followers", "change_seq integer"):
+        # rows saved before change tracking count as the first change
+        with conn:
+            conn.execute("UPDATE followers SET change_seq = 1")
+    create_table(conn, sql_create_watermarks_table)
+    create_table(conn, sql_create_change_index)
+    create_table(conn, sql_create_insert_trigger)
+    create_table(conn, sql_create_update_trigger)
+    # scores are kept apart from the profiles
+    create_table(conn, sql_create_score_history_table)
+    move_scores_to_history(conn)
+    create_table(conn, sql_create_latest_scores_view)
+    # bot probability estimated by the local pre-filter
+    add_missing_column(conn, "followers", "prefilter_score REAL")
+    # recreated if its columns have changed since it was created
+    replace_view(conn, "followers_scores", sql_create_followers_scores_view)
+    # followers of each target account
+    create_table(conn, sql_create_target_followers_table)
+    create_table(conn, sql_create_follower_targets_index)
+    create_table(conn, sql_create_target_insert_trigger)
+    # churn between follower retrievals
+    add_missing_column(conn, "target_followers", "departed_at DATETIME")
+    create_table(conn, sql_create_target_departed_trigger)
+    create_table(conn, sql_create_crawl_ids_table)
+    for column in ("new_followers int", "lost_followers int",
+                   "returned_followers int", "updated_profiles int DEFAULT 0"):
+        add_missing_column(conn, "crawl_runs", column)
+    # scores of the results viewer
+    if add_missing_column(conn, "followers", "en_overall REAL"):
+        add_missing_column(conn, "followers", "un_overall REAL")
+        copy_overall_scores(conn, sql_create_update_trigger)
+    for sql in sql_drop_sort_indexes + sql_create_sort_indexes:
+        create_table(conn, sql)
+    create_table(conn, sql_create_aggregate_cache_table)
+    versions_exist = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+        "AND name = 'target_versions'").fetchone()
+    create_table(conn, sql_create_target_versions_table)
+    if not versions_exist:
+        with conn:
+            conn.execute(""" INSERT OR IGNORE INTO target_versions
+                             SELECT t.target, MAX(f.change_seq)
+                             FROM target_followers t JOIN followers f
+                             ON f.id = t.follower_id GROUP BY t.target""")
+    create_table(conn, sql_create_target_versions_trigger)
+
+
+def move_scores_to_history(conn):
+    """
+    Move the scores of a followers table created by an older version of
+    the app, which stored them in the profile rows, to score_history
+    :param conn: Connection object
+    :return: True if the scores were moved
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(followers)")]
+    if SCORE_COLUMNS[0] not in columns:
+        return False
+    logger.info("Moving the bot scores to the score history table...")
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO score_history SELECT id, " +
+                     SQL_EPOCH.replace("?", "last_check_date") + ", " +
+                     ", ".join(SCORE_COLUMNS) + " FROM followers "
+                     "WHERE en_cap IS NOT NULL "
+                     "AND last_check_date IS NOT NULL")
+    try:
+        for column in SCORE_COLUMNS:
+            conn.execute("ALTER TABLE followers DROP COLUMN " + column)
+    except sqlite3.Error as e:
+        # SQLite before 3.35 cannot drop columns, the old ones are then
+        # left unused
+        logger.warning("Cannot drop the old score columns: " + str(e))
+    return True
+
+
+def copy_overall_scores(conn, sql_create_update_trigger):
+    """
+    Fill the overall score columns of the followers added by an older
+    version of the app from their latest score_history row, without
+    counting it as a change for the incremental export
+    :param conn: Connection object
+    :param sql_create_update_trigger: statement recreating the trigger
+    that stamps updated rows with a change number
+    :return:
+    """
+    with conn:
+        conn.execute("DROP TRIGGER IF EXISTS followers_update_seq")
+        conn.execute(""" UPDATE followers
+                         SET (""" + ", ".join(OVERALL_COLUMNS) + """) =
+                           (SELECT """ + ", ".join(OVERALL_COLUMNS) + """
+                            FROM score_history
+                            WHERE user_id = followers.id
+                            ORDER BY checked_at DESC LIMIT 1)
+                         WHERE last_check_status = "success" """)
+        conn.execute(sql_create_update_trigger)
+
+
+def is_followers_db(path):
+    """
+    :param path: path to a file
+    :return: True if the file is a SQLite database with a followers table
+    """
+    try:
+        conn = sqlite3.connect("file:" + path + "?mode=ro", uri=True)
+        try:
+            return conn.execute("SELECT 1 FROM sqlite_master "
+                                "WHERE type = 'table' AND name = 'followers'"
+                                ).fetchone() is not None
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        return False
+
+
+def merge_account_db(conn, path):
+    """
+    Merge the per account database of an older version of the app into
+    the followers database, then rename it with a .merged ending so it is
+    only merged once. Followers are matched by screen_name, as the rows
+    saved before the Twitter id was stored have made up ids. Profiles
+    already in the followers database are kept, the most recent check of
+    each follower wins. Incremental exports start over, the watermarks of
+    the old database are not merged.
+    :param conn: Connection object of the followers database
+    :param path: path to the per account database, named
+    <target>_followers.db
+    :return: True if the database was merged
+    """
+    target = os.path.basename(path)[:-len(ACCOUNT_DB_SUFFIX)]
+    logger.info("Merging the database of " + target + " into the followers "
+                "database...")
+    # bring the old database to the current layout first
+    old = open_connection(path)
+    if old is None:
+        return False
+    try:
+        # versions before the id-first retrieval let SQLite choose the ids
+        twitter_ids = "mode" in [row[1] for row in
+                                 old.execute("PRAGMA table_info(crawl_runs)")]
+        create_followers_schema(old)
+    finally:
+        old.close()
+
+    profile_columns = [
+        "screen_name", "name", "description", "followers_count",
+        "friends_count", "listed_count", "favourites_count", "created_at",
+        "last_check_date", "last_check_status", "prefilter_score"] + \
+        OVERALL_COLUMNS
+    matched = """ FROM old.followers o
+                  JOIN merged_ids m ON m.old_id = o.id
+                  JOIN main.followers f ON f.id = m.new_id"""
+    conn.execute("ATTACH DATABASE ? AS old", (path,))
+    try:
+        with conn:
+            # id of each old row in the followers database: the id of the
+            # follower saved under the same screen_name, its own id if it is
+            # a Twitter id not taken yet, otherwise a negative one, which no
+            # Twitter account has, until the follower is saved again
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS merged_ids "
+                         "(old_id integer PRIMARY KEY, new_id integer)")
+            conn.execute("DELETE FROM merged_ids")
+            conn.execute(""" INSERT INTO merged_ids
+                             SELECT o.id, f.id FROM old.followers o
+                             JOIN main.followers f
+                             ON f.screen_name = o.screen_name""")
+            if twitter_ids:
+                conn.execute(""" INSERT OR IGNORE INTO merged_ids
+                                 SELECT id, id FROM old.followers o
+                                 WHERE NOT EXISTS (SELECT 1
+                                                   FROM main.followers
+                                                   WHERE id = o.id)""")
+            conn.execute(""" INSERT OR IGNORE INTO merged_ids
+                             SELECT id, (SELECT MIN(0, IFNULL(MIN(id), 0))
+                                         FROM main.followers) - id
+                             FROM old.followers""")
+            conn.execute("INSERT OR IGNORE INTO main.followers(id, " +
+                         ", ".join(profile_columns) + ") SELECT m.new_id, " +
+                         ", ".join("o." + c for c in profile_columns) +
+                         """ FROM old.followers o
+                             JOIN merged_ids m ON m.old_id = o.id""")
+            # the most recent check wins for the followers already saved
+            newer = conn.execute(
+                """ SELECT o.last_check_date, o.last_check_status,
+                           o.prefilter_score, """ +
+                ", ".join("o." + c for c in OVERALL_COLUMNS) +
+                ", f.id" + matched + """
+                    WHERE o.last_check_status IS NOT NULL
+                    AND (f.last_check_status IS NULL
+                         OR o.last_check_date > f.last_check_date)"""
+            ).fetchall()
+            conn.executemany(""" UPDATE main.followers
+                                 SET last_check_date = ?,
+                                     last_check_status = ?,
+                                     prefilter_score = ?,
+                                     en_overall = ?,
+                                     un_overall = ?
+                                 WHERE id = ?""", newer)
+            conn.execute("INSERT OR IGNORE INTO main.score_history("
+                         "user_id, checked_at, " + ", ".join(SCORE_COLUMNS) +
+                         ") SELECT f.id, h.checked_at, " +
+                         ", ".join("h." + c for c in SCORE_COLUMNS) +
+                         matched + " JOIN old.score_history h "
+                         "ON h.user_id = o.id")
+            conn.execute("INSERT OR IGNORE INTO main.target_followers("
+                         "target, follower_id, first_seen) "
+                         "SELECT ?, f.id, ?" + matched,
+                         (target, datetime.now()))
+            crawl_columns = """ target, started_at, updated_at, finished_at,
+                                mode, next_cursor, pages_fetched,
+                                followers_fetched, status"""
+            conn.execute("INSERT INTO main.crawl_runs(" + crawl_columns +
+                         ") SELECT " + crawl_columns + " FROM old.crawl_runs")
+    finally:
+        conn.execute("DETACH DATABASE old")
+    os.replace(path, path + ".merged")
+    return True
+
+
+def create_followers(conn, followers, user_name=None):
+    """
+    Create new followers into the followers table in one batch, update
+    the profiles that changed since they were saved, and link them to the
+    target account. Unchanged profiles are not written.
+    id is the Twitter user id. Rows merged from the databases of older
+    versions without their Twitter id get it when the same screen_name is
+    saved again. Any other row holding the screen_name of a follower
+    belongs to an account renamed since: it gives the screen_name up and
+    keeps its data until its own account is saved again.
+    The caller is responsible for committing.
+    :param conn:
+    :param followers: list of follower tuples
+    :param user_name: the screen_name of the target account they follow
+    :return: number of existing profiles updated
+    """
+    if conn.execute("SELECT 1 FROM followers WHERE id < 0 "
+                    "LIMIT 1").fetchone() is not None:
+        set_merged_ids(conn, followers)
+    conn.executemany(""" UPDATE followers SET screen_name = """ +
+                     SQL_RENAMED + """
+                         WHERE screen_name = ? AND id != ?""",
+                     [(f[1], f[0]) for f in followers])
+
+    sql = """ UPDATE OR IGNORE followers
+              SET """ + ", ".join(c + " = ?" for c in PROFILE_COLUMNS) + """
+              WHERE id = ?
+              AND (""" + ", ".join(PROFILE_COLUMNS) + """) IS NOT
+                  (""" + ", ".join("?" * len(PROFILE_COLUMNS)) + ")"
+    cur = conn.cursor()
+    cur.executemany(sql, [f[1:8] + f[:1] + f[1:8] for f in followers])
+    updated = max(cur.rowcount, 0)
+
+    sql = """ INSERT OR IGNORE INTO followers(
+                id,
+                screen_name,
+                name,
+                description,
+                followers_count,
+                friends_count,
+                listed_count,
+                favourites_count,
+                created_at)
+                VALUES(?,?,?,?,?,?,?,?,?)
+              """
+    cur.executemany(sql, followers)
+    if user_name is not None:
+        link_followers(conn, user_name, [f[0] for f in followers])
+    return updated
+
+
+def set_merged_ids(conn, followers):
+    """
+    Give their Twitter id to the rows merged without it from the databases
+    of older versions of the app, whose screen_name is saved again. Their
+    scores and target accounts move with them.
+    The caller is responsible for committing.
+    :param conn: Connection object
+    :param followers: list of follower tuples
+    :return:
+    """
+    ids = {f[1]: f[0] for f in followers}
+    names = list(ids)
+    merged = []
+    # in chunks, below the limit of SQLite on the number of parameters
+    for i in range(0, len(names), 500):
+        chunk = names[i:i + 500]
+        merged.extend(conn.execute(
+            "SELECT id, screen_name FROM followers WHERE id < 0 "
+            "AND screen_name IN (" + ",".join("?" * len(chunk)) + ")",
+            chunk))
+    for old_id, screen_name in merged:
+        new_id = ids[screen_name]
+        if conn.execute("SELECT 1 FROM followers WHERE id = ?",
+                        (new_id,)).fetchone() is not None:
+            # already saved under its Twitter id, the merged row gives its
+            # screen_name up like a renamed account
+            continue
+        conn.execute("UPDATE followers SET id = ? WHERE id = ?",
+                     (new_id, old_id))
+        conn.execute("UPDATE OR IGNORE score_history SET user_id = ? "
+                     "WHERE user_id = ?", (new_id, old_id))
+        conn.execute("UPDATE OR IGNORE target_followers SET follower_id = ? "
+                     "WHERE follower_id = ?", (new_id, old_id))
+
+
+def link_followers(conn, user_name, ids):
+    """
+    Record that followers follow a target account.
+    The caller is responsible for committing.
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param ids: list of Twitter user ids of its followers
+    :return:
+    """
+    now = datetime.now()
+    conn.executemany(""" INSERT OR IGNORE INTO target_followers(
+                             target, follower_id, first_seen)
+                         VALUES(?,?,?)""",
+                     [(user_name, i, now) for i in ids])
+
+
+def get_new_follower_ids(conn, ids):
+    """
+    Find the ids that are not in the followers table yet, whichever target
+    account they were retrieved for
+    :param conn: Connection object
+    :param ids: list of Twitter user ids
+    :return: list of ids not seen before, in the original order
+    """
+    # commit so the next call sees the pages saved in the meantime
+    with conn:
+        cur = conn.cursor()
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS fetched_ids "
+                    "(id integer PRIMARY KEY)")
+        cur.execute("DELETE FROM fetched_ids")
+        cur.executemany("INSERT OR IGNORE INTO fetched_ids VALUES(?)",
+                        [(i,) for i in ids])
+        cur.execute(""" SELECT f.id FROM fetched_ids f
+                        WHERE NOT EXISTS (SELECT 1 FROM followers
+                                          WHERE id = f.id)""")
+        new_ids = {row[0] for row in cur.fetchall()}
+    return [i for i in ids if i in new_ids]
+
+
+def get_crawl_checkpoint(conn, user_name, mode="profiles"):
+    """
+    Find the last unfinished follower retrieval run
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param mode: "profiles" or "ids", cursors of the two modes are not
+    interchangeable
+    :return: (run id, next_cursor) or None if there is nothing to resume
+    """
+    cur = conn.cursor()
+    cur.execute(""" SELECT id, next_cursor FROM crawl_runs
+                    WHERE target = ? AND mode = ? AND status = "running"
+                    ORDER BY id DESC LIMIT 1""", (user_name, mode))
+    return cur.fetchone()
+
+
+def start_crawl_run(conn, user_name, mode="profiles"):
+    """
+    Record the start of a new follower retrieval run
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param mode: "profiles" or "ids"
+    :return: id of the run
+    """
+    now = datetime.now()
+    with conn:
+        cur = conn.cursor()
+        cur.execute(""" INSERT INTO crawl_runs(target, started_at,
+                            updated_at, mode, next_cursor, status)
+                        VALUES(?,?,?,?,-1,"running")""",
+                    (user_name, now, now, mode))
+    return cur.lastrowid
+
+
+def save_crawl_checkpoint(conn, run_id, next_cursor, n_followers,
+                          n_updated=0):
+    """
+    Store the Tweepy cursor of the next page. Called inside the same
+    transaction as the page insert so the checkpoint never gets ahead of
+    the data. A next_cursor of 0 means the last page has been fetched.
+    :param conn: Connection object
+    :param run_id: id of the run
+    :param next_cursor: cursor of the next page
+    :param n_followers: number of followers in the page just saved
+    :param n_updated: number of existing profiles the page updated
+    :return:
+    """
+    now = datetime.now()
+    status = "finished" if next_cursor == 0 else "running"
+    cur = conn.cursor()
+    cur.execute(""" UPDATE crawl_runs
+                    SET next_cursor = ?,
+                        updated_at = ?,
+                        finished_at = CASE WHEN ? = "finished"
+                                      THEN ? END,
+                        pages_fetched = pages_fetched + 1,
+                        followers_fetched = followers_fetched + ?,
+                        updated_profiles = IFNULL(updated_profiles, 0) + ?,
+                        status = ?
+                    WHERE id = ?""",
+                (next_cursor, now, status, now, n_followers, n_updated,
+                 status, run_id))
+
+
+def stage_crawl_ids(conn, run_id, ids):
+    """
+    Record the follower ids fetched by a retrieval run, to be diffed with
+    the stored followers once the run is finished.
+    The caller is responsible for committing.
+    :param conn: Connection object
+    :param run_id: id of the run
+    :param ids: list of Twitter user ids
+    :return:
+    """
+    conn.executemany("INSERT OR IGNORE INTO crawl_ids VALUES(?, ?)",
+                     [(run_id, i) for i in ids])
+
+
+def diff_crawl(conn, run_id, user_name):
+    """
+    Compare the followers fetched by a finished retrieval run with the
+    stored followers of the account: the ones not fetched are marked as
+    departed, the departed ones fetched again are marked as back. Both
+    sets are found by walking the primary keys of target_followers and
+    crawl_ids, and only the followers that changed are written. The churn
+    is recorded in the run.
+    :param conn: Connection object
+    :param run_id: id of the finished run
+    :param user_name: the screen_name of the target account
+    :return: dict with new, lost, returned and updated counts
+    """
+    now = datetime.now()
+    fetched = """ SELECT 1 FROM crawl_ids
+                  WHERE run_id = ?
+                  AND follower_id = target_followers.follower_id"""
+    with conn:
+        run = conn.execute("SELECT started_at, updated_profiles "
+                           "FROM crawl_runs WHERE id = ?",
+                           (run_id,)).fetchone()
+        lost = conn.execute(""" UPDATE target_followers SET departed_at = ?
+                                WHERE target = ? AND departed_at IS NULL
+                                AND NOT EXISTS (""" + fetched + ")",
+                            (now, user_name, run_id)).rowcount
+        returned = conn.execute(""" UPDATE target_followers
+                                    SET departed_at = NULL
+                                    WHERE target = ?
+                                    AND departed_at IS NOT NULL
+                                    AND EXISTS (""" + fetched + ")",
+                                (user_name, run_id)).rowcount
+        new = conn.execute(""" SELECT COUNT(*) FROM target_followers
+                               WHERE target = ? AND first_seen >= ?""",
+                           (user_name, run[0])).fetchone()[0]
+        conn.execute(""" UPDATE crawl_runs
+                         SET new_followers = ?, lost_followers = ?,
+                             returned_followers = ?
+                         WHERE id = ?""", (new, lost, returned, run_id))
+        conn.execute("DELETE FROM crawl_ids WHERE run_id = ?", (run_id,))
+    return {"new": new, "lost": lost, "returned": returned,
+            "updated": run[1] or 0}
+
+
+def get_crawl_status(conn, run_id):
+    """
+    :param conn: Connection object
+    :param run_id: id of a retrieval run
+    :return: status of the run, "running" or "finished"
+    """
+    row = conn.execute("SELECT status FROM crawl_runs WHERE id = ?",
+                       (run_id,)).fetchone()
+    return row[0] if row else None
+
+
+def update_follower_db(conn, results):
+    """
+    Update followers database with the results from bot check: the scores
+    are appended to score_history and the profile only gets the date and
+    status of the check and the overall scores.
+    The caller is responsible for committing.
+    :param conn:
+    :param results: list of result tuples returned by check_bot()
+    :return:
+    """
+    n = len(SCORE_COLUMNS)
+    sql = """ INSERT OR REPLACE INTO score_history(user_id, checked_at, """ + \
+        ", ".join(SCORE_COLUMNS) + """)
+              SELECT id, """ + SQL_EPOCH + ", " + ", ".join("?" * n) + """
+              FROM followers WHERE screen_name = ?"""
+    cur = conn.cursor()
+    cur.executemany(sql, [(r[n],) + tuple(r[:n]) + (r[n + 2],)
+                          for r in results])
+    sql = """ UPDATE followers
+              SET last_check_date = ?,
+                  last_check_status = ?,
+                  en_overall = ?,
+                  un_overall = ?
+              WHERE screen_name = ?"""
+    cur.executemany(sql, [tuple(r[n:n + 2]) +
+                          tuple(r[i] for i in OVERALL_INDEXES) + (r[n + 2],)
+                          for r in results])
+
+
+def update_follower_db_failed(conn, results):
+    """
+    Mark the followers that cannot be checked as blocked.
+    The caller is responsible for committing.
+    :param conn:
+    :param results: list of (screen_name,) tuples
+    :return:
+    """
+    sql = """ UPDATE followers
+              SET last_check_status = "blocked"
+              WHERE screen_name = ?"""
+    cur = conn.cursor()
+    cur.executemany(sql, results)
+
+
+def update_follower_db_predicted(conn, results):
+    """
+    Store the bot probability estimated by the local pre-filter for the
+    followers it was confident about, instead of a Botometer check. They
+    are due again after days_to_keep like checked followers.
+    The caller is responsible for committing.
+    :param conn:
+    :param results: list of (prefilter_score, check date, screen_name)
+    :return:
+    """
+    sql = """ UPDATE followers
+              SET prefilter_score = ?,
+                  last_check_date = ?,
+                  last_check_status = "predicted"
+              WHERE screen_name = ?"""
+    cur = conn.cursor()
+    cur.executemany(sql, results)
+
+
+class CheckResultWriter:
+    """
+    Buffer bot check results and write them with executemany, committing
+    once every batch_size results. Use it as a context manager so the
+    partial batch is flushed even if the run is interrupted.
+    """
+
+    def __init__(self, conn, batch_size=50):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.succeeded = []
+        self.skipped = []
+        self.predicted = []
+
+    def add(self, action, result):
+        """
+        :param action: check_action returned by check_bot(), or
+        "predicted" for a result of the local pre-filter
+        :param result: result returned by check_bot(), or
+        (prefilter_score, check date, screen_name)
+        :return:
+        """
+        if action == "success":
+            self.succeeded.append(result)
+        elif action == "skip":
+            self.skipped.append(result)
+        elif action == "predicted":
+            self.predicted.append(result)
+        if len(self.succeeded) + len(self.skipped) + len(self.predicted) \
+                >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.succeeded and not self.skipped and not self.predicted:
+            return
+        with metrics.timer("db_write"), self.conn:
+            update_follower_db(self.conn, self.succeeded)
+            update_follower_db_failed(self.conn, self.skipped)
+            update_follower_db_predicted(self.conn, self.predicted)
+        self.succeeded = []
+        self.skipped = []
+        self.predicted = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+# Priority of a follower due for a bot check, from 0 to 1: half how
+# suspicious its profile looks, half how stale its bot data is. Each
+# feature is scaled to 0..1:
+# - following many more accounts than follow it back
+# - a young account (created_at ends with the year)
+# - no description
+# - few likes
+# - days since the last check over twice days_to_keep, 1 if never checked
+SQL_CHECK_PRIORITY = """
+    0.5 * (0.3 * (IFNULL(friends_count, 0) * 1.0 /
+                  (IFNULL(friends_count, 0) + IFNULL(followers_count, 0)
+                   + 1))
+           + 0.25 / (1 + MAX(0, CAST(strftime('%Y', 'now') AS integer) -
+                             IFNULL(CAST(substr(created_at, -4) AS integer),
+                                    0)))
+           + 0.2 * (IFNULL(description, '') = '')
+           + 0.25 * 10.0 / (10 + IFNULL(favourites_count, 0)))
+    + 0.5 * (CASE WHEN last_check_status IS NULL THEN 1.0
+             ELSE MIN(1.0, (julianday('now') - julianday(last_check_date))
+                           / (2.0 * MAX(?, 1))) END)"""
+
+
+# the follower of the current row of followers still follows the target
+# account bound to the parameter, found by the primary key of
+# target_followers
+SQL_FOLLOWS_TARGET = """EXISTS (SELECT 1 FROM target_followers
+                                WHERE target = ?
+                                AND follower_id = followers.id
+                                AND departed_at IS NULL)"""
+
+
+def select_followers_to_check(conn, user_name, days_to_keep, limit,
+                              prioritize=False):
+    """
+    Select the followers of an account due for a bot check: never checked
+    ones first, then the ones whose bot data (or pre-filter estimate) is
+    older than days_to_keep, oldest first. Blocked followers are never
+    selected, nor are the followers that left the account or gave their
+    screen_name up. A follower checked for another account is not due
+    again.
+    Both queries walk the (last_check_status, last_check_date) index and
+    look each follower up in target_followers, so the cost grows with the
+    limit and the share of the due followers that follow other accounts,
+    rather than with the size of the table.
+    With prioritize, the due followers are ordered by SQL_CHECK_PRIORITY
+    instead, so a capped run checks the most suspicious and most stale
+    ones first. This scans all the followers of the account but only keeps
+    the top limit in memory.
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param days_to_keep: number of days before the bot data expires
+    :param limit: maximum number of followers to return
+    :param prioritize: order by priority rather than by the index
+    :return: generator of (id, screen_name)
+    """
+    # bot data expires once it is more than days_to_keep full days old
+    cutoff = datetime.now() - timedelta(days=days_to_keep + 1)
+    cur = conn.cursor()
+    if prioritize:
+        cur.execute(""" SELECT id, screen_name
+                        FROM target_followers t
+                        CROSS JOIN followers ON id = t.follower_id
+                        WHERE t.target = ? AND t.departed_at IS NULL
+                        AND """ + SQL_NOT_RENAMED + """
+                        AND (last_check_status IS NULL
+                             OR (last_check_status IN ("success",
+                                                       "predicted")
+                                 AND last_check_date <= ?))
+                        ORDER BY """ + SQL_CHECK_PRIORITY + """ DESC
+                        LIMIT ?""", (user_name, cutoff, days_to_keep, limit))
+        yield from cur
+        return
+    cur.execute(""" SELECT id, screen_name FROM followers
+                    WHERE last_check_status IS NULL
+                    AND """ + SQL_NOT_RENAMED + """
+                    AND """ + SQL_FOLLOWS_TARGET + """
+                    LIMIT ?""", (user_name, limit))
+    n = 0
+    for row in cur:
+        n += 1
+        yield row
+    if n >= limit:
+        return
+    for row in _select_expired(conn, user_name, cutoff, limit - n):
+        yield row[:2]
+
+
+def _select_expired(conn, user_name, cutoff, limit):
+    # a merge of two index ranges, so no sort of all the expired rows
+    return conn.execute(""" SELECT id, screen_name, last_check_date
+                            FROM followers
+                            WHERE last_check_status = "success"
+                            AND last_check_date <= ?
+                            AND """ + SQL_NOT_RENAMED + """
+                            AND """ + SQL_FOLLOWS_TARGET + """
+                            UNION ALL
+                            SELECT id, screen_name, last_check_date
+                            FROM followers
+                            WHERE last_check_status = "predicted"
+                            AND last_check_date <= ?
+                            AND """ + SQL_NOT_RENAMED + """
+                            AND """ + SQL_FOLLOWS_TARGET + """
+                            ORDER BY 3
+                            LIMIT ?""",
+                        (cutoff, user_name, cutoff, user_name, limit))
+
+
+def count_followers_to_check(conn, user_name, days_to_keep, limit):
+    """
+    Count the followers of an account due for a bot check, stopping at
+    limit
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param days_to_keep: number of days before the bot data expires
+    :param limit: maximum number to count to
+    :return: number of followers due, at most limit
+    """
+    return sum(1 for _ in select_followers_to_check(conn, user_name,
+                                                     days_to_keep, limit))
+
+
+def count_checked_since(conn, user_name, since):
+    """
+    Count the Botometer results of the followers of an account stored
+    since a date
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param since: datetime or its string
+    :return: number of results
+    """
+    return conn.execute("SELECT COUNT(*) FROM score_history h "
+                        "JOIN target_followers t "
+                        "ON t.target = ? AND t.follower_id = h.user_id "
+                        "WHERE h.checked_at >= " + SQL_EPOCH,
+                        (user_name, since)).fetchone()[0]
+
+
+def get_oldest_due_check(conn, user_name, days_to_keep):
+    """
+    Find how stale the bot data of an account is
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param days_to_keep: number of days before the bot data expires
+    :return: (True if some followers have never been checked,
+    last_check_date of the most overdue follower or None)
+    """
+    cutoff = datetime.now() - timedelta(days=days_to_keep + 1)
+    cur = conn.cursor()
+    cur.execute(""" SELECT 1 FROM followers
+                    WHERE last_check_status IS NULL
+                    AND """ + SQL_NOT_RENAMED + """
+                    AND """ + SQL_FOLLOWS_TARGET + """
+                    LIMIT 1""", (user_name,))
+    never_checked = cur.fetchone() is not None
+    oldest = _select_expired(conn, user_name, cutoff, 1).fetchone()
+    return never_checked, oldest[2] if oldest else None
+
+
+def get_follower_overlap(conn, user_name):
+    """
+    Count the followers an account shares with each other target account,
+    going from its followers to the accounts they follow through the two
+    indexes of target_followers
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :return: list of (other account, number of shared followers), most
+    shared first
+    """
+    return conn.execute(""" SELECT o.target, COUNT(*)
+                            FROM target_followers t
+                            JOIN target_followers o
+                            ON o.follower_id = t.follower_id
+                            AND o.target != t.target
+                            AND o.departed_at IS NULL
+                            WHERE t.target = ? AND t.departed_at IS NULL
+                            GROUP BY o.target
+                            ORDER BY 2 DESC""", (user_name,)).fetchall()
+
+
+def get_export_watermark(conn, name):
+    """
+    :param conn: Connection object
+    :param name: name of the export consumer
+    :return: change_seq of the last row exported, 0 if never exported
+    """
+    row = conn.execute("SELECT change_seq FROM export_watermarks "
+                       "WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def set_export_watermark(conn, name, change_seq):
+    """
+    :param conn: Connection object
+    :param name: name of the export consumer
+    :param change_seq: change_seq of the last row exported
+    :return:
+    """
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO export_watermarks "
+                     "VALUES(?, ?, ?)", (name, change_seq, datetime.now()))
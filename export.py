@@ -0,0 +1,172 @@
+import csv
+import gzip
+import logging
+from db import (
+    FOLLOWERS_DB,
+    create_connection,
+    create_new_followers_table,
+    get_export_watermark,
+    set_export_watermark
+)
+
+
+logger = logging.getLogger(__name__)
+
+FOLLOWER_COLUMNS = [
+    "id", "screen_name", "name", "description", "followers_count",
+    "friends_count", "listed_count", "favourites_count", "created_at",
+    "en_cap", "en_astroturf", "en_fake_follower", "en_financial",
+    "en_other", "en_overall", "en_self_declared", "en_spammer",
+    "un_cap", "un_astroturf", "un_fake_follower", "un_financial",
+    "un_other", "un_overall", "un_self_declared", "un_spammer",
+    "last_check_date", "last_check_status", "prefilter_score", "change_seq",
+    "departed_at"
+]
+
+# file extension of each export format
+EXPORT_FORMATS = {"csv": ".csv", "csv.gz": ".csv.gz", "parquet": ".parquet"}
+
+
+def iter_rows(conn, user_name, columns, chunk_size=10000, changes=None):
+    """
+    Stream the followers of an account in chunks, including the ones that
+    left it, which have a departed_at date
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param columns: list of columns to select
+    :param chunk_size: number of rows per chunk
+    :param changes: (after, up_to) to only select the rows whose
+    change_seq is in that range, None for all the rows
+    :return: generator of lists of rows
+    """
+    cur = conn.cursor()
+    # departed_at is the only column of the link to the account
+    select = "SELECT " + ", ".join(
+        ("t." if c == "departed_at" else "s.") + c for c in columns) + \
+        " FROM target_followers t " \
+        "JOIN followers_scores s ON s.id = t.follower_id "
+    if changes is None:
+        cur.execute(select + "WHERE t.target = ? ORDER BY t.follower_id",
+                    (user_name,))
+    else:
+        cur.execute(select + "WHERE t.target = ? "
+                    "AND s.change_seq > ? AND s.change_seq <= ? "
+                    "ORDER BY s.change_seq", (user_name,) + changes)
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def write_csv(path, columns, chunks, compress=False):
+    """
+    :param path: path to the output file
+    :param columns: header row
+    :param chunks: iterable of lists of rows
+    :param compress: gzip the output
+    :return: number of rows written
+    """
+    n = 0
+    opener = gzip.open if compress else open
+    with opener(path, "wt", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for rows in chunks:
+            writer.writerows(rows)
+            n += len(rows)
+    return n
+
+
+def _parquet_type(pa, column):
+    if column in ("id", "change_seq") or column.endswith("_count"):
+        return pa.int64()
+    if column.startswith("en_") or column.startswith("un_") \
+            or column == "prefilter_score":
+        return pa.float64()
+    return pa.string()
+
+
+def write_parquet(path, columns, chunks):
+    """
+    Write one parquet row group per chunk. Needs pyarrow.
+    :param path: path to the output file
+    :param columns: column names
+    :param chunks: iterable of lists of rows
+    :return: number of rows written
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        logger.error("Parquet export needs pyarrow, please run "
+                     "pip install pyarrow.")
+        raise
+
+    n = 0
+    writer = None
+    try:
+        for rows in chunks:
+            # fixed types so every chunk has the same schema
+            table = pa.table({c: pa.array([r[i] for r in rows],
+                                          _parquet_type(pa, c))
+                              for i, c in enumerate(columns)})
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+            n += len(rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n
+
+
+def export_followers(user_name, fmt="csv", columns=None, chunk_size=10000,
+                     incremental=False, consumer="default"):
+    """
+    Export the followers table of an account to a file, streaming the rows
+    from SQLite so the table is never fully loaded in memory
+    :param user_name: the screen_name of the target account
+    :param fmt: "csv", "csv.gz" or "parquet"
+    :param columns: list of columns to export, None for all
+    :param chunk_size: number of rows read from SQLite at a time
+    :param incremental: only export the rows inserted or updated since the
+    last incremental export for the same consumer
+    :param consumer: name under which the incremental export watermark is
+    stored, so several downstream systems can each get their own deltas
+    :return: path to the exported file, None if there was nothing to export
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: " + str(fmt))
+    columns = list(columns) if columns else FOLLOWER_COLUMNS
+    unknown = [c for c in columns if c not in FOLLOWER_COLUMNS]
+    if unknown:
+        raise ValueError("Unknown columns: " + ", ".join(unknown))
+
+    create_new_followers_table(FOLLOWERS_DB)
+    conn = create_connection(FOLLOWERS_DB)
+    changes = None
+    path = "temp/" + user_name + "_followers"
+    # each account has its own watermark
+    watermark = user_name + "/" + consumer
+    if incremental:
+        after = get_export_watermark(conn, watermark)
+        up_to = conn.execute("SELECT IFNULL(MAX(change_seq), 0) "
+                             "FROM followers").fetchone()[0]
+        if up_to <= after:
+            logger.info("No followers changed since the last export.")
+            return None
+        changes = (after, up_to)
+        path += "_changes_" + str(after + 1) + "-" + str(up_to)
+    path += EXPORT_FORMATS[fmt]
+
+    chunks = iter_rows(conn, user_name, columns, chunk_size, changes)
+    if fmt == "parquet":
+        n = write_parquet(path, columns, chunks)
+    else:
+        n = write_csv(path, columns, chunks, compress=fmt == "csv.gz")
+    if incremental:
+        # only move the watermark once the file is complete
+        set_export_watermark(conn, watermark, changes[1])
+    logger.info("Exported " + str(n) + " followers to " + path)
+    return path
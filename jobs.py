@@ -0,0 +1,428 @@
+"""
+Background jobs: followers retrieval and bot checks run in a worker
+process of their own, so they keep going when the Streamlit page is rerun
+or closed, and their state is kept in a SQLite table across app restarts.
+
+Usage of the worker, started by submit_job() and resume_job():
+    python jobs.py JOB_ID
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import subprocess
+from datetime import datetime, timedelta
+from metrics import metrics
+from resources import Resources
+from db import (
+    FOLLOWERS_DB,
+    create_connection,
+    create_new_followers_table,
+    count_checked_since
+)
+
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB = "temp/jobs.db"
+JOBS_LOG_DIR = "temp/jobs"
+
+# statuses of the jobs that are not over yet
+ACTIVE_STATUSES = ("queued", "running")
+
+# minimum seconds between two progress writes of a worker
+PROGRESS_INTERVAL = 1.0
+
+# seconds a worker has to claim its queued job before the job counts as
+# interrupted
+QUEUED_GRACE = 60
+
+
+class JobStopped(Exception):
+    """
+    Raised in a worker when the job was paused or cancelled
+    """
+
+
+def create_jobs_table(conn):
+    """
+    Create the table of the background jobs
+    :param conn: Connection object of the jobs database
+    :return:
+    """
+    conn.execute(""" CREATE TABLE IF NOT EXISTS jobs (
+                        id integer PRIMARY KEY,
+                        kind text NOT NULL,
+                        user_name text NOT NULL,
+                        params text NOT NULL,
+                        status text NOT NULL,
+                        request text,
+                        progress real,
+                        message text,
+                        result text,
+                        pid integer,
+                        created_at timestamp NOT NULL,
+                        started_at timestamp,
+                        updated_at timestamp,
+                        finished_at timestamp
+                    ); """)
+
+
+def jobs_connection(database=JOBS_DB):
+    os.makedirs(os.path.dirname(database) or ".", exist_ok=True)
+    conn = create_connection(database)
+    create_jobs_table(conn)
+    return conn
+
+
+def submit_job(kind, user_name, params, database=JOBS_DB):
+    """
+    Record a job and start its worker process
+    :param kind: "retrieve" or "check"
+    :param user_name: the screen_name of the target account
+    :param params: dict of the keyword arguments of retrieve_followers() or
+    run_bot_check()
+    :param database: path to the jobs database
+    :return: id of the job
+    """
+    if kind not in JOB_KINDS:
+        raise ValueError("Unknown job kind: " + kind)
+    conn = jobs_connection(database)
+    with conn:
+        cur = conn.execute(
+            """ INSERT INTO jobs(kind, user_name, params, status,
+                                 created_at, updated_at)
+                VALUES(?, ?, ?, "queued", ?, ?)""",
+            (kind, user_name, json.dumps(params), datetime.now(),
+             datetime.now()))
+    job_id = cur.lastrowid
+    start_worker(job_id, database)
+    return job_id
+
+
+def job_metrics_path(job_id):
+    """
+    :param job_id:
+    :return: path to the metrics file written by the worker of the job
+    """
+    return os.path.join(JOBS_LOG_DIR, str(job_id) + ".prom")
+
+
+def start_worker(job_id, database=JOBS_DB):
+    """
+    Start the worker process of a job in its own session, so it is not
+    stopped with the app
+    :param job_id:
+    :param database: path to the jobs database
+    :return: the Popen object
+    """
+    os.makedirs(JOBS_LOG_DIR, exist_ok=True)
+    log_path = os.path.join(JOBS_LOG_DIR, str(job_id) + ".log")
+    with open(log_path, "a") as log:
+        return subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(job_id),
+             "--database", database],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+            start_new_session=True)
+
+
+def _job_from_row(cur, row):
+    job = dict(zip([c[0] for c in cur.description], row))
+    job["params"] = json.loads(job["params"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def get_job(job_id, database=JOBS_DB):
+    """
+    :param job_id:
+    :param database: path to the jobs database
+    :return: dict of the columns of the job, None if there is none
+    """
+    cur = jobs_connection(database).execute(
+        "SELECT * FROM jobs WHERE id = ?", (job_id,))
+    row = cur.fetchone()
+    return _job_from_row(cur, row) if row else None
+
+
+def list_jobs(limit=10, database=JOBS_DB):
+    """
+    :param limit: maximum number of jobs returned
+    :param database: path to the jobs database
+    :return: list of dicts of the most recent jobs, newest first
+    """
+    cur = jobs_connection(database).execute(
+        "SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+    return [_job_from_row(cur, row) for row in cur.fetchall()]
+
+
+def _stop_job(job_id, status, database):
+    # a queued job is stopped before its worker claims it, a running one
+    # by its worker at the next progress report
+    conn = jobs_connection(database)
+    request = "pause" if status == "paused" else "cancel"
+    stoppable = ("queued",) if status == "paused" else ("queued", "paused")
+    with conn:
+        cur = conn.execute(
+            """ UPDATE jobs SET status = ?, updated_at = ?,
+                                finished_at = ?
+                WHERE id = ? AND status IN (""" +
+            ",".join("?" * len(stoppable)) + ")",
+            (status, datetime.now(),
+             datetime.now() if status == "cancelled" else None, job_id) +
+            stoppable)
+        if cur.rowcount > 0:
+            return True
+        cur = conn.execute(""" UPDATE jobs SET request = ?, updated_at = ?
+                               WHERE id = ? AND status = "running" """,
+                           (request, datetime.now(), job_id))
+    return cur.rowcount > 0
+
+
+def pause_job(job_id, database=JOBS_DB):
+    """
+    Pause a queued job, or ask the worker of a running one to stop after
+    the follower it is on. The followers retrieved or checked so far are
+    kept.
+    :param job_id:
+    :param database: path to the jobs database
+    :return: False if the job is not queued or running
+    """
+    return _stop_job(job_id, "paused", database)
+
+
+def cancel_job(job_id, database=JOBS_DB):
+    """
+    Cancel a queued or paused job, or ask the worker of a running one to
+    stop
+    :param job_id:
+    :param database: path to the jobs database
+    :return: False if the job is already over
+    """
+    return _stop_job(job_id, "cancelled", database)
+
+
+def resume_job(job_id, database=JOBS_DB):
+    """
+    Start a new worker for a paused job. A retrieval resumes from its last
+    checkpoint and a bot check only checks the followers still due.
+    :param job_id:
+    :param database: path to the jobs database
+    :return: False if the job is not paused
+    """
+    conn = jobs_connection(database)
+    with conn:
+        cur = conn.execute(""" UPDATE jobs
+                               SET status = "queued", request = NULL,
+                                   pid = NULL, updated_at = ?
+                               WHERE id = ? AND status = "paused" """,
+                           (datetime.now(), job_id))
+    if cur.rowcount == 0:
+        return False
+    start_worker(job_id, database)
+    return True
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def recover_jobs(database=JOBS_DB, grace=QUEUED_GRACE):
+    """
+    Mark as paused the jobs whose worker died without recording it, e.g.
+    when the machine was restarted, so they can be resumed. That includes
+    the queued jobs whose worker did not claim them within grace seconds,
+    e.g. when it failed to start.
+    :param database: path to the jobs database
+    :param grace: seconds a worker has to claim its queued job
+    :return: number of jobs recovered
+    """
+    conn = jobs_connection(database)
+    jobs = conn.execute(""" SELECT id, pid FROM jobs
+                            WHERE status = "running" """).fetchall()
+    dead = [job_id for job_id, pid in jobs
+            if pid is None or not _is_alive(pid)]
+    now = datetime.now()
+    with conn:
+        conn.executemany(""" UPDATE jobs
+                             SET status = "paused", request = NULL,
+                                 message = "Interrupted, resume to continue",
+                                 updated_at = ?
+                             WHERE id = ? AND status = "running" """,
+                         [(now, job_id) for job_id in dead])
+        # the claim of the worker sets the pid in the same update as the
+        # status, so a job claimed in the meantime is left alone
+        unclaimed = conn.execute(
+            """ UPDATE jobs
+                SET status = "paused", request = NULL,
+                    message = "Interrupted, resume to continue",
+                    updated_at = ?
+                WHERE status = "queued" AND pid IS NULL
+                AND updated_at < ?""",
+            (now, now - timedelta(seconds=grace))).rowcount
+    return len(dead) + unclaimed
+
+
+class JobReporter(logging.Handler):
+    """
+    Write the progress and last log message of a running job to the jobs
+    table at most every PROGRESS_INTERVAL seconds, and raise JobStopped
+    when the job was paused or cancelled.
+    """
+
+    def __init__(self, conn, job_id):
+        super().__init__(logging.INFO)
+        self.conn = conn
+        self.job_id = job_id
+        self.progress = None
+        self.message = None
+        self.last = 0.0
+
+    def emit(self, record):
+        self.message = record.getMessage()
+
+    def report(self, progress=None, message=None):
+        """
+        Progress callback of retrieve_followers() and run_bot_check()
+        :param progress: fraction completed
+        :param message: message to show instead of the last log message
+        :return:
+        """
+        if progress is not None:
+            self.progress = progress
+        if message is not None:
+            self.message = message
+        if time.monotonic() - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = time.monotonic()
+        with self.conn:
+            self.conn.execute(""" UPDATE jobs
+                                  SET progress = ?, message = ?,
+                                      updated_at = ?
+                                  WHERE id = ?""",
+                              (self.progress, self.message, datetime.now(),
+                               self.job_id))
+        request = self.conn.execute(
+            "SELECT request FROM jobs WHERE id = ?",
+            (self.job_id,)).fetchone()[0]
+        if request is not None:
+            raise JobStopped(request)
+
+
+# the bot checker and its API clients are only imported by the workers
+
+
+def _run_retrieve(job, reporter):
+    from bot_checker import retrieve_followers
+
+    retrieved = retrieve_followers(
+        job["user_name"], progress=lambda n: reporter.report(
+            message=str(n) + " followers saved to database..."),
+        **job["params"])
+    return {"retrieved": retrieved}
+
+
+def _run_check(job, reporter):
+    from bot_checker import run_bot_check
+
+    params = dict(job["params"])
+    if job["started_at"] is not None:
+        # a resumed job only checks what is left of its cap
+        create_new_followers_table(FOLLOWERS_DB)
+        conn = create_connection(FOLLOWERS_DB)
+        params["account_cap"] = max(0, params["account_cap"] -
+                                    count_checked_since(conn,
+                                                        job["user_name"],
+                                                        job["started_at"]))
+    return run_bot_check(job["user_name"],
+                         progress=lambda f: reporter.report(progress=f),
+                         **params)
+
+
+JOB_KINDS = {"retrieve": _run_retrieve, "check": _run_check}
+
+
+def run_job(job_id, database=JOBS_DB):
+    """
+    Run a job in the current process, recording its status, progress and
+    result in the jobs table
+    :param job_id:
+    :param database: path to the jobs database
+    :return: the final status of the job
+    """
+    conn = jobs_connection(database)
+    job = get_job(job_id, database)
+    with conn:
+        # claim the job, another worker may have been started for it
+        cur = conn.execute(""" UPDATE jobs
+                               SET status = "running", pid = ?,
+                                   started_at = IFNULL(started_at, ?),
+                                   updated_at = ?
+                               WHERE id = ? AND status = "queued" """,
+                           (os.getpid(), datetime.now(), datetime.now(),
+                            job_id))
+    if cur.rowcount == 0:
+        logger.warning("Job " + str(job_id) + " is not queued.")
+        return None
+    reporter = JobReporter(conn, job_id)
+    for name in ("bot_checker", "db", "export", "prefilter"):
+        logging.getLogger(name).addHandler(reporter)
+
+    result = None
+    try:
+        result = JOB_KINDS[job["kind"]](job, reporter)
+    except JobStopped as e:
+        status = "paused" if str(e) == "pause" else "cancelled"
+    except Exception as e:
+        logger.exception("Job " + str(job_id) + " failed")
+        status, reporter.message = "failed", str(e)
+    else:
+        status = "done"
+        reporter.progress = 1.0
+    finally:
+        for name in ("bot_checker", "db", "export", "prefilter"):
+            logging.getLogger(name).removeHandler(reporter)
+
+    with conn:
+        conn.execute(""" UPDATE jobs
+                         SET status = ?, request = NULL, progress = ?,
+                             message = ?, result = ?, updated_at = ?,
+                             finished_at = ?
+                         WHERE id = ?""",
+                     (status, reporter.progress, reporter.message,
+                      json.dumps(result) if result is not None else None,
+                      datetime.now(),
+                      None if status == "paused" else datetime.now(),
+                      job_id))
+    logger.info("Job " + str(job_id) + " " + status + ".")
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a background job of the Twitter bot checker.")
+    parser.add_argument("job_id", type=int)
+    parser.add_argument("--database", default=JOBS_DB,
+                        help="jobs database (default: %(default)s)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # one file per job, the workers of other jobs run at the same time
+    metrics.path = job_metrics_path(args.job_id)
+    with Resources():
+        status = run_job(args.job_id, args.database)
+    metrics.write()
+    return 0 if status in ("done", "paused", "cancelled") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
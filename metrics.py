@@ -0,0 +1,230 @@
+import os
+import re
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+METRICS_FILE = "temp/metrics.prom"
+
+
+class Metrics:
+    """
+    Thread-safe timings of the pipeline stages (Botometer calls, Twitter
+    page fetches, rate limit waits, db writes...) and gauges such as the
+    quota left. Rates and latency percentiles are computed over the last
+    `window` seconds. If `path` is set, the metrics are written there in
+    the Prometheus text format for node_exporter's textfile collector or
+    any other scraper.
+    """
+
+    def __init__(self, window=300.0, max_samples=10000, path=None,
+                 write_interval=5.0):
+        """
+        :param window: seconds over which rates and percentiles are computed
+        :param max_samples: maximum number of timings kept per stage
+        :param path: Prometheus text file to write, None to not write one
+        :param write_interval: minimum seconds between writes of the file
+        """
+        self.window = window
+        self.max_samples = max_samples
+        self.path = path
+        self.write_interval = write_interval
+        self._samples = {}  # stage -> deque of (end time, seconds)
+        self._totals = {}  # stage -> [count, total seconds]
+        self._gauges = {}
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        """
+        Record one timing
+        :param stage: name of the stage, e.g. "botometer_call"
+        :param seconds: time it took
+        :return:
+        """
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(
+                    maxlen=self.max_samples)
+                self._totals[stage] = [0, 0.0]
+            now = time.monotonic()
+            samples.append((now, seconds))
+            self._prune(samples, now)
+            self._totals[stage][0] += 1
+            self._totals[stage][1] += seconds
+
+    def _prune(self, samples, now):
+        # timings are appended in time order, drop the ones out of the window
+        while samples and now - samples[0][0] > self.window:
+            samples.popleft()
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Time the body of a with statement, even if it raises
+        :param stage: name of the stage
+        :return:
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def set_gauge(self, name, value):
+        """
+        :param name: name of the gauge, e.g. "quota_left"
+        :param value: number, None to remove the gauge
+        :return:
+        """
+        with self._lock:
+            if value is None:
+                self._gauges.pop(name, None)
+            else:
+                self._gauges[name] = value
+
+    def rate(self, stage):
+        """
+        :param stage: name of the stage
+        :return: number of events per second over the window
+        """
+        now = time.monotonic()
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples:
+                self._prune(samples, now)
+            if not samples:
+                return 0.0
+            # over the window, or since the first event if more recent
+            return len(samples) / max(1.0, min(self.window,
+                                               now - samples[0][0]))
+
+    def snapshot(self):
+        """
+        :return: dict with "stages", a dict of stage to count, total_seconds,
+        rate, p50, p90 and p99, and "gauges"
+        """
+        now = time.monotonic()
+        with self._lock:
+            stages = list(self._samples)
+            for q in self._samples.values():
+                self._prune(q, now)
+            samples = {s: sorted(d for _, d in q)
+                       for s, q in self._samples.items()}
+            totals = {s: list(v) for s, v in self._totals.items()}
+            gauges = dict(self._gauges)
+
+        stats_by_stage = {}
+        for stage in stages:
+            durations = samples[stage]
+            stats = {"count": totals[stage][0],
+                     "total_seconds": totals[stage][1],
+                     "rate": self.rate(stage)}
+            for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+                stats[name] = durations[min(len(durations) - 1,
+                                            int(q * len(durations)))] \
+                    if durations else None
+            stats_by_stage[stage] = stats
+        return {"stages": stats_by_stage, "gauges": gauges}
+
+    def to_prometheus(self):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = ["# TYPE bot_checker_stage_seconds summary"]
+        for stage, s in sorted(snapshot["stages"].items()):
+            for name, q in (("p50", "0.5"), ("p90", "0.9"), ("p99", "0.99")):
+                if s[name] is not None:
+                    lines.append('bot_checker_stage_seconds{stage="%s",'
+                                 'quantile="%s"} %g' % (stage, q, s[name]))
+            lines.append('bot_checker_stage_seconds_sum{stage="%s"} %g'
+                         % (stage, s["total_seconds"]))
+            lines.append('bot_checker_stage_seconds_count{stage="%s"} %d'
+                         % (stage, s["count"]))
+        lines.append("# TYPE bot_checker_stage_rate gauge")
+        for stage, s in sorted(snapshot["stages"].items()):
+            lines.append('bot_checker_stage_rate{stage="%s"} %g'
+                         % (stage, s["rate"]))
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append("# TYPE bot_checker_%s gauge" % name)
+            lines.append("bot_checker_%s %g" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=None):
+        """
+        Write the Prometheus text file, replacing it atomically so a scraper
+        never reads half a file
+        :param path: defaults to self.path
+        :return:
+        """
+        path = path or self.path
+        if path is None:
+            return
+        self._last_write = time.monotonic()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # each writer has its own temporary file, as other processes and
+        # threads may write the same file
+        tmp = path + "." + str(os.getpid()) + "." + \
+            str(threading.get_ident()) + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+    def maybe_write(self):
+        """
+        Write the file if write_interval seconds have passed since the
+        last write
+        :return:
+        """
+        if self.path is not None and \
+                time.monotonic() - self._last_write >= self.write_interval:
+            self.write()
+
+
+def read_snapshot(path):
+    """
+    Read back the metrics written by Metrics.write(), e.g. by another
+    process
+    :param path: Prometheus text file
+    :return: dict like Metrics.snapshot(), None if there is no file
+    """
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return None
+    quantiles = {"0.5": "p50", "0.9": "p90", "0.99": "p99"}
+    stages = {}
+    gauges = {}
+    for line in lines:
+        if line.startswith("#") or " " not in line:
+            continue
+        name, value = line.rsplit(" ", 1)
+        match = re.match(r'bot_checker_stage_(seconds|seconds_sum|'
+                         r'seconds_count|rate)\{stage="([^"]*)"'
+                         r'(?:,quantile="([^"]*)")?\}$', name)
+        if match is None:
+            if name.startswith("bot_checker_"):
+                gauges[name[len("bot_checker_"):]] = float(value)
+            continue
+        kind, stage, quantile = match.groups()
+        stats = stages.setdefault(stage, {
+            "count": 0, "total_seconds": 0.0, "rate": 0.0,
+            "p50": None, "p90": None, "p99": None})
+        if kind == "seconds":
+            stats[quantiles[quantile]] = float(value)
+        elif kind == "seconds_sum":
+            stats["total_seconds"] = float(value)
+        elif kind == "seconds_count":
+            stats["count"] = int(value)
+        else:
+            stats["rate"] = float(value)
+    return {"stages": stages, "gauges": gauges}
+
+
+# shared by the whole pipeline
+metrics = Metrics()
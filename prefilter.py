@@ -0,0 +1,234 @@
+import logging
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+# profile fields the pre-filter reads from the followers table
+FEATURE_COLUMNS = [
+    "followers_count", "friends_count", "listed_count", "favourites_count",
+    "created_at", "description"
+]
+
+# overall Botometer score from which an account counts as a bot
+BOT_THRESHOLD = 0.5
+
+# share of the followers on the confident side of a threshold that the
+# held out data must get right for the threshold to be used
+PRECISION = 0.95
+
+# scored followers needed to train the pre-filter
+MIN_SAMPLES = 200
+
+# followers selected per follower that can be sent to Botometer, so the
+# accounts the pre-filter is sure about do not use up the cap
+LOOKAHEAD = 5
+
+
+def _import_numpy():
+    try:
+        import numpy as np
+    except ImportError:
+        logger.error("The pre-filter needs numpy, please run "
+                     "pip install numpy.")
+        raise
+    return np
+
+
+def profile_features(np, rows):
+    """
+    :param np: the numpy module
+    :param rows: list of tuples of the FEATURE_COLUMNS
+    :return: array of features, one row per follower
+    """
+    counts = np.array([r[:4] for r in rows], dtype=float)
+    counts = np.log1p(np.nan_to_num(counts).clip(min=0))
+    # created_at is in the Twitter format, e.g.
+    # "Sat Mar 31 00:00:00 +0000 2012"
+    years = np.array([str(r[4])[-4:] if r[4] else "" for r in rows])
+    years = np.array([int(y) if y.isdigit() else np.nan for y in years])
+    age = datetime.now().year - years
+    known = ~np.isnan(age)
+    # accounts of unknown age get the mean age
+    age = np.where(known, age.clip(min=0),
+                   age[known].mean() if known.any() else 0)
+    no_description = np.array([not r[5] for r in rows], dtype=float)
+    return np.column_stack([
+        counts,  # log followers, friends, listed and favourites
+        counts[:, 1] - counts[:, 0],  # log friends to followers ratio
+        np.log1p(age),
+        no_description
+    ])
+
+
+class PrefilterModel:
+    """
+    Logistic regression of the overall Botometer score on the stored
+    profile fields, with the thresholds under and over which its estimate
+    is trusted instead of a Botometer call.
+    """
+
+    def __init__(self, np, weights, mean, std, low, high):
+        """
+        :param np: the numpy module
+        :param weights: coefficients, the intercept last
+        :param mean: mean of each feature in the training data
+        :param std: standard deviation of each feature
+        :param low: estimates under low are taken as human
+        :param high: estimates over high are taken as bots
+        """
+        self.np = np
+        self.weights = weights
+        self.mean = mean
+        self.std = std
+        self.low = low
+        self.high = high
+
+    def predict(self, rows):
+        """
+        :param rows: list of tuples of the FEATURE_COLUMNS
+        :return: array of the estimated bot probabilities
+        """
+        np = self.np
+        if not rows:
+            return np.zeros(0)
+        X = _design(np, profile_features(np, rows), self.mean, self.std)
+        return 1 / (1 + np.exp(-X @ self.weights))
+
+    def is_confident(self, p):
+        return p < self.low or p > self.high
+
+
+def _design(np, features, mean, std):
+    return np.column_stack([(features - mean) / std,
+                            np.ones(len(features))])
+
+
+def fit_logistic(np, X, y, l2=1.0, iterations=25):
+    """
+    Fit a logistic regression by iteratively reweighted least squares.
+    y can be soft labels between 0 and 1.
+    :param np: the numpy module
+    :param X: design matrix
+    :param y: targets
+    :param l2: ridge penalty, not applied to the intercept in the last
+    column
+    :param iterations: maximum number of Newton steps
+    :return: coefficients
+    """
+    w = np.zeros(X.shape[1])
+    penalty = l2 * np.eye(X.shape[1])
+    penalty[-1, -1] = 0
+    for _ in range(iterations):
+        p = 1 / (1 + np.exp(-X @ w))
+        hessian = X.T @ (X * (p * (1 - p))[:, None]) + penalty
+        step = np.linalg.solve(hessian, X.T @ (y - p) - penalty @ w)
+        w += step
+        if np.abs(step).max() < 1e-6:
+            break
+    return w
+
+
+def _threshold(np, p, correct, precision):
+    """
+    :param p: estimates sorted from the most to the least confident
+    :param correct: whether each estimate is on the right side of
+    BOT_THRESHOLD
+    :return: the least confident estimate such that the estimates at
+    least as confident reach the precision, None if none do
+    """
+    hits = np.cumsum(correct) / np.arange(1, len(p) + 1)
+    # ignore the first few estimates, too few to measure a precision
+    ok = np.nonzero(hits[10:] >= precision)[0]
+    return p[ok[-1] + 10] if len(ok) else None
+
+
+def train_prefilter(conn, precision=PRECISION, min_samples=MIN_SAMPLES,
+                    max_samples=50000, seed=0):
+    """
+    Train the pre-filter on the followers of an account already checked by
+    Botometer, keeping a quarter of them apart to choose the thresholds
+    :param conn: Connection object of the followers database
+    :param precision: share of the confident estimates that must be right
+    on the held out followers
+    :param min_samples: scored followers needed to train
+    :param max_samples: maximum number of followers trained on, the most
+    recently checked
+    :param seed: seed of the split of the held out followers
+    :return: PrefilterModel, None if there is not enough data or the
+    estimates are never confident enough
+    """
+    np = _import_numpy()
+    cur = conn.execute(
+        "SELECT " + ", ".join("f." + c for c in FEATURE_COLUMNS) + ", "
+        "(IFNULL(h.en_overall, h.un_overall) + "
+        " IFNULL(h.un_overall, h.en_overall)) / 2 "
+        "FROM followers f JOIN latest_scores h ON h.user_id = f.id "
+        "WHERE h.un_overall IS NOT NULL OR h.en_overall IS NOT NULL "
+        "ORDER BY h.checked_at DESC LIMIT ?", (max_samples,))
+    rows = cur.fetchall()
+    if len(rows) < min_samples:
+        logger.info("Not enough followers checked yet to train the "
+                    "pre-filter (" + str(len(rows)) + " of " +
+                    str(min_samples) + ").")
+        return None
+
+    features = profile_features(np, rows)
+    y = np.array([r[-1] for r in rows], dtype=float)
+    held_out = np.random.RandomState(seed).rand(len(rows)) < 0.25
+    train = features[~held_out]
+    mean = train.mean(axis=0)
+    std = train.std(axis=0)
+    std[std == 0] = 1
+    weights = fit_logistic(np, _design(np, train, mean, std), y[~held_out])
+
+    # thresholds from the held out followers
+    model = PrefilterModel(np, weights, mean, std, 0.0, 1.0)
+    p = model.predict([rows[i] for i in np.nonzero(held_out)[0]])
+    bot = y[held_out] >= BOT_THRESHOLD
+    order = np.argsort(p)
+    low = _threshold(np, p[order], ~bot[order], precision)
+    order = order[::-1]
+    high = _threshold(np, p[order], bot[order], precision)
+    # estimates exactly at a threshold stay uncertain
+    model.low = low if low is not None else -np.inf
+    model.high = high if high is not None else np.inf
+    if low is None and high is None:
+        logger.info("The pre-filter is not accurate enough yet, all the "
+                    "followers are sent to Botometer.")
+        return None
+    logger.info("Pre-filter trained on " + str(len(rows)) + " followers.")
+    return model
+
+
+def split_followers(model, conn, followers):
+    """
+    Estimate the bot probability of followers from their profiles
+    :param model: PrefilterModel returned by train_prefilter()
+    :param conn: Connection object of the followers database
+    :param followers: list of (id, screen_name)
+    :return: (predicted, uncertain): predicted is the list of
+    (id, screen_name, estimate) the model is confident about, uncertain
+    the list of (id, screen_name) to send to Botometer, both in the
+    original order
+    """
+    profiles = {}
+    for i in range(0, len(followers), 500):
+        ids = [f[0] for f in followers[i:i + 500]]
+        cur = conn.execute(
+            "SELECT id, " + ", ".join(FEATURE_COLUMNS) + " FROM followers "
+            "WHERE id IN (" + ",".join("?" * len(ids)) + ")", ids)
+        for row in cur:
+            profiles[row[0]] = row[1:]
+
+    known = [f for f in followers if f[0] in profiles]
+    estimates = dict(zip((f[0] for f in known), model.predict(
+        [profiles[f[0]] for f in known])))
+    predicted, uncertain = [], []
+    for user_id, screen_name in followers:
+        p = estimates.get(user_id)
+        if p is not None and model.is_confident(p):
+            predicted.append((user_id, screen_name, float(p)))
+        else:
+            uncertain.append((user_id, screen_name))
+    return predicted, uncertain
@@ -0,0 +1,205 @@
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by all the bot check workers.
+    Tokens refill at `rate` per second up to `burst`. An optional `quota`
+    caps the total number of tokens handed out (e.g. the daily account cap).
+    """
+
+    def __init__(self, rate, burst=1, quota=None):
+        """
+        :param rate: number of requests allowed per second
+        :param burst: maximum number of requests that can be sent at once
+        :param quota: total number of requests allowed, None for no limit
+        """
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.quota = quota
+        self.used = 0
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def remaining(self):
+        """
+        :return: quota left, None if the bucket has no quota
+        """
+        with self._lock:
+            if self.quota is None:
+                return None
+            return max(0, self.quota - self.used)
+
+    def acquire(self, consume_quota=True):
+        """
+        Block until a token is available.
+        :param consume_quota: False for retries of a request that has
+        already been counted against the quota
+        :return: True if a token was taken, False if the quota is exhausted
+        """
+        while True:
+            with self._lock:
+                if consume_quota and self.quota is not None \
+                        and self.used >= self.quota:
+                    return False
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    if consume_quota:
+                        self.used += 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def backoff_delay(attempt, base=2.0, cap=900.0):
+    """
+    Exponential backoff with full jitter
+    :param attempt: number of the retry, starting from 0
+    :param base: delay of the first retry in seconds
+    :param cap: maximum delay in seconds
+    :return: number of seconds to sleep
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# rate limit headers as (limit, remaining, reset, is a window). Twitter
+# gives the reset of its 15 minute windows as a unix time, RapidAPI the
+# reset of the plan's quota as seconds from now.
+RATE_LIMIT_HEADERS = [
+    ("x-rate-limit-limit", "x-rate-limit-remaining", "x-rate-limit-reset",
+     True),
+    ("x-ratelimit-requests-limit", "x-ratelimit-requests-remaining",
+     "x-ratelimit-requests-reset", False)
+]
+
+
+class RateLimits:
+    """
+    Thread-safe budget of each API endpoint, read from the rate limit
+    headers of its responses. A call waits only when the budget of its
+    endpoint is used up, and until the actual reset. The last `reserve`
+    share of a rate limit window is spread evenly until its reset, so the
+    limit is seldom hit. A quota, like the RapidAPI plan's, is used up as
+    fast as allowed.
+    """
+
+    def __init__(self, reserve=0.2):
+        """
+        :param reserve: share of a window that is spread until its reset
+        """
+        self.reserve = reserve
+        self._limits = {}  # endpoint -> limit, remaining, reset, window, last
+        self._lock = threading.Lock()
+
+    def update(self, endpoint, headers):
+        """
+        Record the budget of an endpoint from the headers of a response
+        :param endpoint: name of the endpoint, e.g. "botometer"
+        :param headers: headers of the response
+        :return: True if the headers had a rate limit
+        """
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        now = time.time()
+        budget = None
+        for limit, remaining, reset, window in RATE_LIMIT_HEADERS:
+            try:
+                budget = (int(headers.get(limit, 0)) or None,
+                          int(headers[remaining]),
+                          float(headers[reset]) + (0 if window else now),
+                          window)
+                break
+            except (KeyError, ValueError):
+                continue
+        try:
+            # a 429 may only tell when to retry
+            budget = (budget[0] if budget else None, 0,
+                      now + float(headers["retry-after"]), False)
+        except (KeyError, ValueError):
+            pass
+        if budget is None:
+            return False
+        with self._lock:
+            state = self._limits.setdefault(endpoint, {"last": None})
+            state["limit"], state["remaining"], state["reset"], \
+                state["window"] = budget
+        return True
+
+    def _delay(self, state, now):
+        reset_in = state["reset"] - now
+        if reset_in <= 0:
+            # new window, its budget is not known yet
+            return 0.0
+        if state["remaining"] <= 0:
+            return reset_in
+        if not state["window"] or state["limit"] is None \
+                or state["remaining"] > self.reserve * state["limit"] \
+                or state["last"] is None:
+            return 0.0
+        return max(0.0, state["last"] + reset_in / state["remaining"] - now)
+
+    def delay(self, endpoint):
+        """
+        :param endpoint: name of the endpoint
+        :return: seconds to wait before the next call to the endpoint
+        """
+        with self._lock:
+            state = self._limits.get(endpoint)
+            return 0.0 if state is None else self._delay(state, time.time())
+
+    def acquire(self, endpoint, stop=None, max_wait=None):
+        """
+        Wait until the next call to an endpoint fits in its budget and
+        count it against the budget
+        :param endpoint: name of the endpoint
+        :param stop: threading.Event ending the wait early when set
+        :param max_wait: longest wait in seconds, None to wait for the
+        reset however far it is
+        :return: False if the wait would be longer than max_wait or stop
+        was set
+        """
+        while True:
+            with self._lock:
+                state = self._limits.get(endpoint)
+                now = time.time()
+                wait = 0.0 if state is None else self._delay(state, now)
+                if max_wait is not None and wait > max_wait:
+                    return False
+                if wait <= 0:
+                    if state is not None:
+                        state["last"] = now
+                        if state["reset"] > now:
+                            # until the response tells the actual budget
+                            state["remaining"] -= 1
+                    return True
+            if stop is None:
+                time.sleep(wait)
+            elif stop.wait(wait):
+                return False
+
+    def state(self):
+        """
+        :return: dict of endpoint to dict of limit, remaining and reset_in
+        (seconds until the window resets), remaining is None once the
+        window has reset
+        """
+        now = time.time()
+        with self._lock:
+            return {endpoint: {
+                "limit": s["limit"],
+                "remaining": s["remaining"] if s["reset"] > now else None,
+                "reset_in": max(0.0, s["reset"] - now)}
+                for endpoint, s in self._limits.items()}
+
+
+# shared by the whole pipeline
+rate_limits = RateLimits()
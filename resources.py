@@ -0,0 +1,133 @@
+import time
+import threading
+
+
+_current = None
+
+
+class Resources:
+    """
+    Long-lived SQLite connections and API clients, so the actions of a
+    session reuse them instead of reconnecting and logging in again.
+    While a Resources is in use (see use_resources()), create_connection()
+    returns one connection per database and owner, by default the current
+    thread, and twitter_login() and botometer_login() one client per set
+    of credentials.
+    Use it as a context manager, or call close(), to close them all.
+    """
+
+    def __init__(self, owner=None, idle_timeout=0):
+        """
+        :param owner: function returning a hashable key of the current
+        user of the connections, the current thread by default. The owner
+        must not use its connections from two threads at once.
+        :param idle_timeout: seconds a connection is kept once the last
+        thread that asked for it has ended, e.g. between two Streamlit
+        script runs of a session
+        """
+        self._owner = owner or threading.get_ident
+        self._idle_timeout = idle_timeout
+        # (path, owner) -> [last thread, connection, time of last use]
+        self._connections = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+        # keys of the setups done, run under their own lock as they may
+        # open connections
+        self._setups = set()
+        self._setup_lock = threading.Lock()
+
+    def connection(self, path, opener):
+        """
+        :param path: path to the database
+        :param opener: function opening a new connection to path
+        :return: the connection of the current owner to the database
+        """
+        thread = threading.current_thread()
+        key = (path, self._owner())
+        with self._lock:
+            self._close_idle()
+            entry = self._connections.get(key)
+            if entry is not None:
+                entry[0] = thread
+                entry[2] = time.monotonic()
+                return entry[1]
+        conn = opener(path)
+        if conn is not None:
+            with self._lock:
+                self._connections[key] = [thread, conn, time.monotonic()]
+        return conn
+
+    def _close_idle(self):
+        # e.g. the connections of the threads of ended jobs, or of the
+        # Streamlit sessions closed for idle_timeout
+        now = time.monotonic()
+        for key, (thread, conn, used) in list(self._connections.items()):
+            if not thread.is_alive() and now - used >= self._idle_timeout:
+                del self._connections[key]
+                conn.close()
+
+    def client(self, key, factory):
+        """
+        :param key: hashable key of the client, e.g. its credentials
+        :param factory: function creating the client
+        :return: the client created for key, created on first use
+        """
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = factory()
+            return self._clients[key]
+
+    def setup(self, key, function):
+        """
+        Run function the first time key is set up, e.g. to create the
+        tables of a database once instead of on every script run
+        :param key: hashable key of the setup, e.g. the database path
+        :param function: function taking no argument
+        :return:
+        """
+        with self._setup_lock:
+            if key not in self._setups:
+                function()
+                self._setups.add(key)
+
+    def close(self):
+        """
+        Close all the connections and the clients that have a close method
+        :return:
+        """
+        with self._lock:
+            connections = [conn for _, conn, _ in
+                           self._connections.values()]
+            clients = list(self._clients.values())
+            self._connections = {}
+            self._clients = {}
+        for conn in connections:
+            conn.close()
+        for client in clients:
+            if hasattr(client, "close"):
+                client.close()
+
+    def __enter__(self):
+        use_resources(self)
+        return self
+
+    def __exit__(self, *exc):
+        if current_resources() is self:
+            use_resources(None)
+        self.close()
+
+
+def use_resources(resources):
+    """
+    :param resources: Resources to use from now on, None to stop pooling
+    :return:
+    """
+    global _current
+    _current = resources
+
+
+def current_resources():
+    """
+    :return: the Resources in use, None if there is none
+    """
+    return _current
@@ -0,0 +1,214 @@
+import json
+import logging
+from db import OVERALL_COLUMNS
+
+
+logger = logging.getLogger(__name__)
+
+# columns shown by the results viewer
+RESULT_COLUMNS = [
+    "id", "screen_name", "name", "followers_count", "friends_count",
+    "created_at", "en_overall", "un_overall", "last_check_date",
+    "last_check_status", "prefilter_score", "departed_at"
+]
+
+# sort orders of the results viewer. With a check status filter the
+# scores and the last check walk an index of the followers table, without
+# one the account creation walks the table itself. Twitter ids grow with
+# time, so ordering by id orders the accounts by creation date.
+RESULT_SORTS = {
+    "English overall score": "en_overall",
+    "Universal overall score": "un_overall",
+    "Account creation": "id",
+    "Last check": "last_check_date"
+}
+
+# aggregates kept in the cache for each account
+AGGREGATE_CACHE_SIZE = 100
+
+# statuses the results can be filtered on, "unchecked" for none
+RESULT_STATUSES = ["success", "predicted", "blocked", "unchecked"]
+
+
+def _where(user_name, status=None, score=None, min_score=None,
+           departed=False):
+    """
+    :return: (WHERE clause on the followers table f, parameters)
+    """
+    sql = """ WHERE EXISTS (SELECT 1 FROM target_followers t
+                            WHERE t.target = ? AND t.follower_id = f.id""" + \
+        ("" if departed else " AND t.departed_at IS NULL") + ")"
+    params = [user_name]
+    if status == "unchecked":
+        sql += " AND f.last_check_status IS NULL"
+    elif status is not None:
+        sql += " AND f.last_check_status = ?"
+        params.append(status)
+    if min_score is not None:
+        sql += " AND f." + score + " >= ?"
+        params.append(min_score)
+    return sql, params
+
+
+def _check_score(score):
+    if score not in OVERALL_COLUMNS:
+        raise ValueError("Unknown score: " + str(score))
+
+
+def get_results_page(conn, user_name, sort="en_overall", descending=True,
+                     status=None, score="en_overall", min_score=None,
+                     departed=False, page=0, page_size=50):
+    """
+    Select one page of the followers of an account. The page is sorted,
+    filtered and cut in SQLite, and only the rows of the page are read in
+    full. With a status filter, SQLite walks the index of the check status
+    and the score or last check it is sorted by, and stops at the end of
+    the page. Without one, only sorting by account creation does.
+    Otherwise, and with a min_score on another score than the sort, the
+    matching followers are sorted in a temporary B-tree.
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param sort: one of the values of RESULT_SORTS
+    :param descending: sort from the highest value
+    :param status: one of RESULT_STATUSES, None for all
+    :param score: overall score min_score applies to, "en_overall" or
+    "un_overall"
+    :param min_score: only the followers scoring at least this much
+    :param departed: include the followers that left the account
+    :param page: page number, from 0
+    :param page_size: number of followers per page
+    :return: list of tuples of the RESULT_COLUMNS
+    """
+    if sort not in RESULT_SORTS.values():
+        raise ValueError("Unknown sort: " + str(sort))
+    _check_score(score)
+    where, params = _where(user_name, status, score, min_score, departed)
+    order = " DESC" if descending else ""
+    # the index of the sort column already orders its ties by id. SQLite
+    # puts the unscored followers last in descending order only.
+    ids = [row[0] for row in conn.execute(
+        "SELECT f.id FROM followers f" + where +
+        " ORDER BY f." + sort + order +
+        ("" if sort == "id" else ", f.id" + order) + " LIMIT ? OFFSET ?",
+        params + [page_size, page * page_size])]
+    if not ids:
+        return []
+    rows = conn.execute(
+        "SELECT " + ", ".join(
+            ("t." if c == "departed_at" else "f.") + c
+            for c in RESULT_COLUMNS) +
+        " FROM followers f JOIN target_followers t"
+        " ON t.target = ? AND t.follower_id = f.id"
+        " WHERE f.id IN (" + ",".join("?" * len(ids)) + ")",
+        [user_name] + ids).fetchall()
+    position = {user_id: i for i, user_id in enumerate(ids)}
+    return sorted(rows, key=lambda row: position[row[0]])
+
+
+def get_data_version(conn, user_name):
+    """
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :return: change_seq of the last change of the followers of the account,
+    kept up to date by a trigger
+    """
+    row = conn.execute("SELECT change_seq FROM target_versions "
+                       "WHERE target = ?", (user_name,)).fetchone()
+    return row[0] if row else 0
+
+
+def cached_aggregate(conn, user_name, name, compute):
+    """
+    Return an aggregate of the followers of an account from the aggregate
+    cache, computing and storing it again if the followers changed since.
+    The aggregates of older versions of the followers are dropped, and only
+    the AGGREGATE_CACHE_SIZE latest ones of each account are kept.
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param name: name of the aggregate, including its parameters
+    :param compute: function computing the aggregate, its result must be
+    json serialisable
+    :return: the aggregate
+    """
+    version = get_data_version(conn, user_name)
+    row = conn.execute("SELECT change_seq, value FROM aggregate_cache "
+                       "WHERE target = ? AND name = ?",
+                       (user_name, name)).fetchone()
+    if row is not None and row[0] == version:
+        return json.loads(row[1])
+    value = compute()
+    with conn:
+        conn.execute("DELETE FROM aggregate_cache "
+                     "WHERE target = ? AND change_seq IS NOT ?",
+                     (user_name, version))
+        conn.execute("INSERT OR REPLACE INTO aggregate_cache "
+                     "VALUES(?, ?, ?, ?)",
+                     (user_name, name, version, json.dumps(value)))
+        # each filter value adds an aggregate, drop the oldest ones
+        conn.execute("DELETE FROM aggregate_cache WHERE target = ? "
+                     "AND rowid NOT IN (SELECT rowid FROM aggregate_cache "
+                     "WHERE target = ? ORDER BY rowid DESC LIMIT ?)",
+                     (user_name, user_name, AGGREGATE_CACHE_SIZE))
+    return value
+
+
+def count_results(conn, user_name, status=None, score="en_overall",
+                  min_score=None, departed=False):
+    """
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :return: number of followers matching the filters of
+    get_results_page(), cached until the followers change
+    """
+    _check_score(score)
+    where, params = _where(user_name, status, score, min_score, departed)
+    return cached_aggregate(
+        conn, user_name,
+        "count:" + json.dumps([status, score, min_score, departed]),
+        lambda: conn.execute("SELECT COUNT(*) FROM followers f" + where,
+                             params).fetchone()[0])
+
+
+def score_histogram(conn, user_name, score="en_overall", bins=10):
+    """
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param score: "en_overall" or "un_overall"
+    :param bins: number of bins between 0 and 1
+    :return: list of the number of current followers in each bin, cached
+    until the followers change
+    """
+    _check_score(score)
+    where, params = _where(user_name)
+
+    def compute():
+        counts = [0] * bins
+        for b, n in conn.execute(
+                "SELECT MIN(CAST(f." + score + " * ? AS integer), ? - 1), "
+                "COUNT(*) FROM followers f" + where +
+                " AND f." + score + " IS NOT NULL GROUP BY 1",
+                [bins, bins] + params):
+            counts[b] = n
+        return counts
+    return cached_aggregate(conn, user_name,
+                            "histogram:" + score + ":" + str(bins), compute)
+
+
+def bot_share(conn, user_name, score="en_overall", threshold=0.5):
+    """
+    :param conn: Connection object
+    :param user_name: the screen_name of the target account
+    :param score: "en_overall" or "un_overall"
+    :param threshold: score from which a follower counts as a bot
+    :return: (number of current followers scoring at least threshold,
+    number of scored current followers), cached until the followers change
+    """
+    _check_score(score)
+    where, params = _where(user_name)
+    return tuple(cached_aggregate(
+        conn, user_name, "bot_share:" + score + ":" + str(threshold),
+        lambda: list(conn.execute(
+            "SELECT IFNULL(SUM(f." + score + " >= ?), 0), COUNT(f." + score +
+            ") FROM followers f" + where,
+            [threshold] + params).fetchone())))
+
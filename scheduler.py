@@ -0,0 +1,335 @@
+import time
+import logging
+from datetime import datetime, date, timedelta
+from ratelimit import TokenBucket, rate_limits
+from prefilter import LOOKAHEAD, train_prefilter, split_followers
+from db import (
+    FOLLOWERS_DB,
+    create_connection,
+    create_new_followers_table,
+    CheckResultWriter,
+    select_followers_to_check,
+    count_followers_to_check,
+    get_oldest_due_check
+)
+from bot_checker import (
+    CREDENTIALS_FILE,
+    check_user_name,
+    get_credentials,
+    botometer_login,
+    run_checks
+)
+
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_DB = "temp/scheduler.db"
+
+
+def parse_target(target):
+    """
+    :param target: "screen_name" or "screen_name:priority"
+    :return: (screen_name, priority)
+    """
+    user_name, _, priority = target.partition(":")
+    return user_name, float(priority) if priority else 1.0
+
+
+def create_quota_table(conn):
+    """
+    Create the table recording the Botometer calls made each day
+    :param conn: Connection object of the scheduler database
+    :return:
+    """
+    conn.execute(""" CREATE TABLE IF NOT EXISTS quota_usage (
+                        day DATE PRIMARY KEY,
+                        used int NOT NULL DEFAULT 0
+                    ); """)
+
+
+def get_quota_used(conn, day):
+    """
+    :param conn: Connection object of the scheduler database
+    :param day: date
+    :return: number of Botometer calls made on that day
+    """
+    row = conn.execute("SELECT used FROM quota_usage WHERE day = ?",
+                       (day,)).fetchone()
+    return row[0] if row else 0
+
+
+def add_quota_used(conn, day, n):
+    """
+    :param conn: Connection object of the scheduler database
+    :param day: date
+    :param n: number of Botometer calls made
+    :return:
+    """
+    with conn:
+        conn.execute(""" INSERT INTO quota_usage(day, used) VALUES(?, ?)
+                         ON CONFLICT(day) DO UPDATE
+                         SET used = used + excluded.used""", (day, n))
+
+
+def get_account_stats(user_name, priority, days_to_keep, limit):
+    """
+    Measure how much bot checking an account needs
+    :param user_name: the screen_name of the target account
+    :param priority: priority given to the account
+    :param days_to_keep: number of days before the bot data expires
+    :param limit: maximum number of due followers to count
+    :return: dict with the account, its priority, due count and staleness
+    in days. Followers never checked count as twice days_to_keep stale.
+    """
+    create_new_followers_table(FOLLOWERS_DB)
+    conn = create_connection(FOLLOWERS_DB)
+    due = count_followers_to_check(conn, user_name, days_to_keep, limit)
+    never_checked, oldest = get_oldest_due_check(conn, user_name,
+                                                 days_to_keep)
+    if never_checked:
+        staleness = 2 * days_to_keep
+    elif oldest is not None:
+        staleness = (datetime.now() -
+                     datetime.fromisoformat(str(oldest))).days
+    else:
+        staleness = 0
+    return {"account": user_name, "priority": priority, "due": due,
+            "staleness": staleness}
+
+
+def plan_budget(stats, budget, days_to_keep):
+    """
+    Split the Botometer budget across accounts in proportion to their
+    priority times their staleness, never giving an account more than it
+    has due. What an account cannot use goes to the others.
+    :param stats: list of dicts returned by get_account_stats()
+    :param budget: number of Botometer calls available
+    :param days_to_keep: number of days before the bot data expires
+    :return: dict of account to number of followers to check
+    """
+    weights = {s["account"]: s["priority"] *
+               (1 + s["staleness"] / max(days_to_keep, 1)) for s in stats}
+    due = {s["account"]: s["due"] for s in stats}
+    plan = {s["account"]: 0 for s in stats}
+
+    while budget > 0:
+        active = [a for a in plan if plan[a] < due[a] and weights[a] > 0]
+        if not active:
+            break
+        total = sum(weights[a] for a in active)
+        given = 0
+        for a in active:
+            n = min(int(budget * weights[a] / total), due[a] - plan[a])
+            plan[a] += n
+            given += n
+        if given == 0:
+            # less budget left than accounts, give it to the heaviest ones
+            for a in sorted(active, key=lambda a: -weights[a])[:budget]:
+                plan[a] += 1
+                given += 1
+        budget -= given
+    return plan
+
+
+def select_account_followers(conn, writer, model, user_name, days_to_keep,
+                             want, prioritize, shared, predicted_counts):
+    """
+    Select up to want followers of an account for the Botometer calls of a
+    schedule. The followers already selected for another account are not
+    selected again, they count for this one too. Pre-filter results are
+    written at once, so they are not selected again.
+    :param conn: Connection object of the followers database
+    :param writer: CheckResultWriter of the run
+    :param model: pre-filter model, None to send all the followers to
+    Botometer
+    :param user_name: the screen_name of the target account
+    :param days_to_keep: number of days before the bot data expires
+    :param want: number of followers to select
+    :param prioritize: select the most suspicious and most stale first
+    :param shared: dict of follower id to (screen_name, list of accounts)
+    selected so far, updated
+    :param predicted_counts: dict of account to number of followers
+    estimated by the pre-filter, updated
+    :return: True if all the followers due have been selected
+    """
+    # enough candidates to get want new ones after the shared ones
+    limit = (want + len(shared)) * (LOOKAHEAD if model is not None else 1)
+    candidates = list(select_followers_to_check(
+        conn, user_name, days_to_keep, limit, prioritize))
+    to_check = []
+    for user_id, screen_name in candidates:
+        if user_id in shared:
+            if user_name not in shared[user_id][1]:
+                shared[user_id][1].append(user_name)
+        else:
+            to_check.append((user_id, screen_name))
+    if model is not None:
+        predicted, to_check = split_followers(model, conn, to_check)
+        now = datetime.now()
+        for user_id, screen_name, p in predicted:
+            writer.add("predicted", (p, now, screen_name))
+        predicted_counts[user_name] = \
+            predicted_counts.get(user_name, 0) + len(predicted)
+    # write the estimated results, so they are not selected again
+    writer.flush()
+    for user_id, screen_name in to_check[:want]:
+        shared[user_id] = (screen_name, [user_name])
+    return len(candidates) < limit
+
+
+def run_schedule(targets, daily_budget, days_to_keep, workers=4,
+                 rate_per_second=1.0, credentials_file=CREDENTIALS_FILE,
+                 progress=None, scorer=None, prefetch=4, prioritize=True,
+                 prefilter=False):
+    """
+    Check the followers of several accounts within one daily Botometer
+    budget. A follower of several accounts is checked once and counts for
+    all of them.
+    :param targets: list of (screen_name, priority)
+    :param daily_budget: Botometer calls allowed per day for all accounts
+    :param days_to_keep: number of days before the bot data expires
+    :param workers: number of concurrent Botometer requests
+    :param rate_per_second: Botometer requests allowed per second
+    :param credentials_file: path to the credentials file
+    :param progress: optional callback taking the fraction completed
+    :param scorer: score provider with a check_account method, by default
+    the live Botometer API
+    :param prefetch: number of concurrent Twitter fetches running ahead of
+    the Botometer calls
+    :param prioritize: check the most suspicious and most stale followers
+    of each account first
+    :param prefilter: only send to Botometer the followers the local
+    pre-filter is unsure about
+    :return: dict summarising the run
+    """
+    for user_name, _ in targets:
+        check_user_name(user_name)
+
+    today = date.today()
+    quota_conn = create_connection(SCHEDULER_DB)
+    create_quota_table(quota_conn)
+    budget = max(0, daily_budget - get_quota_used(quota_conn, today))
+    summary = {"day": str(today), "budget_left": budget, "planned": {},
+               "checked": {}, "predicted": {}, "api_calls": 0,
+               "rate_limited": False, "rate_limits": rate_limits.state()}
+    if budget == 0:
+        logger.warning("The daily Botometer budget has been used up. "
+                       "Continue the next day.")
+        return summary
+
+    # Never plan more than the Botometer quota left, as given by the rate
+    # limit headers of the last responses
+    quota = rate_limits.state().get("botometer", {}).get("remaining")
+    calls = budget if quota is None else min(budget, quota)
+    if calls == 0:
+        logger.warning("The Botometer quota is used up until it resets in " +
+                       str(int(rate_limits.delay("botometer"))) + "s.")
+        summary["rate_limited"] = True
+        return summary
+
+    # Plan how many followers of each account to check
+    stats = [get_account_stats(user_name, priority, days_to_keep,
+                               daily_budget)
+             for user_name, priority in targets]
+    plan = plan_budget(stats, calls, days_to_keep)
+    summary["planned"] = plan
+
+    conn = create_connection(FOLLOWERS_DB)
+    writer = CheckResultWriter(conn)
+    shared = {}  # follower id -> (screen_name, list of accounts)
+    checked = {user_name: 0 for user_name, _ in targets}
+    # the pre-filter is trained once on the followers of all the accounts
+    model = train_prefilter(conn) if prefilter else None
+    try:
+        # each account first gets its planned number of followers, then
+        # the budget left by the followers shared with the accounts before
+        # it goes to the accounts that have more due
+        exhausted = {a for a in plan if plan[a] == 0}
+        for first in (True, False):
+            for user_name, _ in targets:
+                want = plan[user_name] if first else calls - len(shared)
+                if user_name in exhausted or want <= 0:
+                    continue
+                if select_account_followers(
+                        conn, writer, model, user_name, days_to_keep, want,
+                        prioritize, shared, summary["predicted"]):
+                    exhausted.add(user_name)
+
+        def on_result(user_id, action, result):
+            writer.add(action, result)
+            for user_name in shared[user_id][1]:
+                checked[user_name] += 1
+
+        logger.info("Starting to check " + str(len(shared)) +
+                    " followers of " + str(len(targets)) + " accounts...")
+        bom = scorer
+        if bom is None:
+            bom = botometer_login(get_credentials(credentials_file))
+        bucket = TokenBucket(rate=rate_per_second,
+                             burst=max(1, int(rate_per_second)),
+                             quota=calls)
+        followers_to_check = [(user_id, screen_name)
+                              for user_id, (screen_name, _)
+                              in shared.items()]
+        try:
+            _, completed = run_checks(bom, followers_to_check, bucket,
+                                      on_result, workers=workers,
+                                      progress=progress, prefetch=prefetch)
+        finally:
+            add_quota_used(quota_conn, today, bucket.used)
+    finally:
+        writer.flush()
+
+    summary["checked"] = checked
+    summary["api_calls"] = bucket.used
+    summary["budget_left"] = budget - bucket.used
+    summary["rate_limited"] = not completed
+    summary["rate_limits"] = rate_limits.state()
+    if not completed:
+        logger.error("Botometer API daily limit is reached. "
+                     "Continue the next day.")
+    elif summary["budget_left"] == 0:
+        logger.warning("The daily Botometer budget has been used up. "
+                       "Continue the next day.")
+    return summary
+
+
+def seconds_until_tomorrow():
+    """
+    :return: number of seconds until the next local midnight
+    """
+    now = datetime.now()
+    tomorrow = datetime.combine(now.date() + timedelta(days=1),
+                                datetime.min.time())
+    return (tomorrow - now).total_seconds()
+
+
+def run_daily(targets, daily_budget, days_to_keep, **kwargs):
+    """
+    Keep running the schedule, waiting for the next day whenever the
+    budget is used up, the rate limit is hit or nothing is due, or for
+    the reset of the Botometer quota if it comes first.
+    Stop with Ctrl-C.
+    :param targets: list of (screen_name, priority)
+    :param daily_budget: Botometer calls allowed per day for all accounts
+    :param days_to_keep: number of days before the bot data expires
+    :param kwargs: passed to run_schedule()
+    :return:
+    """
+    while True:
+        summary = run_schedule(targets, daily_budget, days_to_keep,
+                               **kwargs)
+        if summary["api_calls"] > 0 and summary["budget_left"] > 0 \
+                and not summary["rate_limited"]:
+            # followers shared by several accounts left some budget over
+            continue
+        # the Botometer quota may reset before the next day
+        wait = rate_limits.delay("botometer") \
+            if summary["rate_limited"] else 0
+        if wait:
+            logger.info("Waiting " + str(int(wait)) + "s for the Botometer "
+                        "quota to reset.")
+        else:
+            wait = seconds_until_tomorrow()
+            logger.info("Waiting " + str(int(wait)) + "s for the next day.")
+        time.sleep(wait)
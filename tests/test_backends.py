@@ -0,0 +1,38 @@
+import time
+import tweepy
+from backends import PrefetchingBotometer
+from ratelimit import rate_limits
+
+
+class Response:
+
+    def __init__(self, headers, status_code=200):
+        self.headers = headers
+        self.status_code = status_code
+        self.text = ""
+
+
+def test_twitter_calls_wait_in_rate_limits():
+    bom = PrefetchingBotometer("key", "secret", "token", "token secret",
+                               rapidapi_key="rapidapi", wait_on_ratelimit=True)
+    # Tweepy does not sleep on its own
+    assert not bom.twitter_api.wait_on_rate_limit
+    calls = []
+
+    def timeline(user):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise tweepy.RateLimitError(
+                "Rate limit exceeded",
+                Response({"retry-after": "1"}, status_code=429))
+        bom.twitter_api.last_response = Response({
+            "x-rate-limit-limit": "1500",
+            "x-rate-limit-remaining": "1499",
+            "x-rate-limit-reset": str(int(time.time()) + 900)})
+        return ["tweet"]
+
+    assert bom._twitter_call("test_timeline", timeline, "a") == ["tweet"]
+    # retried once the 429 was over, not before
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.9
+    assert rate_limits.state()["test_timeline"]["remaining"] == 1499
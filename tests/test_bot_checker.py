@@ -0,0 +1,145 @@
+import threading
+import pytest
+import bot_checker
+from backends import SimulatedBotometer, http_error
+from bot_checker import (
+    PayloadPrefetcher,
+    check_bot_with_retry,
+    run_checks
+)
+from ratelimit import TokenBucket, rate_limits
+
+
+@pytest.fixture(autouse=True)
+def no_waits(monkeypatch):
+    # each test starts without rate limits and backs off at once
+    monkeypatch.setattr(rate_limits, "_limits", {})
+    monkeypatch.setattr(bot_checker, "backoff_delay", lambda attempt: 0)
+
+
+def followers(n):
+    return [(i, "sim_user_" + str(i)) for i in range(1, n + 1)]
+
+
+class FlakyBotometer(SimulatedBotometer):
+    """
+    Returns a 429 without rate limit headers to the first `failures` calls
+    of each account
+    """
+
+    def __init__(self, failures):
+        super().__init__(latency=0, private_rate=0, missing_rate=0)
+        self.failures = failures
+        self.fetches = {}
+        self.scores = {}
+
+    def fetch_payload(self, screen_name):
+        with self.lock:
+            self.fetches[screen_name] = self.fetches.get(screen_name, 0) + 1
+        return super().fetch_payload(screen_name)
+
+    def score_payload(self, payload):
+        screen_name = payload["user"]["screen_name"]
+        with self.lock:
+            self.scores[screen_name] = self.scores.get(screen_name, 0) + 1
+            failed = self.scores[screen_name] <= self.failures
+        if failed:
+            raise http_error(429)
+        return super().score_payload(payload)
+
+
+def test_run_checks():
+    bom = SimulatedBotometer(latency=0, private_rate=0.2, missing_rate=0.1)
+    results = []
+    checked, completed = run_checks(
+        bom, followers(50), TokenBucket(1000, burst=10),
+        lambda user_id, action, result: results.append((user_id, action)),
+        workers=4)
+    assert completed and checked == 50
+    assert sorted(user_id for user_id, _ in results) == list(range(1, 51))
+    actions = {action for _, action in results}
+    assert actions == {"success", "skip"}
+
+
+def test_retry_counts_once_against_quota():
+    bom = FlakyBotometer(failures=2)
+    bucket = TokenBucket(1000, burst=10, quota=1)
+    result, action = check_bot_with_retry("a", bom, bucket,
+                                          threading.Event())
+    assert action == "success" and result[-1] == "a"
+    assert bom.scores == {"a": 3}
+    assert bucket.used == 1
+
+    # still rate limited after all the retries
+    bom = FlakyBotometer(failures=10)
+    _, action = check_bot_with_retry("a", bom, TokenBucket(1000),
+                                     threading.Event(), max_retries=3)
+    assert action == "retry"
+    assert bom.scores == {"a": 4}
+
+
+def test_run_checks_stops_at_cap():
+    bom = SimulatedBotometer(latency=0, private_rate=0, missing_rate=0)
+    checked, completed = run_checks(
+        bom, followers(20), TokenBucket(1000, burst=10, quota=7),
+        lambda *args: None, workers=4)
+    assert completed and checked == 7
+    assert bom.calls == 7
+
+
+def test_run_checks_stops_when_rate_limited():
+    # the quota resets tomorrow, longer than MAX_RATE_LIMIT_WAIT
+    bom = SimulatedBotometer(latency=0, private_rate=0, missing_rate=0,
+                             daily_quota=5)
+    checked, completed = run_checks(
+        bom, followers(20), TokenBucket(1000, burst=10),
+        lambda *args: None, workers=1)
+    assert not completed and checked == 5
+    assert rate_limits.state()["botometer"]["remaining"] == 0
+
+
+def test_prefetched_payloads_fetched_once():
+    bom = FlakyBotometer(failures=1)
+    results = []
+    checked, completed = run_checks(
+        bom, followers(30), TokenBucket(1000, burst=10),
+        lambda user_id, action, result: results.append(result),
+        workers=4, prefetch=2)
+    assert completed and checked == 30
+    # retried Botometer calls reuse the prefetched payload
+    assert set(bom.fetches.values()) == {1}
+    assert set(bom.scores.values()) == {2}
+    # same results as without prefetching
+    expected = SimulatedBotometer(latency=0, private_rate=0, missing_rate=0)
+    assert {r[-1]: r[:16] for r in results} == {
+        s: bot_checker.check_bot(s, expected)[0][:16]
+        for _, s in followers(30)}
+
+
+def test_prefetcher_depth():
+    bom = FlakyBotometer(failures=0)
+    stop = threading.Event()
+    names = [s for _, s in followers(10)]
+    prefetcher = PayloadPrefetcher(bom, names, TokenBucket(1000), stop,
+                                   workers=2, depth=3)
+    try:
+        assert prefetcher.get(0).result() == {
+            "user": {"screen_name": "sim_user_1"}}
+        # the accounts after it are fetched ahead, no further
+        assert prefetcher.next == 4
+        prefetcher.get(1)
+        assert prefetcher.next == 5
+    finally:
+        prefetcher.close()
+    # nothing is fetched once the run is stopping
+    assert prefetcher.get(8).result() is None
+    assert "sim_user_9" not in bom.fetches
+
+    # nor once the quota of the run is used up
+    bucket = TokenBucket(1000, quota=0)
+    prefetcher = PayloadPrefetcher(bom, ["b"], bucket, threading.Event())
+    try:
+        assert prefetcher.get(0).result() is None
+    finally:
+        prefetcher.close()
+    assert "b" not in bom.fetches
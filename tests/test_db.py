@@ -0,0 +1,188 @@
+import os
+import sqlite3
+import db
+
+
+def create_baseline_db(path, followers):
+    """
+    Create a per account database in the layout of the first version of
+    the app, which stored the scores in the followers table and let SQLite
+    choose the ids
+    :param path: path to the database
+    :param followers: list of (screen_name, en_overall, last_check_date,
+    last_check_status)
+    :return:
+    """
+    conn = sqlite3.connect(path)
+    conn.execute(""" CREATE TABLE followers (
+                        id integer PRIMARY KEY,
+                        screen_name text NOT NULL,
+                        name text,
+                        description text,
+                        followers_count int,
+                        friends_count int,
+                        listed_count int,
+                        favourites_count int,
+                        created_at DATETIME,
+                        """ + ",\n".join(
+        c + " numeric" for c in db.SCORE_COLUMNS) + """,
+                        last_check_date DATETIME,
+                        last_check_status text,
+                        UNIQUE(screen_name)
+                    ); """)
+    with conn:
+        conn.executemany("INSERT INTO followers(screen_name, en_cap, "
+                         "en_overall, last_check_date, last_check_status) "
+                         "VALUES(?, ?, ?, ?, ?)",
+                         [(f[0], f[1], f[1]) + f[2:] for f in followers])
+    conn.close()
+
+
+def test_merge_baseline_db(tmp_path):
+    create_baseline_db(str(tmp_path / "alice_followers.db"), [
+        ("a", 0.9, "2020-08-01 10:00:00", "success"),
+        ("b", None, None, None)])
+    database = str(tmp_path / "followers.db")
+    db.create_new_followers_table(database)
+    # opening it again does not merge anything twice
+    db.create_new_followers_table(database)
+
+    assert not os.path.exists(tmp_path / "alice_followers.db")
+    assert os.path.exists(tmp_path / "alice_followers.db.merged")
+    conn = sqlite3.connect(database)
+    rows = conn.execute(""" SELECT f.screen_name, f.last_check_status,
+                                   f.en_overall, t.first_seen IS NOT NULL,
+                                   t.departed_at
+                            FROM followers f JOIN target_followers t
+                            ON t.follower_id = f.id AND t.target = "alice"
+                            ORDER BY f.screen_name""").fetchall()
+    assert rows == [("a", "success", 0.9, 1, None),
+                    ("b", None, None, 1, None)]
+    assert conn.execute(""" SELECT f.screen_name, h.en_overall
+                            FROM score_history h
+                            JOIN followers f ON f.id = h.user_id"""
+                        ).fetchall() == [("a", 0.9)]
+    conn.close()
+
+
+def profile(user_id, screen_name, name=""):
+    return (user_id, screen_name, name, "", 1, 1, 1, 1,
+            "Sat Aug 01 10:00:00 +0000 2020")
+
+
+def check_result(screen_name, score):
+    return (score,) * len(db.SCORE_COLUMNS) + \
+        ("2020-08-01 10:00:00", "success", screen_name)
+
+
+def test_merge_baseline_dbs_then_retrieve(tmp_path):
+    # SQLite gave the same ids to different followers in each database
+    create_baseline_db(str(tmp_path / "alice_followers.db"), [
+        ("a", 0.9, "2020-08-01 10:00:00", "success")])
+    create_baseline_db(str(tmp_path / "bob_followers.db"), [
+        ("c", 0.2, "2020-08-01 10:00:00", "success"),
+        ("a", None, None, None)])
+    database = str(tmp_path / "followers.db")
+    db.create_new_followers_table(database)
+    conn = db.open_connection(database)
+    assert conn.execute("SELECT target, f.screen_name, f.en_overall "
+                        "FROM target_followers t JOIN followers f "
+                        "ON f.id = t.follower_id ORDER BY 1, 2"
+                        ).fetchall() == [("alice", "a", 0.9),
+                                         ("bob", "a", 0.9),
+                                         ("bob", "c", 0.2)]
+
+    # retrieved again, the merged followers get their Twitter id along
+    # with their scores and target accounts
+    with conn:
+        db.create_followers(conn, [profile(1001, "a"), profile(1003, "c")],
+                            "bob")
+    assert conn.execute("SELECT id, screen_name, en_overall FROM followers "
+                        "ORDER BY id").fetchall() == [(1001, "a", 0.9),
+                                                      (1003, "c", 0.2)]
+    assert conn.execute("SELECT target, follower_id FROM target_followers "
+                        "ORDER BY 1, 2").fetchall() == [("alice", 1001),
+                                                        ("bob", 1001),
+                                                        ("bob", 1003)]
+    assert conn.execute("SELECT user_id FROM score_history "
+                        "ORDER BY 1").fetchall() == [(1001,), (1003,)]
+    conn.close()
+
+
+def test_screen_name_taken_by_another_account(tmp_path):
+    database = str(tmp_path / "followers.db")
+    db.create_new_followers_table(database)
+    conn = db.open_connection(database)
+    with conn:
+        db.create_followers(conn, [profile(11, "b", "Old")], "t")
+        db.update_follower_db(conn, [check_result("b", 0.9)])
+    # account 11 renamed, account 12 took its screen_name
+    with conn:
+        db.create_followers(conn, [profile(12, "b", "New")], "t")
+    assert conn.execute("SELECT id, screen_name, name, last_check_status, "
+                        "en_overall FROM followers ORDER BY id"
+                        ).fetchall() == [(11, "#11", "Old", "success", 0.9),
+                                         (12, "b", "New", None, None)]
+    assert conn.execute("SELECT user_id FROM score_history").fetchall() == \
+        [(11,)]
+    # account 11 is not checked until its new screen_name is known
+    for prioritize in (False, True):
+        assert list(db.select_followers_to_check(
+            conn, "t", 0, 10, prioritize=prioritize)) == [(12, "b")]
+    with conn:
+        db.create_followers(conn, [profile(11, "b2", "Old")], "t")
+    assert conn.execute("SELECT screen_name FROM followers WHERE id = 11"
+                        ).fetchone() == ("b2",)
+    conn.close()
+
+
+def test_merge_not_a_database(tmp_path):
+    (tmp_path / "bad_followers.db").write_bytes(b"not a database")
+    create_baseline_db(str(tmp_path / "alice_followers.db"), [
+        ("a", 0.9, "2020-08-01 10:00:00", "success")])
+    assert not db.is_followers_db(str(tmp_path / "bad_followers.db"))
+    assert db.is_followers_db(str(tmp_path / "alice_followers.db"))
+    database = str(tmp_path / "followers.db")
+    db.create_new_followers_table(database)
+    db.create_new_followers_table(database)
+
+    # set aside once, the other databases are still merged
+    assert os.path.exists(tmp_path / "bad_followers.db.failed")
+    assert not os.path.exists(tmp_path / "bad_followers.db")
+    assert os.path.exists(tmp_path / "alice_followers.db.merged")
+    conn = sqlite3.connect(database)
+    assert conn.execute("SELECT screen_name FROM followers").fetchall() == \
+        [("a",)]
+    conn.close()
+
+
+def test_schema_not_written_again(tmp_path):
+    database = str(tmp_path / "followers.db")
+    db.create_new_followers_table(database)
+    conn = db.open_connection(database)
+    version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    db.create_new_followers_table(database)
+    assert conn.execute("PRAGMA schema_version").fetchone()[0] == version
+
+    # a view from another version of the app is replaced
+    conn.execute("DROP VIEW followers_scores")
+    conn.execute("CREATE VIEW followers_scores AS SELECT id FROM followers")
+    db.create_new_followers_table(database)
+    columns = [row[1] for row in
+               conn.execute("PRAGMA table_info(followers_scores)")]
+    assert "en_overall" in columns and "change_seq" in columns
+    conn.close()
+
+
+def test_schema_set_up_once_per_database(tmp_path, monkeypatch):
+    from resources import Resources
+    calls = []
+    monkeypatch.setattr(db, "create_new_followers_table", calls.append)
+    database = str(tmp_path / "followers.db")
+    with Resources() as resources:
+        for _ in range(3):
+            resources.setup(("followers_schema", database),
+                            lambda: db.create_new_followers_table(database))
+        resources.setup(("followers_schema", database + "2"),
+                        lambda: db.create_new_followers_table(database + "2"))
+    assert calls == [database, database + "2"]
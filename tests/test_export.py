@@ -0,0 +1,59 @@
+import csv
+import pytest
+import db
+import export
+from tests.test_db import profile, check_result
+
+
+def read_csv(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def test_incremental_export_watermark(tmp_path, monkeypatch):
+    # the exports are written to temp/
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "temp").mkdir()
+    database = str(tmp_path / "followers.db")
+    monkeypatch.setattr(export, "FOLLOWERS_DB", database)
+    db.create_new_followers_table(database)
+    conn = db.open_connection(database)
+    with conn:
+        db.create_followers(conn, [profile(1, "a"), profile(2, "b")],
+                            "alice")
+
+    def export_changes(consumer="default"):
+        return export.export_followers(
+            "alice", columns=["screen_name", "en_overall"],
+            incremental=True, consumer=consumer)
+
+    path = export_changes()
+    assert [r["screen_name"] for r in read_csv(path)] == ["a", "b"]
+    # nothing changed since
+    assert export_changes() is None
+
+    with conn:
+        db.update_follower_db(conn, [check_result("b", 0.9)])
+    path = export_changes()
+    assert "_changes_" in path
+    assert read_csv(path) == [{"screen_name": "b", "en_overall": "0.9"}]
+    assert export_changes() is None
+
+    # each consumer has its own watermark
+    path = export_changes("warehouse")
+    assert sorted(r["screen_name"] for r in read_csv(path)) == ["a", "b"]
+
+    # a failed export does not move the watermark
+    with conn:
+        db.update_follower_db(conn, [check_result("a", 0.1)])
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    write_csv = export.write_csv
+    monkeypatch.setattr(export, "write_csv", fail)
+    with pytest.raises(OSError):
+        export_changes()
+    monkeypatch.setattr(export, "write_csv", write_csv)
+    path = export_changes()
+    assert [r["screen_name"] for r in read_csv(path)] == ["a"]
+    conn.close()
@@ -0,0 +1,111 @@
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+import pytest
+import jobs
+
+
+@pytest.fixture
+def jobs_db(tmp_path, monkeypatch):
+    """
+    :return: path to the jobs database, list of the ids of the jobs whose
+    worker was started. No worker process is started, the tests run the
+    jobs themselves.
+    """
+    started = []
+    monkeypatch.setattr(jobs, "start_worker",
+                        lambda job_id, database: started.append(job_id))
+    monkeypatch.setattr(jobs, "PROGRESS_INTERVAL", 0)
+    return str(tmp_path / "jobs.db"), started
+
+
+def fake_job(steps):
+    """
+    :param steps: number of progress reports of the job
+    :return: job function reporting steps times, then returning its count
+    """
+    def run(job, reporter):
+        for i in range(steps):
+            reporter.report(progress=(i + 1) / steps, message="step")
+        return {"steps": steps}
+    return run
+
+
+def test_pause_and_resume(jobs_db, monkeypatch):
+    database, started = jobs_db
+    job_id = jobs.submit_job("check", "alice", {"account_cap": 10},
+                             database)
+    assert started == [job_id]
+
+    # a queued job is paused before its worker claims it
+    assert jobs.pause_job(job_id, database)
+    assert jobs.get_job(job_id, database)["status"] == "paused"
+    assert jobs.run_job(job_id, database) is None
+    assert not jobs.pause_job(job_id, database)
+
+    assert jobs.resume_job(job_id, database)
+    assert started == [job_id, job_id]
+    assert not jobs.resume_job(job_id, database)
+
+    # a running job stops at its next progress report
+    def pause_then_run(job, reporter):
+        assert jobs.pause_job(job_id, database)
+        return fake_job(3)(job, reporter)
+    monkeypatch.setitem(jobs.JOB_KINDS, "check", pause_then_run)
+    assert jobs.run_job(job_id, database) == "paused"
+    job = jobs.get_job(job_id, database)
+    assert job["request"] is None and job["finished_at"] is None
+    assert job["started_at"] is not None
+
+    monkeypatch.setitem(jobs.JOB_KINDS, "check", fake_job(3))
+    assert jobs.resume_job(job_id, database)
+    assert jobs.run_job(job_id, database) == "done"
+    job = jobs.get_job(job_id, database)
+    assert job["progress"] == 1.0 and job["result"] == {"steps": 3}
+    assert not jobs.cancel_job(job_id, database)
+
+
+def test_cancel(jobs_db, monkeypatch):
+    database, _ = jobs_db
+    job_id = jobs.submit_job("retrieve", "alice", {}, database)
+
+    def cancel_then_run(job, reporter):
+        assert jobs.cancel_job(job_id, database)
+        return fake_job(3)(job, reporter)
+    monkeypatch.setitem(jobs.JOB_KINDS, "retrieve", cancel_then_run)
+    assert jobs.run_job(job_id, database) == "cancelled"
+    assert jobs.get_job(job_id, database)["finished_at"] is not None
+    assert not jobs.resume_job(job_id, database)
+
+
+def test_recover_stale_jobs(jobs_db):
+    database, _ = jobs_db
+    conn = jobs.jobs_connection(database)
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    ids = {}
+    for name, status, pid, age in [
+            ("dead", "running", dead.pid, 0),
+            ("no_pid", "running", None, 0),
+            ("alive", "running", os.getpid(), 0),
+            ("unclaimed", "queued", None, 120),
+            ("starting", "queued", None, 0),
+            ("done", "done", None, 120)]:
+        ids[name] = jobs.submit_job("check", name, {}, database)
+        with conn:
+            conn.execute("UPDATE jobs SET status = ?, pid = ?, "
+                         "updated_at = ? WHERE id = ?",
+                         (status, pid,
+                          datetime.now() - timedelta(seconds=age),
+                          ids[name]))
+
+    assert jobs.recover_jobs(database, grace=60) == 3
+    statuses = {name: jobs.get_job(job_id, database)["status"]
+                for name, job_id in ids.items()}
+    assert statuses == {"dead": "paused", "no_pid": "paused",
+                        "alive": "running", "unclaimed": "paused",
+                        "starting": "queued", "done": "done"}
+    assert jobs.get_job(ids["dead"], database)["message"] == \
+        "Interrupted, resume to continue"
+    conn.close()
@@ -0,0 +1,21 @@
+from metrics import Metrics, read_snapshot
+
+
+def test_read_snapshot(tmp_path):
+    metrics = Metrics(path=str(tmp_path / "metrics.prom"))
+    for seconds in (0.1, 0.2, 0.3):
+        metrics.observe("botometer_call", seconds)
+    metrics.set_gauge("quota_left", 42)
+    metrics.write()
+
+    snapshot = read_snapshot(str(tmp_path / "metrics.prom"))
+    expected = metrics.snapshot()
+    assert snapshot["gauges"] == {"quota_left": 42.0}
+    stats = snapshot["stages"]["botometer_call"]
+    assert stats["count"] == 3
+    for name in ("total_seconds", "p50", "p90", "p99"):
+        assert abs(stats[name] - expected["stages"]["botometer_call"][name]) \
+            < 1e-6
+    # no temporary file is left behind
+    assert [p.name for p in tmp_path.iterdir()] == ["metrics.prom"]
+    assert read_snapshot(str(tmp_path / "missing.prom")) is None
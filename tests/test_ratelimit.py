@@ -0,0 +1,81 @@
+import time
+import threading
+from ratelimit import TokenBucket, RateLimits
+
+
+def test_token_bucket_quota():
+    bucket = TokenBucket(1000, burst=3, quota=3)
+    assert [bucket.acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.remaining() == 0
+    # retries were already counted against the quota
+    assert bucket.acquire(consume_quota=False)
+    assert bucket.used == 3
+    assert TokenBucket(1).remaining() is None
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(20, burst=1)
+    start = time.monotonic()
+    for _ in range(3):
+        bucket.acquire()
+    # the first token is there at once, the next two take 1/20s each
+    assert 0.09 <= time.monotonic() - start < 0.5
+
+
+def twitter_headers(limit, remaining, reset_in):
+    return {"X-Rate-Limit-Limit": str(limit),
+            "X-Rate-Limit-Remaining": str(remaining),
+            "X-Rate-Limit-Reset": str(time.time() + reset_in)}
+
+
+def test_rate_limit_headers():
+    limits = RateLimits()
+    assert not limits.update("none", {"content-type": "text/plain"})
+    assert limits.delay("none") == 0
+
+    # Twitter gives the reset as a unix time
+    assert limits.update("twitter", twitter_headers(15, 0, 60))
+    assert 59 < limits.delay("twitter") <= 60
+    assert limits.state()["twitter"]["remaining"] == 0
+
+    # RapidAPI gives it in seconds from now, and its quota is not spread
+    limits.update("botometer", {"x-ratelimit-requests-limit": "500",
+                                "x-ratelimit-requests-remaining": "1",
+                                "x-ratelimit-requests-reset": "3600"})
+    assert limits.delay("botometer") == 0
+    limits.update("botometer", {"x-ratelimit-requests-limit": "500",
+                                "x-ratelimit-requests-remaining": "0",
+                                "x-ratelimit-requests-reset": "3600"})
+    assert 3599 < limits.delay("botometer") <= 3600
+
+    # a 429 may only tell when to retry
+    limits.update("retry", {"Retry-After": "5"})
+    assert 4 < limits.delay("retry") <= 5
+
+    # a window that has reset has an unknown budget
+    limits.update("old", twitter_headers(15, 0, -1))
+    assert limits.delay("old") == 0
+    assert limits.state()["old"]["remaining"] is None
+
+
+def test_rate_limit_waits():
+    limits = RateLimits(reserve=0.2)
+    # within the reserve, the calls left are spread until the reset
+    limits.update("twitter", twitter_headers(100, 10, 100))
+    assert limits.acquire("twitter")
+    assert 10 < limits.delay("twitter") <= 100 / 9
+    assert not limits.acquire("twitter", max_wait=1)
+    assert limits.state()["twitter"]["remaining"] == 9
+
+    # above the reserve the calls go at once
+    limits.update("twitter", twitter_headers(100, 50, 100))
+    assert limits.acquire("twitter", max_wait=0)
+    assert limits.acquire("twitter", max_wait=0)
+
+    # a stopped run does not wait for the reset
+    limits.update("twitter", twitter_headers(100, 0, 100))
+    stop = threading.Event()
+    threading.Timer(0.1, stop.set).start()
+    start = time.monotonic()
+    assert not limits.acquire("twitter", stop=stop)
+    assert time.monotonic() - start < 5
@@ -0,0 +1,68 @@
+import db
+import results
+from tests.test_db import profile, check_result
+
+
+def test_aggregates_versioned_per_target(tmp_path):
+    database = str(tmp_path / "followers.db")
+    db.create_new_followers_table(database)
+    conn = db.open_connection(database)
+    with conn:
+        db.create_followers(conn, [profile(1, "a")], "alice")
+        db.create_followers(conn, [profile(2, "b")], "bob")
+    assert results.count_results(conn, "alice") == 1
+    version = results.get_data_version(conn, "alice")
+
+    # a change of the followers of another account keeps the aggregates
+    with conn:
+        db.update_follower_db(conn, [check_result("b", 0.9)])
+    assert results.get_data_version(conn, "alice") == version
+    assert results.get_data_version(conn, "bob") > version
+    assert conn.execute("SELECT change_seq FROM aggregate_cache "
+                        "WHERE target = 'alice'").fetchall() == [(version,)]
+
+    # a change of its own followers drops them
+    for min_score in range(5):
+        results.count_results(conn, "alice", min_score=min_score / 10)
+    with conn:
+        db.update_follower_db(conn, [check_result("a", 0.8)])
+    assert results.count_results(conn, "alice", min_score=0.5) == 1
+    assert conn.execute("SELECT COUNT(*) FROM aggregate_cache "
+                        "WHERE target = 'alice'").fetchone() == (1,)
+    conn.close()
+
+
+def test_aggregate_cache_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(results, "AGGREGATE_CACHE_SIZE", 3)
+    database = str(tmp_path / "followers.db")
+    db.create_new_followers_table(database)
+    conn = db.open_connection(database)
+    with conn:
+        db.create_followers(conn, [profile(1, "a")], "alice")
+    for min_score in range(10):
+        results.count_results(conn, "alice", min_score=min_score / 10)
+    assert conn.execute("SELECT COUNT(*) FROM aggregate_cache"
+                        ).fetchone() == (3,)
+    conn.close()
+
+
+def test_sort_indexes(tmp_path):
+    database = str(tmp_path / "followers.db")
+    db.create_new_followers_table(database)
+    conn = db.open_connection(database)
+    # left by an earlier version, each bot check would still write it
+    conn.execute("CREATE INDEX followers_last_check_date "
+                 "ON followers(last_check_date)")
+    db.create_new_followers_table(database)
+    indexes = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' "
+        "AND tbl_name = 'followers' AND sql IS NOT NULL")]
+    assert "followers_last_check_date" not in indexes
+    # the default view of the results browser reads its page by index
+    where, params = results._where("alice", "success")
+    plan = " ".join(row[3] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT f.id FROM followers f" + where +
+        " ORDER BY f.en_overall DESC, f.id DESC LIMIT 50", params))
+    assert "followers_status_en_overall" in plan
+    assert "TEMP B-TREE" not in plan
+    conn.close()
@@ -0,0 +1,40 @@
+from scheduler import parse_target, plan_budget
+
+
+def stats(account, due, priority=1.0, staleness=0):
+    return {"account": account, "priority": priority, "due": due,
+            "staleness": staleness}
+
+
+def test_parse_target():
+    assert parse_target("alice") == ("alice", 1.0)
+    assert parse_target("bob:2.5") == ("bob", 2.5)
+
+
+def test_plan_budget_by_priority_and_staleness():
+    plan = plan_budget([stats("a", 1000, priority=3),
+                        stats("b", 1000)], 400, days_to_keep=30)
+    assert plan == {"a": 300, "b": 100}
+
+    # never checked followers count as 2 * days_to_keep stale
+    plan = plan_budget([stats("a", 1000, staleness=60),
+                        stats("b", 1000)], 400, days_to_keep=30)
+    assert plan == {"a": 300, "b": 100}
+
+
+def test_plan_budget_gives_what_is_left_to_the_others():
+    plan = plan_budget([stats("a", 10, priority=3), stats("b", 1000),
+                        stats("c", 0, priority=5)], 400, days_to_keep=30)
+    assert plan == {"a": 10, "b": 390, "c": 0}
+
+    # never more than is due
+    plan = plan_budget([stats("a", 10), stats("b", 20)], 400,
+                       days_to_keep=30)
+    assert plan == {"a": 10, "b": 20}
+
+
+def test_plan_budget_remainder():
+    # less budget left than accounts, it goes to the heaviest ones
+    plan = plan_budget([stats("a", 100), stats("b", 100, priority=2),
+                        stats("c", 100, priority=0)], 4, days_to_keep=30)
+    assert plan == {"a": 1, "b": 3, "c": 0}
@@ -1,559 +1,520 @@
 import sys
 import os
-import base64
-import io
-import json
+import hashlib
+import logging
 import time
-from datetime import datetime
+import atexit
+import threading
+from functools import partial
 import streamlit as st
-import pandas as pd
-import tweepy
-import requests
-import botometer
-import sqlite3
+try:
+    from streamlit.report_thread import add_report_ctx, get_report_ctx
+except ImportError:
+    # moved and renamed in later Streamlit versions
+    from streamlit.runtime.scriptrunner import (
+        add_script_run_ctx as add_report_ctx,
+        get_script_run_ctx as get_report_ctx
+    )
+from export import export_followers
+from db import (
+    FOLLOWERS_DB,
+    ACCOUNT_DB_SUFFIX,
+    create_connection,
+    create_new_followers_table,
+    is_followers_db
+)
+from results import (
+    RESULT_COLUMNS,
+    RESULT_SORTS,
+    RESULT_STATUSES,
+    get_results_page,
+    count_results,
+    score_histogram,
+    bot_share
+)
+from metrics import metrics, read_snapshot
+from resources import Resources, current_resources
+from jobs import (
+    ACTIVE_STATUSES,
+    submit_job,
+    list_jobs,
+    pause_job,
+    cancel_job,
+    resume_job,
+    recover_jobs,
+    job_metrics_path
+)
+
+
+class StreamlitHandler(logging.Handler):
+    """
+    Show the log records of the bot checker in the Streamlit page.
+    Records logged from worker threads are attached to the script's
+    report context so they are not dropped.
+    """
 
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.ctx = get_report_ctx()
+
+    def emit(self, record):
+        if get_report_ctx() is None and self.ctx is not None:
+            add_report_ctx(threading.current_thread(), self.ctx)
+        status = getattr(record, "status", None)
+        if status is None:
+            if record.levelno >= logging.ERROR:
+                status = "error"
+            elif record.levelno >= logging.WARNING:
+                status = "warning"
+            else:
+                status = "info"
+        getattr(st, status)(record.getMessage())
 
-def cache_file(f, path, filename, file_type="string"):
+
+def show_logs_in_page():
     """
-    Store the user uploaded files to the temp folder.
-    :param f: the stringIO or byteIO object
-    :param path: the name of the temp folder
-    :param filename: the name of the temp file
+    Route the log records of the bot checker to the current Streamlit page,
+    replacing the handler of the previous script run
     :return:
     """
-    if f is not None:
-        if not os.path.exists(path):
-            os.makedirs(path)
+    handler = StreamlitHandler()
+    for name in ("bot_checker", "db", "export", "prefilter"):
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.INFO)
+        for h in list(logger.handlers):
+            if isinstance(h, StreamlitHandler):
+                logger.removeHandler(h)
+        logger.addHandler(handler)
 
-        temporary_location = path + "/" + filename
 
-        if file_type == "string":
-            g = f
-            with open(temporary_location, mode='w') as f:
-                print(g.getvalue(), file=f)
-        elif file_type == "byte":
-            g = io.BytesIO(f.read())
-            with open(temporary_location, 'wb') as out:
-                out.write(g.read())
-        else:
-            print("Unknown type of file", file=sys.stderr)
+def _cache_resource(func):
+    # st.cache_resource in recent Streamlit versions, st.cache before
+    if hasattr(st, "cache_resource"):
+        return st.cache_resource(func)
+    return st.cache(allow_output_mutation=True)(func)
+
+
+# seconds the database connections of a browser session are kept after
+# its last script run
+SESSION_IDLE_TIMEOUT = 1800
 
 
-def get_credentials():
+def session_id():
     """
-    Load credential.json file from the temp folder
-    :return:
+    :return: id of the browser session of the current script run, or of
+    the current thread outside of a script run
     """
-    try:
-        f = open("temp/credentials.json")
-    except IOError:
-        st.error("Cannot find cached credentials."
-                 "Please specify file containing the credentials.")
-    else:
-        with f:
-            credentials = json.load(f)
-            return(credentials)
+    ctx = get_report_ctx()
+    if ctx is None:
+        return threading.get_ident()
+    return ctx.session_id
 
 
-def twitter_login():
+@_cache_resource
+def shared_resources():
     """
-    Log in Twitter API
-    :return: the api object
+    Database connections and API clients shared by the script runs of the
+    app, so each button click does not reconnect and log in again. Each
+    script run has a thread of its own, so the connections belong to the
+    browser session rather than to the thread.
+    :return: Resources closed when the server exits
     """
-    credentials = get_credentials()
-    consumer_key = credentials["twitter_app_auth"]["consumer_key"]
-    consumer_secret = credentials["twitter_app_auth"]["consumer_secret"]
+    resources = Resources(owner=session_id,
+                          idle_timeout=SESSION_IDLE_TIMEOUT)
+    atexit.register(resources.close)
+    return resources
 
-    auth = tweepy.AppAuthHandler(consumer_key, consumer_secret)
-    api = tweepy.API(auth)
-    if (api.verify_credentials):
-        st.success('Twitter API successfully logged in.')
-    else:
-        st.error('Login failed, please check Twitter credentials.')
-    return(api)
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 1:
+        return str(round(seconds * 1000)) + " ms"
+    if seconds < 120:
+        return str(round(seconds, 1)) + " s"
+    return str(round(seconds / 60)) + " min"
 
 
-def create_connection(db_file):
+def metrics_table(snapshot=None):
     """
-    Create a database connection to the SQLite database
-    specified by db_file. Create the database if not exist
-    :param db_file: database file
-    :return: Connection object or None
+    :param snapshot: metrics returned by Metrics.snapshot() or
+    read_snapshot(), those of this process by default
+    :return: markdown table of the stage timings, quota left and ETA
     """
-    conn = None
-    try:
-        conn = sqlite3.connect(db_file)
-        return conn
-    except sqlite3.Error as e:
-        print(e)
+    snapshot = snapshot or metrics.snapshot()
+    gauges = snapshot["gauges"]
+    lines = ["| stage | count | per second | p50 | p90 | p99 |",
+             "| --- | --- | --- | --- | --- | --- |"]
+    for stage, s in sorted(snapshot["stages"].items()):
+        lines.append("| " + " | ".join(
+            [stage, str(s["count"]), str(round(s["rate"], 2))] +
+            [format_seconds(s[p]) for p in ("p50", "p90", "p99")]) + " |")
+    if "quota_left" in gauges:
+        lines.append("\nQuota left: " + str(int(gauges["quota_left"])))
+    if "checks_total" in gauges:
+        lines.append("\nChecked " + str(int(gauges.get("checks_done", 0))) +
+                     " of " + str(int(gauges["checks_total"])) +
+                     ", ETA " + format_seconds(gauges.get("eta_seconds")))
+    return "\n".join(lines)
+
+
+def live_metrics(interval=1.0):
+    """
+    Show the pipeline metrics in a placeholder of the page
+    :param interval: minimum seconds between refreshes
+    :return: function refreshing the metrics, to be called from the
+    progress callbacks
+    """
+    placeholder = st.empty()
+    last = [0.0]
 
-    return conn
+    def refresh(force=False):
+        if force or time.monotonic() - last[0] >= interval:
+            last[0] = time.monotonic()
+            placeholder.markdown(metrics_table())
+    return refresh
 
 
-def create_table(conn, create_table_sql):
-    """
-    Create a table from the create_table_sql statement
-    :param conn: Connection object
-    :param create_table_sql: a CREATE TABLE statement
-    :return:
-    """
-    try:
-        c = conn.cursor()
-        c.execute(create_table_sql)
-    except sqlite3.Error as e:
-        print(e)
+# digest of the last upload stored at each path
+_cached_uploads = {}
 
 
-def create_new_followers_table(database):
+def cache_file(f, path, filename, file_type="string"):
     """
-    Create the followers table in the database if not exist.
-    screen_name is set to be unique.
-    :param db_file: Path to the cached database
+    Store the user uploaded files to the temp folder. The uploader returns
+    the same file on every rerun of the script, it is only written once.
+    :param f: the stringIO or byteIO object
+    :param path: the name of the temp folder
+    :param filename: the name of the temp file
     :return:
     """
-    sql_create_followers_table = """ CREATE TABLE IF NOT EXISTS followers (
-                                        id integer PRIMARY KEY,
-                                        screen_name text NOT NULL,
-                                        name text,
-                                        description text,
-                                        followers_count int,
-                                        friends_count int,
-                                        listed_count int,
-                                        favourites_count int,
-                                        created_at DATETIME,
-                                        en_cap numeric,
-                                        en_astroturf numeric,
-                                        en_fake_follower numeric,
-                                        en_financial numeric,
-                                        en_other numeric,
-                                        en_overall numeric,
-                                        en_self_declared numeric,
-                                        en_spammer numeric,
-                                        un_cap numeric,
-                                        un_astroturf numeric,
-                                        un_fake_follower numeric,
-                                        un_financial numeric,
-                                        un_other numeric,
-                                        un_overall numeric,
-                                        un_self_declared numeric,
-                                        un_spammer numeric,
-                                        last_check_date DATETIME,
-                                        last_check_status text,
-                                        UNIQUE(screen_name)
-                                    ); """
-    # create a database connection
-    conn = create_connection(database)
-
-    # create tables
-    if conn is not None:
-        # create projects table
-        create_table(conn, sql_create_followers_table)
-    else:
-        print("Error! cannot create the database connection.")
+    if f is not None:
+        if not os.path.exists(path):
+            os.makedirs(path)
 
+        temporary_location = path + "/" + filename
 
-def create_follower(conn, follower):
+        if file_type not in ("string", "byte"):
+            print("Unknown type of file", file=sys.stderr)
+            return
+        # the uploader of recent Streamlit versions gives bytes whatever
+        # the type of file
+        data = f.getvalue()
+        if isinstance(data, str):
+            data = data.encode()
+        digest = hashlib.sha1(data).hexdigest()
+        if _cached_uploads.get(temporary_location) == digest \
+                and os.path.exists(temporary_location):
+            return
+
+        with open(temporary_location, 'wb') as out:
+            out.write(data)
+        _cached_uploads[temporary_location] = digest
+
+
+def merge_uploaded_db(f, user_name):
     """
-    Create a new follower into the followers table
-    :param conn:
-    :param follower:
+    Store an uploaded database of the followers of an account, saved by an
+    older version of the app, next to the followers database and merge it.
+    The uploader returns the same file on every rerun of the script, it
+    is only merged once.
+    :param f: the uploaded file
+    :param user_name: the screen_name of the account
     :return:
     """
-    sql = """ INSERT OR IGNORE INTO followers(
-                screen_name,
-                name,
-                description,
-                followers_count,
-                friends_count,
-                listed_count,
-                favourites_count,
-                created_at)
-                VALUES(?,?,?,?,?,?,?,?)
-              """
-    cur = conn.cursor()
-    cur.execute(sql, follower)
-    conn.commit()
-
-
-def save_followers_to_db(user_name, followers):
-    """
-    Save the followers data returned by Tweepy to SQLite db
-    :param user_name: the screen_name of the account for which the followers
-    are collected
-    :param data: data returned by get_followers()
-    :return: None
-    """
-    database = "temp/" + user_name + "_followers.db"
-
-    # create a database connection
-    conn = create_connection(database)
-    with conn:
-        for i in followers:
-            # create a new follower
-            follower = (i._json["screen_name"],
-                        i._json["name"],
-                        i._json["description"],
-                        i._json["followers_count"],
-                        i._json["friends_count"],
-                        i._json["listed_count"],
-                        i._json["favourites_count"],
-                        i._json["created_at"])
-            create_follower(conn, follower)
-
-    st.success("Successfully saved followers to database.")
-
-
-def get_followers(user_name):
-    """
-    Get a list of all followers of a twitter account
-    :param user_name: twitter username without '@' symbol
-           api: Tweepy api
-    :return: list of usernames without '@' symbol
-    """
-    # Check if target account name was given
+    if f is None:
+        return
     if user_name == "":
-        st.error("You need to specify a target account name.")
-        raise TypeError("user_name is empty")
-
-    api = twitter_login()
-    followers = []
-    st.info("Begin to retrieve followers of " + user_name + "...")
-    for page in tweepy.Cursor(api.followers, screen_name=user_name,
-                              wait_on_rate_limit=True, count=200).pages():
-        try:
-            followers.extend(page)
-        except tweepy.TweepError as e:
-            st.text("Twitter API limit has been reached.\
-                    Continue in 60s.", e)
-            time.sleep(60)
-    st.success("Completed retrieving all followers of " + user_name)
-    return followers
-
-
-def get_download_link(bin_file, file_label='File'):
-    '''
-    Generate link to download any files stored on your disk
-    :param bin_file: path to the file
-           file_label: label of the file that shows in the button
-    :return: html link
-    '''
-    with open(bin_file, 'rb') as f:
-        data = f.read()
-    bin_str = base64.b64encode(data).decode()
-    href = f'<a href="data:application/octet-stream;base64,{bin_str}\
-        " download="{os.path.basename(bin_file)}">Download {file_label}</a>'
-    return href
-
-
-def retrieve_followers_button(user_name):
+        st.sidebar.info("Enter the account handler to merge the database.")
+        return
+    path = os.path.join(os.path.dirname(FOLLOWERS_DB),
+                        user_name + ACCOUNT_DB_SUFFIX)
+    data = f.getvalue()
+    digest = hashlib.sha1(data).hexdigest()
+    # the merged file is renamed, so only the digest tells it was merged
+    if _cached_uploads.get(path) == digest:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # checked under a name the merge does not pick up
+    upload = path + ".upload"
+    with open(upload, 'wb') as out:
+        out.write(data)
+    _cached_uploads[path] = digest
+    if not is_followers_db(upload):
+        os.remove(upload)
+        st.sidebar.error("The file is not a database of followers saved "
+                         "by the app.")
+        return
+    os.replace(upload, path)
+    create_new_followers_table(FOLLOWERS_DB)
+    st.sidebar.success("Merged the database of " + user_name + ".")
+
+
+def show_download_link(user_name, fmt="csv", columns=None,
+                       incremental=False):
+    """
+    Export the followers table and offer it for download with a button in
+    the sidebar.
+    :param user_name:
+    :param fmt: "csv", "csv.gz" or "parquet"
+    :param columns: list of columns to export, None for all
+    :param incremental: only export the rows changed since the last
+    incremental download
+    :return:
+    """
+    path = export_followers(user_name, fmt, columns,
+                            incremental=incremental)
+    if path is None:
+        st.sidebar.info("No followers changed since the last download.")
+        return
+    with open(path, 'rb') as f:
+        st.sidebar.download_button("Download followers table", f,
+                                   file_name=os.path.basename(path))
+
+
+def retrieve_followers_button(user_name, by_id=False, fmt="csv",
+                              columns=None, background=False):
     """
     Actions took when the "Retrieve followers" button is clicked.
     :param user_name:
+    :param by_id: fetch the follower ids first and only look up the
+    profiles of new followers
+    :param fmt: export format of the download
+    :param columns: columns of the download, None for all
+    :param background: run the retrieval as a background job
     :return:
     """
-    # Create the follower database if not exist
-    database = "temp/" + user_name + "_followers.db"
-    create_new_followers_table(database)
+    if background:
+        start_job("retrieve", user_name, {"by_id": by_id})
+        return
 
-    # Retrieve followers
-    followers = get_followers(user_name)
+    # imports the API clients, only needed in the foreground
+    from bot_checker import retrieve_followers
 
-    # Save followers to database
-    save_followers_to_db(user_name, followers)
+    counter = st.empty()
+    refresh_metrics = live_metrics()
+
+    def progress(n):
+        counter.text(str(n) + " followers saved to database...")
+        refresh_metrics()
+    retrieve_followers(user_name, by_id, progress=progress)
+    refresh_metrics(force=True)
 
     # Completion message
     st.balloons()
     st.success("Successfully retrieved all the followers!")
 
     # Display download link
-    conn = create_connection(database)
-    followers_df = pd.read_sql_query("SELECT * FROM followers", conn)
-    followers_csv = "temp/" + user_name + "_followers.csv"
-    followers_df.to_csv(followers_csv)
-    st.sidebar.markdown(
-        get_download_link(followers_csv, 'followers csv table'),
-        unsafe_allow_html=True)
+    show_download_link(user_name, fmt, columns)
 
 
-def update_follower_db(conn, result):
-    """
-    Update followers database with the results from bot check
-    :param conn:
-    :param result:
-    :return:
-    """
-    sql = """ UPDATE followers
-              SET en_cap = ? ,
-                  en_astroturf = ? ,
-                  en_fake_follower = ?,
-                  en_financial = ?,
-                  en_other = ?,
-                  en_overall = ?,
-                  en_self_declared = ?,
-                  en_spammer = ?,
-                  un_cap = ?,
-                  un_astroturf = ?,
-                  un_fake_follower = ?,
-                  un_financial = ?,
-                  un_other = ?,
-                  un_overall = ?,
-                  un_self_declared = ?,
-                  un_spammer = ?,
-                  last_check_date = ?,
-                  last_check_status = ?
-              WHERE screen_name = ?"""
-    cur = conn.cursor()
-    cur.execute(sql, result)
-    conn.commit()
-
-
-def update_follower_db_failed(conn, result):
-    """
-    Update followers database with the results from bot check
-    :param conn:
-    :param result:
-    :return:
-    """
-    sql = """ UPDATE followers
-              SET last_check_status = "blocked"
-              WHERE screen_name = ?"""
-    cur = conn.cursor()
-    cur.execute(sql, result)
-    conn.commit()
-
-
-def check_bot(screen_name, bom):
-    """
-    Call the Botometer API to return bot check info for an account
-    :param screen_name:
-    :param bom:
-    :return: result, check_action
-    """
-    result = (screen_name,)
-    try:
-        result_js = bom.check_account(screen_name)
-        cap = result_js["cap"]
-        raw_scores_en = result_js["raw_scores"]["english"]
-        raw_scores_un = result_js["raw_scores"]["universal"]
-
-        # Store the following results to tuple
-        result = (
-            cap["english"],
-            raw_scores_en["astroturf"],
-            raw_scores_en["fake_follower"],
-            raw_scores_en["financial"],
-            raw_scores_en["other"],
-            raw_scores_en["overall"],
-            raw_scores_en["self_declared"],
-            raw_scores_en["spammer"],
-            cap["universal"],
-            raw_scores_un["astroturf"],
-            raw_scores_un["fake_follower"],
-            raw_scores_un["financial"],
-            raw_scores_un["other"],
-            raw_scores_un["overall"],
-            raw_scores_un["self_declared"],
-            raw_scores_un["spammer"],
-            datetime.now(),  # stamp with current date and time
-            "success",
-            screen_name)  # need screen_name here as key
-
-        check_action = "success"
-        return(result, check_action)
-
-    except requests.exceptions.HTTPError as e:
-        status_code = e.response.status_code
-        if status_code == 401:
-            st.text(screen_name + " is a private account, "
-                                  "skipping bot check...")
-            check_action = "skip"
-            return(result, check_action)
-
-        elif status_code == 404:
-            st.text(screen_name + " has been suspended or deleted, "
-                                  "skipping bot check...")
-            check_action = "skip"
-            return(result, check_action)
-
-        elif status_code == 403:
-            st.error("Botometer account error! "
-                     "Please check Rapid API subscription and settings")
-            raise requests.exceptions.HTTPError
-
-        elif status_code == 429:
-            st.warning("API rate limit reached! The app will pause for 15 "
-                       "minutes and try again. Don't close the app.")
-            time.sleep(900)
-            check_action = "retry"
-            return(result, check_action)
-
-        else:
-            st.error("HTTP error: " + str(status_code))
-            raise requests.exceptions.HTTPError
-
-    except tweepy.TweepError as e:
-        error_text = e.response.text
-        if "Not authorized" in error_text:
-            st.text(screen_name + " is a private account, "
-                                  "skipping bot check...")
-            check_action = "skip"
-            return(result, check_action)
-        elif "does not exist" in error_text:
-            st.text(screen_name + " does not exist, "
-                                  "skipping bot check...")
-            check_action = "skip"
-            return(result, check_action)
-        else:
-            st.error("Other Tweepy error: " + error_text)
-            raise
-
-    except botometer.NoTimelineError:
-        st.text(screen_name + " account does not have enough information, "
-                              "skipping bot check...")
-        check_action = "skip"
-        return(result, check_action)
-
-    except Exception:
-        st.error("Unexpected error:" + sys.exc_info()[0])
-        raise
-
-
-def check_bot_button(user_name, days_to_keep, account_cap):
+def check_bot_button(user_name, days_to_keep, account_cap, workers=4,
+                     rate_per_second=1.0, fmt="csv", columns=None,
+                     prefetch=4, prioritize=True, prefilter=False,
+                     background=False):
     """
     Actions took when the "Check bot" button is clicked.
     :param user_name:
+    :param days_to_keep: number of days before the bot data expires
+    :param account_cap: maximum number of accounts to check in this run
+    :param workers: number of concurrent Botometer requests
+    :param rate_per_second: Botometer requests allowed per second
+    :param fmt: export format of the download
+    :param columns: columns of the download, None for all
+    :param prefetch: number of concurrent Twitter fetches running ahead of
+    the Botometer calls
+    :param prioritize: check the most suspicious and most stale followers
+    first
+    :param prefilter: only send to Botometer the followers the local
+    pre-filter is unsure about
+    :param background: run the checks as a background job
     :return:
     """
-    # Check if target account name was given
-    if user_name == "":
-        st.error("You need to specify a target account name.")
-        raise TypeError("user_name is empty")
-
-    # Load credentials
-    credentials = get_credentials()
-    rapidapi_key = credentials["botometer_auth"]["rapidapi_key"]
-    twitter_app_auth = credentials["twitter_app_auth"]
-
-    # Create botometer api
-    bom = botometer.Botometer(wait_on_ratelimit=True,
-                              rapidapi_key=rapidapi_key,
-                              **twitter_app_auth)
-
-    # Load followers table
-    database = "temp/" + user_name + "_followers.db"
-    try:
-        conn = create_connection(database)
-    except sqlite3.Error:
-        st.error("Cannot find cached database. "
-                 "Either run Retrieve Twitter followers function first or"
-                 "upload a database.")
-        raise sqlite3.Error("Cannot connect to database")
-    followers_df = pd.read_sql_query("SELECT * FROM followers", conn)
-
-    # Calculate the total number of followers need to be checked
-    # Give it an old date if last_check_date is empty
-    old_date = datetime.strptime("01-01-2000", "%d-%m-%Y").date()
-    followers_df.last_check_date.fillna(value=old_date, inplace=True)
-
-    followers_df["last_check_date"] = pd.to_datetime(
-        followers_df["last_check_date"])
-    NOW = datetime.now()
-
-    followers_df["expired"] = (NOW - followers_df["last_check_date"])\
-        .astype('timedelta64[D]') > days_to_keep
-
-    is_expired = followers_df["expired"]
-    is_not_blocked = followers_df["last_check_status"] != "blocked"
-    to_be_checked = is_expired & is_not_blocked
-    followers_to_check = followers_df[to_be_checked]["screen_name"]
-    N = sum(to_be_checked)
-
-    if N > 500:
-        st.warning("You have more than 500 followers to check. "
-                   "This is beyond the Botometer's daily limit (free plan), "
-                   "which may lead to suspension of your Rapid API "
-                   "account. Please make sure you set up a daily cap that "
-                   "is smaller than 500 or upgrade to a paid plan.")
-
-    # Loop through followers and check bot
-    st.info("Starting to check " + str(N) + " followers..."
-                                            "This may take a while.")
-    i = 0  # initiate counter
-    my_bar = st.progress(0)  # initiate progress bar
+    if background:
+        start_job("check", user_name, {
+            "days_to_keep": days_to_keep, "account_cap": account_cap,
+            "workers": workers, "rate_per_second": rate_per_second,
+            "prefetch": prefetch, "prioritize": prioritize,
+            "prefilter": prefilter})
+        return
 
-    for follower in followers_to_check:
-        # Check if the daily cap set is reached
-        if i >= account_cap:
-            st.warning("You have reached the daily cap set. "
-                       "Please continue the next day if you are using the "
-                       "free plan. Ignore this message and re-run the app "
-                       "if you are on the paid plan.")
-            break
-        i += 1  # counter
-        my_bar.progress(i/N)  # update progress bar
-        time.sleep(1)  # botometer has 1 sec per request limit
-        screen_name = follower
-
-        retry_count = 0
-        while True:
-            result, action = check_bot(screen_name, bom)
-            if action == "success":
-                update_follower_db(conn, result)  # store the result to db
-                break
-            elif action == "skip":
-                update_follower_db_failed(conn, result)
-                break
-            elif action == "retry" and retry_count == 0:
-                retry_count += 1
-                continue
-            elif action == "retry" and retry_count > 0:
-                st.error("Doh! Botometer API daily limit is reached. "
-                         "Please continue the next day. "
-                         "Don't worry, Followers that have "
-                         "been checked will not be lost.")
-                raise
-            else:
-                print("Unknown action code!")
-                raise
+    from bot_checker import run_bot_check
+
+    my_bar = st.progress(0)  # initiate progress bar
+    refresh_metrics = live_metrics()
+
+    def progress(fraction):
+        my_bar.progress(fraction)
+        refresh_metrics()
+    summary = run_bot_check(user_name, days_to_keep, account_cap, workers,
+                            rate_per_second, progress=progress,
+                            prefetch=prefetch, prioritize=prioritize,
+                            prefilter=prefilter)
+    refresh_metrics(force=True)
+    if summary["rate_limited"]:
+        return
 
     # Completion message
     st.balloons()
     st.success("Bot checking is completed!")
 
     # Show download link
-    followers_df = pd.read_sql_query("SELECT * FROM followers", conn)
-    followers_csv = "temp/" + user_name + "_followers.csv"
-    followers_df.to_csv(followers_csv)
-    st.sidebar.markdown(
-        get_download_link(followers_csv, 'followers csv table'),
-        unsafe_allow_html=True)
+    show_download_link(user_name, fmt, columns)
 
 
-def download_bot_result_button(user_name, days_to_keep=180):
+def start_job(kind, user_name, params):
     """
-    Actions took when the "Check bot" button is clicked.
+    Start a background job, shown in the jobs panel
+    :param kind: "retrieve" or "check"
     :param user_name:
+    :param params: keyword arguments of the job
     :return:
     """
-    # Check if target account name was given
-    if user_name == "":
-        st.error("You need to specify a target account name.")
-        raise TypeError("user_name is empty")
-
-    # Load followers table
-    database = "temp/" + user_name + "_followers.db"
-    try:
-        conn = create_connection(database)
-    except sqlite3.Error:
-        st.error("Cannot find cached database. "
-                 "Either run Retrieve Twitter followers function first or"
-                 "upload a database.")
-        raise sqlite3.Error("Cannot connect to database")
+    from bot_checker import check_user_name
+
+    # checked like in the foreground, rather than failing in the worker
+    check_user_name(user_name)
+    job_id = submit_job(kind, user_name, params)
+    st.sidebar.success("Job " + str(job_id) + " started. It keeps running "
+                       "if the page is closed.")
+
+
+JOB_TITLES = {"retrieve": "Retrieve followers", "check": "Check bot"}
+
+
+def show_job(status_slot, bar_slot, metrics_slot, job):
+    """
+    :param status_slot: placeholder of the status line
+    :param bar_slot: placeholder of the progress bar
+    :param metrics_slot: placeholder of the metrics written by the worker
+    :param job: dict returned by list_jobs()
+    :return:
+    """
+    text = job["status"].capitalize()
+    if job["message"]:
+        text += ": " + job["message"]
+    if job["status"] == "done" and job["result"]:
+        text += " " + ", ".join(str(k) + " " + str(v)
+                                for k, v in job["result"].items())
+    status_slot.text(text)
+    bar_slot.progress(min(1.0, job["progress"] or 0.0))
+    snapshot = read_snapshot(job_metrics_path(job["id"]))
+    if snapshot is not None:
+        metrics_slot.markdown(metrics_table(snapshot))
+
+
+def jobs_panel(limit=5, interval=1.0, timeout=600):
+    """
+    Show the most recent background jobs with their controls, polling
+    the jobs table until none is running or for timeout seconds at most
+    :param limit: number of jobs shown
+    :param interval: seconds between two polls
+    :param timeout: seconds after which the polling stops
+    :return:
+    """
+    recover_jobs()
+    jobs = list_jobs(limit)
+    if not jobs:
+        return
+    st.header("Jobs")
+    slots = {}
+    for job in jobs:
+        job_id = job["id"]
+        st.subheader(JOB_TITLES[job["kind"]] + " @" + job["user_name"] +
+                     " (job " + str(job_id) + ")")
+        slots[job_id] = (st.empty(), st.empty(), st.empty())
+        show_job(*slots[job_id], job)
+        if job["status"] == "paused":
+            if st.button("Resume", key="resume" + str(job_id)):
+                resume_job(job_id)
+        elif job["status"] in ACTIVE_STATUSES:
+            if st.button("Pause", key="pause" + str(job_id)):
+                pause_job(job_id)
+        if job["status"] in ACTIVE_STATUSES + ("paused",):
+            if st.button("Cancel", key="cancel" + str(job_id)):
+                cancel_job(job_id)
+
+    # a widget interaction reruns the script and ends the polling, the
+    # jobs keep running in their own processes
+    deadline = time.monotonic() + timeout
+    while True:
+        # a job whose worker died stops being active
+        recover_jobs()
+        jobs = [job for job in list_jobs(limit) if job["id"] in slots]
+        for job in jobs:
+            show_job(*slots[job["id"]], job)
+        if not any(job["status"] in ACTIVE_STATUSES for job in jobs):
+            break
+        if time.monotonic() >= deadline:
+            st.text("Rerun the page to follow the jobs again.")
+            break
+        time.sleep(interval)
 
+
+def results_viewer(user_name, page_size=50, bins=10):
+    """
+    Browse the bot check results of an account one page at a time. Only
+    the rows of the page are loaded, the counts and the histogram are
+    read from the aggregate cache while the followers do not change.
+    :param user_name:
+    :param page_size: number of followers per page
+    :param bins: number of bins of the score histogram
+    :return:
+    """
+    import pandas as pd
+
+    resources = current_resources()
+    if resources is None:
+        create_new_followers_table(FOLLOWERS_DB)
+    else:
+        # once for the app rather than on every rerun of the script
+        resources.setup(("followers_schema", FOLLOWERS_DB),
+                        partial(create_new_followers_table, FOLLOWERS_DB))
+    conn = create_connection(FOLLOWERS_DB)
+    st.header("Results @" + user_name)
+    score = st.selectbox("Score:", ["en_overall", "un_overall"])
+    bots, scored = bot_share(conn, user_name, score)
+    if scored:
+        st.markdown(str(bots) + " of the " + str(scored) + " checked "
+                    "followers (" + str(round(100 * bots / scored, 1)) +
+                    "%) have a " + score + " score of 0.5 or more.")
+    st.bar_chart(pd.DataFrame(
+        {"followers": score_histogram(conn, user_name, score, bins)},
+        index=[str(round(i / bins, 2)) + "-" + str(round((i + 1) / bins, 2))
+               for i in range(bins)]))
+
+    sort = st.selectbox("Sort by:", list(RESULT_SORTS))
+    descending = not st.checkbox("Lowest first", value=False)
+    # the checked followers, whose pages are read through an index
+    status = st.selectbox("Check status:", ["all"] + RESULT_STATUSES,
+                          index=1)
+    status = None if status == "all" else status
+    min_score = st.slider("Minimum " + score + " score:", 0.0, 1.0, 0.0,
+                          0.05)
+    min_score = min_score or None
+    departed = st.checkbox("Include followers who left", value=False)
+
+    total = count_results(conn, user_name, status, score, min_score,
+                          departed)
+    pages = max(1, -(-total // page_size))
+    page = st.number_input("Page (of " + str(pages) + "):", 1, pages, 1)
+    rows = get_results_page(conn, user_name, RESULT_SORTS[sort],
+                            descending, status, score, min_score, departed,
+                            page - 1, page_size)
+    st.text(str(total) + " followers")
+    st.dataframe(pd.DataFrame(rows, columns=RESULT_COLUMNS))
+
+
+def download_bot_result_button(user_name, fmt="csv", columns=None,
+                               incremental=False):
+    """
+    Actions took when the "Download bot check results" button is clicked.
+    :param user_name:
+    :param fmt: export format of the download
+    :param columns: columns of the download, None for all
+    :param incremental: only download the rows changed since the last
+    incremental download
+    :return:
+    """
     # Show download link
-    followers_df = pd.read_sql_query("SELECT * FROM followers", conn)
-    followers_csv = "temp/" + user_name + "_followers.csv"
-    followers_df.to_csv(followers_csv)
-    st.sidebar.markdown(
-        get_download_link(followers_csv, 'followers csv table'),
-        unsafe_allow_html=True)
+    show_download_link(user_name, fmt, columns, incremental)